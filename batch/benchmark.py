@@ -0,0 +1,354 @@
+"""Benchmark the submit and manage paths of umn_htcondor against a synthetic schedd
+
+The htcondor.Schedd is replaced by a local stand-in holding a configurable
+number of synthetic job ClassAds, so this can be run without touching the
+real batch system (or being on a scorpion). The wall time and peak (python)
+memory of each case is printed and written to a JSON report so that
+different runs can be compared over time.
+"""
+
+import os
+import sys
+import time
+import json
+import socket
+import random
+import getpass
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+
+import htcondor
+import classad
+from umn_htcondor import manage, utility
+from umn_htcondor.submit import JobInstructions
+
+class SyntheticTransaction :
+    """Stand-in for the transaction context of a schedd"""
+
+    def __init__(self, schedd) :
+        self.schedd = schedd
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, *exc) :
+        return False
+
+class SyntheticSubmitResult :
+    """Stand-in for the result of a submission"""
+
+    def __init__(self, cluster_id, num_procs) :
+        self.__cluster_id = cluster_id
+        self.__num_procs = num_procs
+
+    def cluster(self) :
+        return self.__cluster_id
+
+    def num_procs(self) :
+        return self.__num_procs
+
+class SyntheticSchedd :
+    """Local stand-in for htcondor.Schedd holding synthetic job ClassAds
+
+    Parameters
+    ----------
+    n_jobs : int
+        Number of synthetic jobs to start with
+    owner_fraction : float, optional
+        Fraction of the jobs that are owned by the current user
+    seed : int, optional
+        Seed for the random choices made when generating the jobs
+    """
+
+    hosts = [f'scorpion{i}' for i in range(1,49)]
+    others = ['alice', 'bob', 'carol']
+
+    def __init__(self, n_jobs, owner_fraction = 0.8, seed = 42) :
+        self.jobs = []
+        self.n_edits = 0
+        self.n_queries = 0
+        self.__next_cluster = 1000
+        self.__rng = random.Random(seed)
+        me = getpass.getuser()
+        # condor_submit adds its own terms to the requirements of the queued jobs
+        #   some jobs in each cluster have had other machines banned already, so the clusters are mixed
+        banned = ["caffeine","zebra01","zebra02","zebra03","zebra04"]
+        submit_terms = (' && (TARGET.Arch == "X86_64") && (TARGET.OpSys == "LINUX") && (TARGET.Disk >= RequestDisk)'
+            + ' && (TARGET.Memory >= RequestMemory) && (TARGET.HasFileTransfer)')
+        requirements = f'({utility.machine_requirements(banned = banned)})' + submit_terms
+        already_banned = f'({utility.machine_requirements(banned = banned + ["scorpion1","scorpion48"])})' + submit_terms
+        now = int(time.time())
+        for i in range(n_jobs) :
+            cluster, proc = 100 + i // 1000, i % 1000
+            owner = me if self.__rng.random() < owner_fraction else self.__rng.choice(SyntheticSchedd.others)
+            status = self.__rng.choice([1,1,2,2,2,5])
+            ad = classad.ClassAd({
+                'ClusterId' : cluster,
+                'ProcId' : proc,
+                'Owner' : owner,
+                'JobStatus' : status,
+                'ServerTime' : now,
+                'EnteredCurrentStatus' : now - self.__rng.randint(0, 36000),
+                'Args' : f'/hdfs/detail/run.sh {cluster}_{proc:04d} img.sif /hdfs/out fire /hdfs/detail/script.py {i}',
+                })
+            ad['Requirements'] = classad.ExprTree(already_banned if proc % 10 == 3 else requirements)
+            if status == 2 :
+                ad['RemoteHost'] = f'slot1_{proc%16}@{self.__rng.choice(SyntheticSchedd.hosts)}.spa.umn.edu'
+            elif status == 5 :
+                ad['LastRemoteHost'] = f'slot1_{proc%16}@{self.__rng.choice(SyntheticSchedd.hosts)}.spa.umn.edu'
+                ad['HoldReasonCode'] = 3
+                ad['HoldReasonSubCode'] = self.__rng.choice([99,100,115,117,118])
+            self.jobs.append(ad)
+        self.__index = { (j['ClusterId'], j['ProcId']) : i for i, j in enumerate(self.jobs) }
+
+    def _matching(self, constraint) :
+        """Generate the jobs matching the input constraint"""
+        expr = classad.ExprTree(str(constraint))
+        for j in self.jobs :
+            if expr.eval(j) is True :
+                yield j
+
+    def _project(self, job, projection) :
+        """Copy the job keeping only the attributes in the projection"""
+        if not projection :
+            return job
+        return classad.ClassAd({ a : job[a] for a in projection if a in job })
+
+    def xquery(self, constraint = True, projection = [], **kwargs) :
+        self.n_queries += 1
+        for j in self._matching(constraint) :
+            yield self._project(j, projection)
+
+    def query(self, constraint = True, projection = [], opts = None, **kwargs) :
+        if opts is not None and opts == getattr(htcondor.QueryOpts, 'SummaryOnly', None) :
+            self.n_queries += 1
+            statuses = [j['JobStatus'] for j in self._matching(constraint)]
+            return [classad.ClassAd({ 'Jobs' : len(statuses),
+                'Idle' : statuses.count(1), 'Running' : statuses.count(2), 'Held' : statuses.count(5) })]
+        return list(self.xquery(constraint, projection))
+
+    def act(self, action, job_spec, reason = None) :
+        n = 0
+        for j in self._matching(job_spec) :
+            n += 1
+        return classad.ClassAd({ 'TotalSuccess' : n })
+
+    def edit(self, job_spec, attr, value) :
+        self.n_edits += 1
+        if isinstance(job_spec, str) and job_spec.replace('.','').isdigit() :
+            cluster, proc = (int(p) for p in job_spec.split('.'))
+            i = self.__index.get((cluster, proc))
+            jobs = [] if i is None else [self.jobs[i]]
+        else :
+            jobs = list(self._matching(job_spec))
+        for j in jobs :
+            j[attr] = classad.ExprTree(str(value))
+
+    def transaction(self) :
+        return SyntheticTransaction(self)
+
+    def queue(self, itemdata) :
+        """Queue the items as a new cluster of jobs (used for JobInstructions.queue_with_itemdata)"""
+        cluster = self.__next_cluster
+        self.__next_cluster += 1
+        n = 0
+        for n, item in enumerate(itemdata, start=1) :
+            self.__index[(cluster, n-1)] = len(self.jobs)
+            self.jobs.append(classad.ClassAd({
+                'ClusterId' : cluster, 'ProcId' : n-1, 'Owner' : getpass.getuser(),
+                'JobStatus' : 1, 'Args' : ' '.join(item.values()) }))
+        return SyntheticSubmitResult(cluster, n)
+
+@contextlib.contextmanager
+def synthetic_schedd(schedd) :
+    """Replace htcondor.Schedd and the queueing of JobInstructions with the input stand-in"""
+
+    real_schedd = htcondor.Schedd
+    htcondor.Schedd = lambda *args, **kwargs : schedd
+    JobInstructions.queue_with_itemdata = lambda self, txn, itemdata = None : schedd.queue(itemdata)
+    try :
+        yield schedd
+    finally :
+        htcondor.Schedd = real_schedd
+        del JobInstructions.queue_with_itemdata
+
+def make_input_tree(top, n_files, files_per_dir = 1000) :
+    """Create a synthetic input directory tree of empty ROOT files"""
+
+    for i in range(n_files) :
+        d = os.path.join(top, f'batch{i // files_per_dir // 10}', f'sub{i // files_per_dir}')
+        if i % files_per_dir == 0 :
+            os.makedirs(d, exist_ok=True)
+        with open(os.path.join(d, f'sample_run_{i:06d}.root'), 'w') :
+            pass
+
+def quietly(func) :
+    """Wrap the input function so that it doesn't print to the screen"""
+
+    def quiet_func() :
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull) :
+            return func()
+    return quiet_func
+
+def measure(name, size, func, schedd = None) :
+    """Measure the wall time and peak python memory of calling func
+
+    If a schedd is given, the number of queries and edits
+    made to it while calling func are recorded as well.
+
+    Returns
+    -------
+        dict : record of the measurement
+    """
+
+    if schedd is not None :
+        n_queries, n_edits = schedd.n_queries, schedd.n_edits
+    tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    wall = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    record = { 'case' : name, 'size' : size, 'wall_s' : wall, 'peak_mem_MB' : peak / 1024**2 }
+    if schedd is not None :
+        record['schedd_queries'] = schedd.n_queries - n_queries
+        record['schedd_edits'] = schedd.n_edits - n_edits
+    print(f'{name:36} {size:8d} {wall:10.3f}s {record["peak_mem_MB"]:10.1f}MB', flush=True)
+    return record
+
+def banned_machines(schedd) :
+    """Get the set of banned machines of each of our idle and held jobs
+
+    Returns
+    -------
+        dict : (cluster, proc) -> set of banned machines
+    """
+
+    me = getpass.getuser()
+    return { (j['ClusterId'], j['ProcId']) : utility.parse_machine_requirements(str(j['Requirements']))[1]
+        for j in schedd.jobs if j['Owner'] == me and j['JobStatus'] in [1,5] }
+
+def check_flat_bans(schedd, machines, before) :
+    """Check that the input machines were banned by rewriting the banned set of machines in place
+
+    The requirements of the idle and held jobs should still have a single banned set
+    (with the input machines in it) and the terms condor_submit added, without any
+    'Machine != ...' comparisons chained onto the end. No job should lose a machine
+    it had banned before (the input from banned_machines), even in clusters where
+    some of the jobs were skipped since they already banned the machine.
+    """
+
+    me = getpass.getuser()
+    for j in schedd.jobs :
+        if j['Owner'] != me or j['JobStatus'] not in [1,5] :
+            continue
+        requirements = str(j['Requirements'])
+        allowed, banned = utility.parse_machine_requirements(requirements)
+        if ('Machine !=' in requirements or requirements.count('stringListMember') != 1
+                or not set(machines) <= banned or 'TARGET.HasFileTransfer' not in requirements) :
+            raise Exception(f'Machines were not banned in place: {requirements}')
+        if not before[(j['ClusterId'], j['ProcId'])] <= banned :
+            raise Exception(f'Job {j["ClusterId"]}.{j["ProcId"]} lost banned machines: {requirements}')
+
+def run_benchmarks(sizes, work_dir, cases) :
+    """Run the benchmark cases at each size
+
+    Parameters
+    ----------
+    sizes : list[int]
+        Number of jobs (or input files) to benchmark with
+    work_dir : str
+        Directory to create synthetic inputs and outputs in
+    cases : list[str]
+        Names of cases to run
+
+    Returns
+    -------
+        list[dict] : measurement records
+    """
+
+    # JobInstructions needs these to exist, the output directory needs 'hdfs' in it to avoid a prompt
+    os.environ.setdefault('LDMX_BASE', work_dir)
+    run_script = os.path.join(work_dir, 'run.sh')
+    img = os.path.join(work_dir, 'img.sif')
+    for f in [run_script, img] :
+        with open(f, 'w') :
+            pass
+
+    def job_instructions(size) :
+        return JobInstructions(run_script, os.path.join(work_dir, 'hdfs', f'out{size}'), img, None)
+
+    records = []
+    print(f'{"CASE":36} {"SIZE":>8} {"WALL":>11} {"PEAK MEM":>12}')
+    for size in sizes :
+        if 'run_over_input_dirs' in cases :
+            input_dir = os.path.join(work_dir, 'hdfs', f'in{size}')
+            make_input_tree(input_dir, size)
+            # make sure the directories aren't considered too recently modified to trust
+            then = time.time() - 60
+            for d, sub_dirs, files in os.walk(input_dir) :
+                os.utime(d, (then, then))
+            catalog = os.path.join(work_dir, f'catalog{size}.sqlite')
+            def run_over_input_dirs(catalog) :
+                # the items are only made as they are looped over, so we loop over them
+                #   to include scanning the directories (and using the catalog)
+                ji = job_instructions(size)
+                ji.run_over_input_dirs([input_dir], 10, catalog = catalog)
+                return sum(1 for item in ji._items())
+            records.append(measure('run_over_input_dirs', size,
+                quietly(lambda : run_over_input_dirs(False))))
+            records.append(measure('run_over_input_dirs (cold catalog)', size,
+                quietly(lambda : run_over_input_dirs(catalog))))
+            records.append(measure('run_over_input_dirs (warm catalog)', size,
+                quietly(lambda : run_over_input_dirs(catalog))))
+
+        if 'submit' in cases :
+            with synthetic_schedd(SyntheticSchedd(0)) as schedd :
+                def submit() :
+                    ji = job_instructions(size)
+                    ji.run_numbers(0, size)
+                    ji.submit()
+                records.append(measure('submit', size, quietly(submit), schedd))
+
+        with synthetic_schedd(SyntheticSchedd(size)) as schedd, open(os.devnull, 'w') as devnull :
+            if 'print_q' in cases :
+                records.append(measure('print_q', size, lambda : manage.print_q(o = devnull), schedd))
+            if 'get_q_totals' in cases :
+                records.append(measure('get_q_totals', size, manage.get_q_totals, schedd))
+            if 'hosts' in cases :
+                records.append(measure('hosts', size, manage.hosts, schedd))
+            if 'who' in cases :
+                records.append(measure('who', size, quietly(manage.who), schedd))
+            if 'ban_machine' in cases :
+                before = banned_machines(schedd)
+                records.append(measure('ban_machine', size, lambda : manage.ban_machine('scorpion1'), schedd))
+                records.append(measure('ban_machine (second machine)', size, lambda : manage.ban_machine('scorpion2'), schedd))
+                check_flat_bans(schedd, ['scorpion1','scorpion2'], before)
+
+    return records
+
+if __name__ == '__main__' :
+    all_cases = ['run_over_input_dirs', 'submit', 'print_q', 'get_q_totals', 'hosts', 'who', 'ban_machine']
+
+    parser = argparse.ArgumentParser('ldmx-benchmark',
+        description="Benchmark the umn_htcondor submit and manage functions against a synthetic schedd.")
+    parser.add_argument('--sizes',type=int,nargs='+',default=[1000,10000,100000],help='Numbers of jobs (and input files) to benchmark with.')
+    parser.add_argument('--cases',type=str,nargs='+',default=all_cases,choices=all_cases,help='Which cases to benchmark.')
+    parser.add_argument('--work_dir',type=str,help='Directory to write the synthetic inputs and outputs to. Default is a temporary directory that is removed afterwards.')
+    parser.add_argument('--report',type=str,default=f'benchmark.{time.strftime("%Y%m%d-%H%M%S")}.json',help='JSON file to write the report to.')
+    arg = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir :
+        records = run_benchmarks(arg.sizes, arg.work_dir or tmp_dir, arg.cases)
+
+    with open(arg.report, 'w') as report :
+        json.dump({
+            'time' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'host' : socket.gethostname(),
+            'python' : sys.version.split()[0],
+            'htcondor' : htcondor.version(),
+            'results' : records
+            }, report, indent=1)
+    print(f'Report written to {arg.report}')
@@ -41,8 +41,10 @@ check-host() {
 }
 
 # check all the scorpions
+#   all of the scorpions are checked at once, waiting at most 30s for each,
+#   and the results are remembered for a few minutes (see umn_htcondor/probe.py)
 check-scorpions() {
-  for scorpion in scorpion{1..48}; do check-host $scorpion; done
+  python3 -m umn_htcondor.probe check $@
 }
 
 # clean the host's /export/scratch/users directory by removing this user's working directory
@@ -58,7 +60,7 @@ clean-host() {
 # clean all of the scorpions
 #   Don't run this while you have any jobs running!!!
 clean-scorpions() {
-  for scorpion in scorpion{1..48}; do clean-host $scorpion; done
+  python3 -m umn_htcondor.probe clean $@
 }
 
 # print the disk space for the /export/scratch directory of the input host
@@ -72,8 +74,9 @@ scratch-space-on-host() {
 }
 
 # print the disk space on all the scorpions
+#   all of the scorpions are checked at once (see check-scorpions)
 list-scorpion-scratch-space() {
-  for scorpion in scorpion{1..48}; do scratch-space-on-host $scorpion; done
+  python3 -m umn_htcondor.probe scratch $@
 }
 
 # List jobs that failed to copy
@@ -81,9 +84,27 @@ failed-copy() {
   my-q -held -constraint 'HoldReasonSubCode == 118' $@
 }
 
+# Count the held jobs by exit code, host, and cluster
+#   with the age of the oldest hold in each group
+hold-summary() {
+  python3 -c 'from umn_htcondor import manage; manage.hold_summary()'
+}
+
+# Summarize the event logs in the input log directory (default is current directory)
+#   into a CSV file (log_summary.csv next to the log directory)
+#   Only logs that changed since the last summary are read again.
+summarize-logs() {
+  local _log_dir="${1:-.}"
+  [[ $# -gt 0 ]] && shift
+  python3 -m umn_htcondor.logs $_log_dir $@
+}
+
 # Archive log files for the input cluster
+#   The logs in the current directory are summarized first,
+#   so their summary is kept after they are archived.
 archive-logs() {
   local _cluster="$1"
+  summarize-logs .
   tar --create --remove-files --verbose --file $_cluster.tar.gz ${_cluster}_*
 }
 
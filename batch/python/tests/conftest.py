@@ -0,0 +1,9 @@
+"""Make the umn_htcondor package importable however the tests are run
+
+    python3 -m pytest batch/python/tests
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
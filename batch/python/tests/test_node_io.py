@@ -0,0 +1,98 @@
+"""Tests of the input cache the run script stages input files through on the worker nodes"""
+
+import os
+
+import pytest
+
+from umn_htcondor import node_io
+
+def _input(path, size, content = b'x') :
+    """Write an input file of the input size"""
+    path.parent.mkdir(parents = True, exist_ok = True)
+    path.write_bytes(content*size)
+    return str(path)
+
+@pytest.fixture
+def cache(tmp_path) :
+    return node_io.InputCache(str(tmp_path / 'cache'), max_size = 1000)
+
+def _job(tmp_path, name) :
+    """Make a working directory for a job"""
+    d = tmp_path / name
+    d.mkdir()
+    return str(d)
+
+def _cached_files(cache) :
+    """Names of the files in the cache, including any being copied in"""
+    return sorted(os.listdir(os.path.join(cache.cache_dir, 'files')))
+
+def test_miss_then_hit(tmp_path, cache) :
+    source = _input(tmp_path / 'hdfs' / 'a.root', 100)
+    first = cache.stage(source, _job(tmp_path, 'job1'))
+    second = cache.stage(source, _job(tmp_path, 'job2'))
+    assert (cache.misses, cache.hits) == (1, 1)
+    assert open(first, 'rb').read() == open(second, 'rb').read() == open(source, 'rb').read()
+    # the jobs and the cache share one copy
+    assert os.stat(first).st_ino == os.stat(second).st_ino
+    assert os.stat(first).st_nlink == 3
+
+def test_changed_source_is_copied_again(tmp_path, cache) :
+    source = _input(tmp_path / 'hdfs' / 'a.root', 100)
+    cache.stage(source, _job(tmp_path, 'job1'))
+    _input(tmp_path / 'hdfs' / 'a.root', 120, b'y')
+    staged = cache.stage(source, _job(tmp_path, 'job2'))
+    assert (cache.misses, cache.hits) == (2, 0)
+    assert open(staged, 'rb').read() == b'y'*120
+
+def test_same_name_in_job(tmp_path, cache) :
+    job = _job(tmp_path, 'job')
+    a = cache.stage(_input(tmp_path / 'one' / 'a.root', 10), job)
+    b = cache.stage(_input(tmp_path / 'two' / 'a.root', 20), job)
+    assert a != b and os.path.getsize(a) == 10 and os.path.getsize(b) == 20
+
+def test_least_recently_used_are_evicted(tmp_path, cache) :
+    def stage(name, when = None) :
+        job = _job(tmp_path, f'job-{name}-{len(os.listdir(tmp_path))}')
+        source = tmp_path / 'hdfs' / f'{name}.root'
+        staged = cache.stage(str(source) if source.exists() else _input(source, 400), job)
+        if when is not None :
+            os.utime(staged, (when, when))
+        # the job finishes and cleans up its working directory
+        os.remove(staged)
+
+    stage('a', 1)
+    stage('b', 2)
+    # using a again makes b the least recently used
+    stage('a')
+    stage('c')
+    assert (cache.evicted, cache.hits) == (1, 1)
+    assert {f.split('-')[-1] for f in _cached_files(cache)} == {'a.root', 'c.root'}
+
+def test_files_in_use_are_not_evicted(tmp_path, cache) :
+    a = _input(tmp_path / 'hdfs' / 'a.root', 600)
+    b = _input(tmp_path / 'hdfs' / 'b.root', 600)
+    cache.stage(a, _job(tmp_path, 'job1'))
+    # a is still linked into job1, so there isn't room for b
+    assert cache.stage(b, _job(tmp_path, 'job2')) == b
+    assert (cache.evicted, cache.bypassed) == (0, 1)
+
+def test_too_large_is_not_cached(tmp_path, cache) :
+    source = _input(tmp_path / 'hdfs' / 'big.root', 2000)
+    assert cache.stage(source, _job(tmp_path, 'job')) == source
+    assert cache.bypassed == 1 and _cached_files(cache) == []
+
+def test_failed_copy_leaves_nothing(tmp_path, cache, monkeypatch) :
+    def interrupted(source, dest, algorithm = 'adler32', verify = True) :
+        with open(dest, 'wb') as f :
+            f.write(b'half')
+        raise KeyboardInterrupt()
+    monkeypatch.setattr(node_io, '_copy_file', interrupted)
+    with pytest.raises(KeyboardInterrupt) :
+        cache.stage(_input(tmp_path / 'hdfs' / 'a.root', 100), _job(tmp_path, 'job'))
+    assert _cached_files(cache) == []
+
+def test_verify(tmp_path) :
+    cache = node_io.InputCache(str(tmp_path / 'cache'), max_size = 1000, verify = True)
+    source = _input(tmp_path / 'hdfs' / 'img.sif', 500)
+    staged = cache.stage(source, _job(tmp_path, 'job'))
+    assert node_io.checksum_file(staged) == node_io.checksum_file(source)
@@ -0,0 +1,101 @@
+"""Tests of the work queue shared by the pilots and of running a pilot on this machine"""
+
+import time
+
+import pytest
+
+from umn_htcondor import pilot
+
+@pytest.fixture
+def queue(tmp_path) :
+    q = pilot.WorkQueue(str(tmp_path / 'queue.db'))
+    yield q
+    q.close()
+
+def test_claim_in_order(queue) :
+    assert queue.fill(['1','2']) == 2
+    assert queue.claim('p1') == (1, '1')
+    assert queue.claim('p2') == (2, '2')
+    assert queue.claim('p3') is None
+    assert queue.counts()[pilot.RUNNING] == 2
+
+def test_pilots_do_not_share_items(tmp_path, queue) :
+    queue.fill(str(i) for i in range(10))
+    other = pilot.WorkQueue(queue.path)
+    try :
+        claimed = [q.claim(f'p{i}') for i in range(5) for q in [queue, other]]
+    finally :
+        other.close()
+    assert sorted(item for item, args in claimed) == list(range(1,11))
+
+def test_complete(queue) :
+    queue.fill(['1','2','3'])
+    # an item whose outputs failed to copy goes back into the queue and is claimed again first
+    for expected, exit_code, status in [(1, 0, pilot.DONE), (2, 118, pilot.PENDING), (2, 115, pilot.FAILED)] :
+        item, args = queue.claim('p')
+        assert item == expected
+        assert queue.complete(item, 'p', exit_code) == status
+    assert queue.counts() == { pilot.PENDING : 1, pilot.RUNNING : 0, pilot.DONE : 1, pilot.FAILED : 1 }
+    assert queue.failed() == [(2, '2', 115)]
+
+def test_expired_lease_is_claimed_again(queue) :
+    queue.fill(['1'])
+    item, args = queue.claim('slow', lease = -1)
+    assert queue.claim('fast') == (item, args)
+    # the first pilot doesn't hold the item anymore
+    assert not queue.renew(item, 'slow')
+    assert queue.complete(item, 'slow', 0) is None
+    assert queue.renew(item, 'fast')
+    assert queue.complete(item, 'fast', 0) == pilot.DONE
+
+def test_max_attempts(queue) :
+    queue.fill(['1'])
+    for attempt in range(2) :
+        item, args = queue.claim('p', max_attempts = 2)
+        queue.complete(item, 'p', 117)
+    assert queue.claim('p', max_attempts = 2) is None
+    assert queue.counts()[pilot.FAILED] == 1
+
+def test_release_does_not_count(queue) :
+    queue.fill(['1'])
+    for attempt in range(3) :
+        item, args = queue.claim('p', max_attempts = 1)
+        queue.release(item, 'p')
+    assert queue.claim('p', max_attempts = 1) == (1, '1')
+
+def test_check_queue(tmp_path) :
+    pilot.check_queue(str(tmp_path / 'queue.db'))
+    with pytest.raises(Exception, match = 'Unable to use') :
+        pilot.check_queue(str(tmp_path / 'missing' / 'queue.db'))
+
+def _run_script(tmp_path, body) :
+    """Write a run script with the input body"""
+    script = tmp_path / 'run.sh'
+    script.write_text(body)
+    return str(script)
+
+def test_run_pilot(tmp_path, queue) :
+    queue.fill(['1','2','3'])
+    # the run script gets the job ID, the shared arguments, and the item's arguments
+    run_script = _run_script(tmp_path, f'echo "$@" >> {tmp_path}/ran; [[ $3 != 2 ]]\n')
+    assert pilot.run_pilot(queue, '7_0000', run_script, ['shared']) == 0
+    assert (tmp_path / 'ran').read_text().splitlines() == [
+        '7_0000_000001 shared 1', '7_0000_000002 shared 2', '7_0000_000003 shared 3']
+    assert queue.counts()[pilot.DONE] == 2
+    assert queue.failed() == [(2, '2', 1)]
+
+def test_node_cannot_run(tmp_path, queue) :
+    queue.fill(['1'])
+    assert pilot.run_pilot(queue, '7_0000', _run_script(tmp_path, 'exit 99\n')) == 99
+    # the item goes back without counting this attempt
+    assert queue.counts()[pilot.PENDING] == 1
+    assert queue.claim('p', max_attempts = 1) == (1, '1')
+
+def test_lost_lease_stops_run_script(tmp_path, queue, monkeypatch) :
+    queue.fill(['1'])
+    monkeypatch.setattr(queue, 'renew', lambda *args : False)
+    start = time.time()
+    pilot.run_pilot(queue, '7_0000', _run_script(tmp_path, 'sleep 30\n'), lease = 0.3, max_time = 1)
+    assert time.time() - start < 10
+    # nothing is recorded for an item another pilot may be running
+    assert queue.counts()[pilot.RUNNING] == 1
@@ -0,0 +1,63 @@
+"""Tests of probing nodes, running the checks on this machine with the local transport"""
+
+import pytest
+
+pytest.importorskip('htcondor') # umn_htcondor.utility needs the HTCondor python API
+
+from umn_htcondor import probe, utility
+
+@pytest.fixture(autouse = True)
+def local_dir(tmp_path, monkeypatch) :
+    """Remember the results in a temporary directory instead of your local directory"""
+    monkeypatch.setattr(utility, 'local_dir', lambda : str(tmp_path))
+    monkeypatch.setitem(probe.checks, 'hello', 'echo hello')
+    monkeypatch.setitem(probe.checks, 'slow', 'sleep 5; echo done')
+    return tmp_path
+
+def _refuse(host, command) :
+    """Transport for hosts we shouldn't be asking"""
+    raise AssertionError(f'{host} was asked again')
+
+def test_probe_local() :
+    results = probe.probe('hello', ['a','b','c'], probe.local_transport, max_age = 0)
+    assert list(results) == ['a','b','c']
+    assert all(r.ok and r.output == 'hello' for r in results.values())
+
+def test_results_are_remembered() :
+    first = probe.probe('hello', ['a','b'], probe.local_transport)
+    again = probe.probe('hello', ['a','b'], _refuse)
+    assert again == first
+    assert set(probe.cached('hello')) == {'a','b'}
+
+def test_only_new_hosts_are_asked() :
+    probe.probe('hello', ['a'], probe.local_transport)
+    asked = []
+    def transport(host, command) :
+        asked.append(host)
+        return probe.local_transport(host, command)
+    probe.probe('hello', ['a','b'], transport)
+    assert asked == ['b']
+
+def test_max_age_zero_asks_again() :
+    probe.probe('hello', ['a'], probe.local_transport)
+    with pytest.raises(AssertionError) :
+        probe.probe('hello', ['a'], _refuse, max_age = 0)
+
+def test_timeout() :
+    results = probe.probe('slow', ['a','b'], probe.local_transport, timeout = 0.5, max_age = 0)
+    assert all(not r.ok and r.output.startswith('Timed out') for r in results.values())
+
+def test_scratch() :
+    r = probe.probe('scratch', ['a'], lambda host, command : ['bash', '-c', command.replace('/export/scratch', '/')])['a']
+    # one line for the filesystem with its sizes in human-readable units
+    filesystem, size, used, available, percent, mount = r.output.split()
+    assert r.ok and mount == '/' and size[-1] in 'KMGTP'
+
+def test_bad_hosts() :
+    probe.probe('hello', ['a'], probe.local_transport)
+    probe.probe('check', ['b'], lambda host, command : ['bash', '-c', 'echo "No hdfs"'])
+    assert probe.bad_hosts() == ['b']
+
+def test_unknown_check() :
+    with pytest.raises(Exception, match = 'Unknown check') :
+        probe.probe('nope', ['a'], probe.local_transport)
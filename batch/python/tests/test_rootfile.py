@@ -0,0 +1,73 @@
+"""Tests of the ROOT file integrity check on hand-built files in the small (32-bit) format"""
+
+import struct
+
+import pytest
+
+from umn_htcondor import rootfile
+
+# where the records are in our synthetic file
+_begin = 100
+_n_bytes_name = 50
+_keys = (300, 80)
+_free = (400, 40)
+_info = (500, 60)
+_end = 560
+
+def _file(seek_keys = _keys[0], n_bytes_keys = _keys[1], end = _end) :
+    """Build a closed ROOT file with a header, top directory, keys list, free segments, and streamer info"""
+
+    buf = bytearray(_end)
+    struct.pack_into('>4sii', buf, 0, b'root', 62206, _begin)
+    # fEND fSeekFree fNbytesFree nfree fNbytesName fUnits fCompress fSeekInfo fNbytesInfo
+    struct.pack_into('>iiiiiBiii', buf, 12, end, _free[0], _free[1], 1, _n_bytes_name, 4, 101, _info[0], _info[1])
+    # version fDatimeC fDatimeM fNbytesKeys fNbytesName fSeekDir fSeekParent fSeekKeys
+    struct.pack_into('>hIIiiiii', buf, _begin + _n_bytes_name, 5, 0, 0, n_bytes_keys, _n_bytes_name, _begin, 0, seek_keys)
+    # Nbytes Version ObjLen Datime KeyLen Cycle SeekKey SeekPdir of each record, pointing at itself
+    for seek, n_bytes in [_keys, _free, _info] :
+        struct.pack_into('>ihiIhhii', buf, seek, n_bytes, 4, n_bytes, 0, 32, 1, seek, _begin)
+    return bytes(buf)
+
+def _check(buf) :
+    return rootfile._check_buffer(buf, len(buf))
+
+def test_good() :
+    assert _check(_file()) == rootfile.GOOD
+
+def test_truncated_before_end() :
+    buf = _file()
+    assert _check(buf[:_end-10]) == rootfile.TRUNCATED
+
+def test_truncated_inside_keys() :
+    buf = _file()
+    assert _check(buf[:_keys[0]+20]) == rootfile.TRUNCATED
+
+def test_keys_record_past_end() :
+    # the header and file size agree but the keys list runs off the end
+    assert _check(_file(n_bytes_keys = _end)) == rootfile.TRUNCATED
+
+def test_keys_record_misplaced() :
+    assert _check(_file(seek_keys = _free[0])) == rootfile.CORRUPT
+
+def test_not_closed() :
+    assert _check(_file(seek_keys = 0)) == rootfile.NOT_CLOSED
+
+def test_not_root() :
+    assert _check(b'x'*_end) == rootfile.NOT_ROOT
+
+def test_end_before_size() :
+    assert _check(_file() + b'\0'*10) == rootfile.CORRUPT
+
+@pytest.mark.parametrize('cut, expected', [
+    (None, rootfile.GOOD),
+    (0, rootfile.EMPTY),
+    (_end-10, rootfile.TRUNCATED),
+    (_keys[0]+20, rootfile.TRUNCATED),
+    ])
+def test_check_files(tmp_path, cut, expected) :
+    path = tmp_path / 'sample_run_1.root'
+    path.write_bytes(_file()[:cut])
+    assert rootfile.check(str(path)) == expected
+
+def test_check_missing(tmp_path) :
+    assert rootfile.check(str(tmp_path / 'missing.root')) == rootfile.UNREADABLE
@@ -0,0 +1,260 @@
+"""Keeping track of which machines are running our jobs well
+
+For each machine, we keep a score of the jobs that were held with
+each of the exit codes of our run script and a score of the jobs
+that finished successfully. The scores decay exponentially in time,
+so a machine that was broken last week but has since been fixed
+is not avoided forever. The scores are filled from the data we
+already have: the held jobs in the queue and the event logs of the jobs
+(see logs.LogSummary), and are kept in a JSON file in your local directory.
+"""
+
+import os # for path manipulation
+import json # for keeping the scores between sessions
+import time # for decaying the scores
+from umn_htcondor import utility
+from umn_htcondor import manage
+from umn_htcondor import logs
+
+# exit codes of our run script that are counted against the machine the job was on
+#   and how much each counts; a container failure (115) could be the fault of
+#   the job instead of the machine, so it counts less
+code_weights = {
+    99 : 1.,  # hdfs or cvmfs is not mounted on worker node
+    100 : 1., # can't create or enter working directory
+    115 : 0.5, # container failed to run the job
+    117 : 1., # output directory can't be seen from worker node
+    118 : 1., # output file failed to copy
+    }
+
+class HostHealth :
+    """Exponentially decaying scores of held and successful jobs for each machine
+
+    Parameters
+    ----------
+    path : str, optional
+        JSON file to keep the scores in, default is 'host_health.json' in your local directory
+    half_life : float, optional
+        Time in seconds for a score to decay to half of its value, default is one day
+
+    Examples
+    --------
+    >>> health = HostHealth()
+    >>> health.update_from_queue()
+    >>> health.update_from_logs('/hdfs/cms/user/me/ldmx/my-production/detail/logs')
+    >>> health.save()
+    >>> health.print_table()
+    >>> health.recommended_bans()
+    ['scorpion17']
+    """
+
+    def __init__(self, path = None, half_life = 24*3600) :
+        if path is None :
+            path = os.path.join(utility.local_dir(), 'host_health.json')
+        self.path = path
+        self.half_life = half_life
+        # host -> {'time' : when the scores were last decayed, 'good' : score, 'held' : {code : score}}
+        self.hosts = dict()
+        # job id -> [number of holds counted, was its success counted, time of last hold counted, when we last saw it]
+        self.__jobs = dict()
+        if os.path.isfile(path) :
+            with open(path) as f :
+                state = json.load(f)
+            self.hosts = state.get('hosts', dict())
+            self.__jobs = state.get('jobs', dict())
+
+    def save(self) :
+        """Write the scores to their JSON file, replacing the old one in one step
+
+        Jobs we haven't seen for long enough that their scores
+        would have decayed away are forgotten.
+        """
+
+        now = time.time()
+        self.__jobs = { job : seen for job, seen in self.__jobs.items() if now - seen[3] < 10*self.half_life }
+        os.makedirs(os.path.dirname(os.path.realpath(self.path)), exist_ok=True)
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f :
+            json.dump({ 'hosts' : self.hosts, 'jobs' : self.__jobs }, f)
+        os.replace(tmp, self.path)
+
+    def _decayed(self, host, now) :
+        """Get the scores of the input host decayed to the input time"""
+
+        scores = self.hosts.setdefault(host, { 'time' : now, 'good' : 0., 'held' : dict() })
+        factor = 0.5**((now - scores['time'])/self.half_life)
+        if factor != 1. :
+            scores['good'] *= factor
+            scores['held'] = { code : score*factor for code, score in scores['held'].items() }
+            scores['time'] = now
+        return scores
+
+    def record(self, host, code, when = None) :
+        """Record that a job on the input host finished with the input exit code
+
+        Parameters
+        ----------
+        host : str
+            Name of machine without URL (e.g. scorpion3)
+        code : int
+            Exit code of the job, zero for success
+        when : float, optional
+            Time the job finished (default: now)
+        """
+
+        now = time.time()
+        when = now if when is None or when <= 0 else min(when, now)
+        weight = 0.5**((now - when)/self.half_life)
+        scores = self._decayed(host, now)
+        if code == 0 :
+            scores['good'] += weight
+        elif code in code_weights :
+            # json keys are strings
+            scores['held'][str(code)] = scores['held'].get(str(code), 0.) + code_weights[code]*weight
+
+    def _seen(self, job, now) :
+        """Get what we have counted for the input job already"""
+        seen = self.__jobs.setdefault(job, [0, False, 0, now])
+        seen[3] = now
+        return seen
+
+    def update_from_queue(self) :
+        """Count the jobs that are currently held by our run script
+
+        Returns
+        -------
+            int : number of new holds counted
+        """
+
+        now = time.time()
+        n_new = 0
+        held_by_us = utility.job_status_is_held().and_(utility.job_held_by_run_script())
+        for j in manage._my_q(held_by_us,
+                ['ClusterId','ProcId','HoldReasonSubCode','LastRemoteHost','EnteredCurrentStatus']) :
+            if 'LastRemoteHost' not in j :
+                continue
+            seen = self._seen(f'{j["ClusterId"]}.{j["ProcId"]}', now)
+            held_since = j.get('EnteredCurrentStatus', 0)
+            if held_since == seen[2] :
+                continue
+            seen[0] += 1
+            seen[2] = held_since
+            self.record(utility.get_umn_host_name(j['LastRemoteHost']), j.get('HoldReasonSubCode'), held_since)
+            n_new += 1
+        return n_new
+
+    def update_from_logs(self, log_dir, workers = 8) :
+        """Count the holds and successes in the event logs of the input directory
+
+        Each hold by our run script is counted against the host the job was running on
+        when it was held (see logs.hold_list). Other holds (e.g. submitting on hold with
+        a throttle) don't say anything about the host and are not counted.
+        Holds that were already counted from the queue are not counted again.
+
+        Parameters
+        ----------
+        log_dir : str
+            Directory holding the event logs (e.g. '<output-dir>/detail/logs')
+        workers : int, optional
+            Number of processes to read the logs with
+
+        Returns
+        -------
+            int : number of new holds and successes counted
+        """
+
+        now = time.time()
+        n_new = 0
+        summary = logs.LogSummary(log_dir)
+        summary.update(workers)
+        for job in summary.jobs.values() :
+            if not job.host :
+                continue
+            seen = self._seen(f'{job.cluster}.{job.proc}', now)
+            end_time = job.submit_time + max(job.queue_wait, 0) + max(job.wall_time, 0)
+            holds = logs.hold_list(job.holds)
+            for host, code, when in holds[seen[0]:] :
+                if host != '-' :
+                    self.record(host, code, when)
+                    n_new += 1
+            seen[0] = max(seen[0], len(holds))
+            if job.exit_code == 0 and not seen[1] :
+                seen[1] = True
+                self.record(job.host, 0, end_time)
+                n_new += 1
+        return n_new
+
+    def score(self, host) :
+        """Get the decayed scores of the input host
+
+        Returns
+        -------
+            tuple : (score of successful jobs, score of held jobs weighted by exit code)
+        """
+        if host not in self.hosts :
+            return 0., 0.
+        scores = self._decayed(host, time.time())
+        return scores['good'], sum(scores['held'].values())
+
+    def recommended_bans(self, min_held = 3., max_held_fraction = 0.5) :
+        """Get the machines that should be banned
+
+        A machine is banned if enough of its recent jobs were held
+        and the held jobs make up too much of its recent jobs.
+
+        Parameters
+        ----------
+        min_held : float, optional
+            Minimum decayed score of held jobs to ban a machine
+        max_held_fraction : float, optional
+            Ban machines whose held score is more than this fraction of their total score
+
+        Returns
+        -------
+            list[str] : machine names without URL (e.g. scorpion3)
+        """
+
+        bans = []
+        for host in sorted(self.hosts) :
+            good, held = self.score(host)
+            if held >= min_held and held > max_held_fraction*(good + held) :
+                bans.append(host)
+        return bans
+
+    def print_table(self) :
+        """Print the decayed scores of each machine, worst first"""
+
+        codes = sorted(code_weights)
+        print(f'{"HOST":12} {"GOOD":>7} ' + ' '.join(f'{c:>6}' for c in codes))
+        rows = []
+        for host in self.hosts :
+            good, held = self.score(host)
+            rows.append((held/(good + held) if good + held > 0 else 0., host, good))
+        for fraction, host, good in sorted(rows, reverse = True) :
+            held = self.hosts[host]['held']
+            print(f'{host:12} {good:7.1f} ' + ' '.join(f'{held.get(str(c), 0.):6.1f}' for c in codes))
+
+def unhealthy_machines(log_dirs = [], min_held = 3., max_held_fraction = 0.5) :
+    """Update the health of each machine from the queue and the input log directories and get the ones to ban
+
+    Parameters
+    ----------
+    log_dirs : list[str], optional
+        Directories holding event logs of our jobs (e.g. '<output-dir>/detail/logs')
+    min_held : float, optional
+        Minimum decayed score of held jobs to ban a machine
+    max_held_fraction : float, optional
+        Ban machines whose held score is more than this fraction of their total score
+
+    Returns
+    -------
+        list[str] : machine names without URL (e.g. scorpion3)
+    """
+
+    host_health = HostHealth()
+    host_health.update_from_queue()
+    for log_dir in log_dirs :
+        if os.path.isdir(log_dir) :
+            host_health.update_from_logs(log_dir)
+    host_health.save()
+    return host_health.recommended_bans(min_held, max_held_fraction)
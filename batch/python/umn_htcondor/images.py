@@ -0,0 +1,223 @@
+"""Cache of singularity images built from docker images
+
+The images are kept in your local directory named by the digest of the
+docker image they were built from (instead of its tag), so a tag that has
+been moved to a new image is built again while a tag we already have is
+used right away. Each image is built into a temporary file and renamed
+into place once it is complete while holding a lock, so several submissions
+at once only build the image once and never see a half-built image.
+"""
+
+import os # for path manipulation
+import re # for parsing docker tags and authentication challenges
+import json # for reading the token
+import time # for tracking when images were used
+import fcntl # for locking
+import subprocess # for building images
+import urllib.request # for asking the registry for digests
+import urllib.parse # for building the token request
+import urllib.error # for registry errors
+from umn_htcondor import utility
+
+# media types of the manifests we accept from the registry
+_manifest_types = ', '.join([
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.oci.image.manifest.v1+json',
+    ])
+
+def parse_docker_tag(docker_tag) :
+    """Split the input docker tag into the registry, repository, and tag or digest
+
+    >>> parse_docker_tag('ldmx/pro:v2.3.0')
+    ('registry-1.docker.io', 'ldmx/pro', 'v2.3.0')
+    """
+
+    name, reference = docker_tag, 'latest'
+    if '@' in name :
+        name, reference = name.split('@', 1)
+    elif ':' in name.split('/')[-1] :
+        name, reference = name.rsplit(':', 1)
+
+    registry = 'registry-1.docker.io'
+    first = name.split('/')[0]
+    if '/' in name and ('.' in first or ':' in first or first == 'localhost') :
+        registry, name = name.split('/', 1)
+    elif '/' not in name :
+        name = f'library/{name}'
+    return registry, name, reference
+
+def _registry_request(url, timeout, token = None) :
+    """Make a HEAD request for a manifest from the registry"""
+    headers = { 'Accept' : _manifest_types }
+    if token is not None :
+        headers['Authorization'] = f'Bearer {token}'
+    return urllib.request.urlopen(urllib.request.Request(url, headers = headers, method = 'HEAD'), timeout = timeout)
+
+def resolve_digest(docker_tag, timeout = 10) :
+    """Ask the registry for the digest of the image the input tag points to
+
+    We follow the registry's authentication challenge to get an
+    anonymous token if it asks for one, so this works for public images.
+
+    Parameters
+    ----------
+    docker_tag : str
+        Docker image (e.g. 'ldmx/pro:v2.3.0')
+    timeout : float, optional
+        Maximum time in seconds to wait for each request
+
+    Returns
+    -------
+        str : digest of the image (e.g. 'sha256:abc...') or None if the registry couldn't tell us
+    """
+
+    registry, repository, reference = parse_docker_tag(docker_tag)
+    if reference.startswith('sha256:') :
+        return reference
+
+    url = f'https://{registry}/v2/{repository}/manifests/{reference}'
+    try :
+        try :
+            response = _registry_request(url, timeout)
+        except urllib.error.HTTPError as e :
+            challenge = e.headers.get('WWW-Authenticate', '')
+            if e.code != 401 or not challenge.startswith('Bearer ') :
+                return None
+            params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+            realm = params.pop('realm')
+            params.setdefault('scope', f'repository:{repository}:pull')
+            with urllib.request.urlopen(f'{realm}?{urllib.parse.urlencode(params)}', timeout = timeout) as r :
+                auth = json.load(r)
+            response = _registry_request(url, timeout, auth.get('token', auth.get('access_token')))
+        with response :
+            return response.headers.get('Docker-Content-Digest')
+    except (OSError, ValueError, KeyError) :
+        # can't reach the registry
+        return None
+
+class ImageCache :
+    """Singularity images built from docker images, named by their digest
+
+    Parameters
+    ----------
+    path : str, optional
+        Directory to keep the images in, default is 'images' in your local directory
+    max_size : str, optional
+        Images that haven't been used recently are removed once the cache is larger than this
+        (same 'K', 'M', 'G' suffixes as utility.parse_size)
+    keep_for : float, optional
+        Never remove an image that was used in the last this many seconds,
+        since jobs that are still in the queue could be using it (default is one week)
+
+    Examples
+    --------
+    >>> singularity_img = ImageCache().get('ldmx/pro:v2.3.0')
+    """
+
+    def __init__(self, path = None, max_size = '50G', keep_for = 7*24*3600) :
+        if path is None :
+            path = os.path.join(utility.local_dir(), 'images')
+        self.path = utility.full_dir(path)
+        self.max_size = utility.parse_size(max_size)
+        self.keep_for = keep_for
+
+    def _image_path(self, docker_tag, digest) :
+        """Path to the image for the input tag and digest"""
+        if digest is not None :
+            return os.path.join(self.path, digest.replace(':','-')+'.sif')
+        # couldn't resolve the digest, so the best we can do is go by the tag
+        return os.path.join(self.path, 'tag-'+re.sub(r'[^\w.-]', '_', docker_tag)+'.sif')
+
+    def get(self, docker_tag) :
+        """Get the singularity image for the input docker tag, building it if we don't have it yet
+
+        Parameters
+        ----------
+        docker_tag : str
+            Docker image (e.g. 'ldmx/pro:v2.3.0')
+
+        Returns
+        -------
+            str : full path to the singularity image
+        """
+
+        digest = resolve_digest(docker_tag)
+        if digest is None :
+            print(f'Could not find the digest of {docker_tag}, using the image built for this tag if there is one.')
+        image = self._image_path(docker_tag, digest)
+
+        if not os.path.isfile(image) :
+            with open(image+'.lock', 'w') as lock :
+                # wait for anyone else building this image
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if not os.path.isfile(image) :
+                    self._build(docker_tag, digest, image)
+
+        # remember that this image was used recently
+        os.utime(image)
+        self.prune(keep = image)
+        return image
+
+    def _build(self, docker_tag, digest, image) :
+        """Build the image into a temporary file and move it into place when it is done"""
+
+        source = docker_tag
+        if digest is not None :
+            registry, repository, reference = parse_docker_tag(docker_tag)
+            name = repository if registry == 'registry-1.docker.io' else f'{registry}/{repository}'
+            # build exactly the image we resolved, even if the tag moves while we build
+            source = f'{name}@{digest}'
+
+        tmp = f'{image}.{os.getpid()}.tmp'
+        print(f'Building {image} from docker://{source}')
+        try :
+            result = subprocess.run(['singularity', 'build', '--force', tmp, f'docker://{source}'])
+            if result.returncode != 0 :
+                raise Exception(f'Building singularity image from {docker_tag} failed.')
+            os.replace(tmp, image)
+        finally :
+            if os.path.isfile(tmp) :
+                os.remove(tmp)
+
+    def prune(self, keep = None) :
+        """Remove the least recently used images until the cache fits in its maximum size
+
+        Images used in the last keep_for seconds are never removed.
+        The lock file of each image is left in place since other submissions
+        may be holding or waiting on it (see get), removing it would let another
+        submission lock a new file and build the same image at the same time.
+
+        Parameters
+        ----------
+        keep : str, optional
+            Path to an image that should not be removed
+
+        Returns
+        -------
+            list[str] : paths to images that were removed
+        """
+
+        images = []
+        with os.scandir(self.path) as it :
+            for e in it :
+                if e.name.endswith('.sif') :
+                    st = e.stat()
+                    images.append((st.st_mtime, st.st_size, e.path))
+
+        total = sum(size for mtime, size, path in images)
+        removed = []
+        now = time.time()
+        for mtime, size, path in sorted(images) :
+            if total <= self.max_size :
+                break
+            if path == keep or now - mtime < self.keep_for :
+                continue
+            try :
+                os.remove(path)
+                removed.append(path)
+                total -= size
+            except OSError :
+                pass
+        return removed
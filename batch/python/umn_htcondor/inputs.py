@@ -0,0 +1,494 @@
+"""Discovery of input files for batch jobs
+
+Walking large trees on hdfs one entry at a time is slow,
+so we scan directories with os.scandir in a bounded pool of threads
+and stream the files we find back to the caller.
+What we find can be remembered in an InputCatalog so that later
+submissions only need to re-list the directories that have changed.
+"""
+
+import os # for scandir and path manipulation
+import collections # for deque and namedtuple
+import sqlite3 # for the on-disk catalog
+import time # for time stamping scans
+import heapq # for balancing the partitions
+from concurrent.futures import ThreadPoolExecutor # for scanning directories in parallel
+from umn_htcondor import utility
+
+InputFile = collections.namedtuple('InputFile', ['path', 'size', 'mtime', 'events'])
+InputFile.__new__.__defaults__ = (None,)
+InputFile.__doc__ = """A single input file along with its size in bytes, modification time in ns,
+and number of events (None if not known)"""
+
+class InputCatalog :
+    """On-disk catalog of the contents of input directories
+
+    We record the modification time of each directory along with the
+    files, file listings, and sub-directories that were in it when it was scanned.
+    A directory's modification time changes whenever an entry is added to
+    or removed from it, so if the time has not changed, we can re-use what
+    we found last time instead of listing it again.
+
+    Files that are re-written in place do not change the modification time
+    of their directory, so their size may be out of date in the catalog.
+
+    Parameters
+    ----------
+    path : str, optional
+        Path to the SQLite file holding the catalog.
+        Default is 'input_catalog.sqlite' in your local directory.
+
+    Examples
+    --------
+    >>> with InputCatalog() as catalog :
+    ...     files = list(InputDiscovery(catalog = catalog)(['my/sample']))
+    """
+
+    # don't trust a directory listing if it was modified this close
+    #   to when we scanned it (in ns), we could have missed a file
+    #   that landed in the same tick of the clock
+    _safety_margin = 2*10**9
+
+    def __init__(self, path = None) :
+        if path is None :
+            path = os.path.join(utility.local_dir(), 'input_catalog.sqlite')
+        os.makedirs(os.path.dirname(os.path.realpath(path)), exist_ok=True)
+        self.path = path
+        self.__db = sqlite3.connect(path, timeout = 60)
+        self.__db.executescript("""
+            CREATE TABLE IF NOT EXISTS directories (
+                path TEXT PRIMARY KEY, mtime INTEGER, scanned INTEGER, n_skipped INTEGER);
+            CREATE TABLE IF NOT EXISTS entries (
+                dir TEXT, path TEXT, kind INTEGER, size INTEGER, mtime INTEGER);
+            CREATE INDEX IF NOT EXISTS entries_dir ON entries (dir);
+            """)
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, *exc) :
+        self.close()
+
+    def close(self) :
+        """Write any changes to disk and close the catalog"""
+        self.__db.commit()
+        self.__db.close()
+
+    def commit(self) :
+        """Write any changes to disk"""
+        self.__db.commit()
+
+    def known_mtime(self, d) :
+        """Get the modification time of the input directory we can trust
+
+        Returns
+        -------
+            int : modification time in ns or None if we don't have a trustworthy listing
+        """
+
+        row = self.__db.execute('SELECT mtime, scanned FROM directories WHERE path = ?', (d,)).fetchone()
+        if row is None or row[0] > row[1] - InputCatalog._safety_margin :
+            return None
+        return row[0]
+
+    def load(self, d) :
+        """Load what we found in the input directory the last time we scanned it
+
+        Returns
+        -------
+            tuple : (files, file listings, sub directories, number skipped) like _scan_dir
+        """
+
+        files, listings, sub_dirs = [], [], []
+        by_kind = { _FILE : files, _LISTING : listings, _DIRECTORY : sub_dirs }
+        for path, kind, size, mtime in self.__db.execute(
+                'SELECT path, kind, size, mtime FROM entries WHERE dir = ? ORDER BY rowid', (d,)) :
+            by_kind[kind].append(InputFile(path, size, mtime) if kind == _FILE else path)
+        n_skipped, = self.__db.execute('SELECT n_skipped FROM directories WHERE path = ?', (d,)).fetchone()
+        return files, listings, sub_dirs, n_skipped
+
+    def store(self, d, mtime, scanned, files, listings, sub_dirs, n_skipped) :
+        """Replace what we have recorded for the input directory"""
+
+        self.__db.execute('DELETE FROM entries WHERE dir = ?', (d,))
+        self.__db.executemany('INSERT INTO entries VALUES (?,?,?,?,?)',
+            [(d, f.path, _FILE, f.size, f.mtime) for f in files]
+            + [(d, l, _LISTING, None, None) for l in listings]
+            + [(d, s, _DIRECTORY, None, None) for s in sub_dirs])
+        self.__db.execute('INSERT OR REPLACE INTO directories VALUES (?,?,?,?)',
+            (d, mtime, scanned, n_skipped))
+
+class InputDiscovery :
+    """Find the input files within a set of directories, files, or file listings.
+
+    Each directory is listed exactly once using os.scandir so that we
+    can use the file type information returned along with the listing
+    instead of asking the file system about each entry individually.
+    The directories are scanned by a bounded pool of threads while
+    the files are yielded back in a deterministic (breadth-first) order.
+
+    Parameters
+    ----------
+    recursive : bool, optional
+        True if we should recursively search for root and list files in the supplied directories.
+        If False, we take every entry at the top level of the supplied directories.
+    max_workers : int, optional
+        Maximum number of threads to use when scanning directories
+    catalog : InputCatalog, optional
+        Catalog to re-use unchanged directory listings from and record new listings in
+    exclude : iterable[str], optional
+        Full paths to sub-directories that we shouldn't enter when searching recursively
+    follow_listings : bool, optional
+        True to generate the files named in file listings,
+        False to skip the listings like any other file that isn't a ROOT file
+
+    Attributes
+    ----------
+    n_found : int
+        Number of files found so far
+    n_skipped : int
+        Number of entries skipped because they are not ROOT files, directories, or file listings
+        (including entries of file listings that don't exist)
+    n_unreadable : int
+        Number of directories or files that could not be read (no permission, etc...)
+    n_rescanned : int
+        Number of directories that we needed to list
+    n_cached : int
+        Number of directories whose listing was taken from the catalog
+
+    Examples
+    --------
+    >>> discovery = InputDiscovery()
+    >>> for f in discovery(['my/sample']) :
+    ...     print(f.path, f.size)
+    >>> print(discovery.summary())
+    """
+
+    def __init__(self, recursive = True, max_workers = 8, catalog = None, exclude = (), follow_listings = True) :
+        self.recursive = recursive
+        self.max_workers = max(1, max_workers)
+        self.catalog = catalog
+        self.exclude = { os.path.realpath(d) for d in exclude }
+        self.follow_listings = follow_listings
+        self.n_found = 0
+        self.n_skipped = 0
+        self.n_unreadable = 0
+        self.n_rescanned = 0
+        self.n_cached = 0
+
+    def summary(self) :
+        """Get a one-line summary of what was found."""
+        return (f'Found {self.n_found} input files ({self.n_skipped} entries skipped, {self.n_unreadable} unreadable) '
+                f'listing {self.n_rescanned} directories and re-using {self.n_cached} from the catalog.')
+
+    def __call__(self, inputs) :
+        """Generate the full paths to the input files
+
+        Parameters
+        ----------
+        inputs : str or list[str]
+            Input directories, files, or file listings.
+            Directory paths that are not absolute are assumed to be relative to your hdfs directory.
+
+        Returns
+        -------
+            generator[InputFile] : full path, size, and modification time of each input file
+
+        Raises
+        ------
+        Exception
+            If one of the inputs doesn't exist, before any files are generated
+        """
+
+        if isinstance(inputs, str) :
+            inputs = [inputs]
+
+        for entry in inputs :
+            if not os.path.exists(entry) :
+                utility.check_exists(utility.resolve_path(entry))
+
+        try :
+            with ThreadPoolExecutor(max_workers = self.max_workers) as pool :
+                for entry in inputs :
+                    for f in self._walk_input(entry, pool) :
+                        self.n_found += 1
+                        yield f
+        finally :
+            if self.catalog is not None :
+                self.catalog.commit()
+
+    def _walk_input(self, file_or_dir, pool) :
+        """Generate the files from a single input entry"""
+
+        if file_or_dir.endswith('.root') and os.path.isfile(file_or_dir) :
+            full_path = os.path.realpath(file_or_dir)
+            st = os.stat(full_path)
+            yield InputFile(full_path, st.st_size, st.st_mtime_ns)
+        elif file_or_dir.endswith('.list') and os.path.isfile(file_or_dir) :
+            if self.follow_listings :
+                yield from self._walk_listing(file_or_dir, pool)
+            else :
+                self.n_skipped += 1
+        else :
+            d = utility.resolve_path(file_or_dir)
+            if not os.path.isdir(d) :
+                self.n_skipped += 1
+            elif self.recursive :
+                yield from self._walk_tree(d, pool)
+            else :
+                yield from self._flat_listing(d)
+
+    def _walk_listing(self, listing_path, pool) :
+        """Generate the files named in a file listing
+
+        Each line of the listing is one entry. ROOT files can optionally be
+        followed by the number of events in them, for example
+
+            /hdfs/cms/user/me/ldmx/sample/my_file_run_1.root 10000
+
+        If the entry with a number of events is a directory (or another listing),
+        the events are split across the files in it in proportion to their size.
+        """
+
+        try :
+            with open(listing_path) as listing :
+                entries = [l.split() for l in listing]
+        except OSError :
+            self.n_unreadable += 1
+            return
+
+        for entry in entries :
+            if len(entry) == 2 and entry[1].isdigit() :
+                yield from _split_events(list(self._walk_input(entry[0], pool)), int(entry[1]))
+            elif entry :
+                yield from self._walk_input(' '.join(entry), pool)
+
+    def _flat_listing(self, d) :
+        """Generate every entry in the input directory without entering any sub-directories"""
+
+        try :
+            with os.scandir(d) as it :
+                entries = [e for e in it]
+        except OSError :
+            self.n_unreadable += 1
+            return
+
+        for e in sorted(entries, key = lambda e : e.name) :
+            try :
+                st = e.stat()
+            except OSError :
+                self.n_unreadable += 1
+                continue
+            yield InputFile(os.path.realpath(e.path) if e.is_symlink() else e.path, st.st_size, st.st_mtime_ns)
+
+    def _walk_tree(self, top, pool) :
+        """Generate the files in the input directory tree
+
+        We keep at most twice as many directory scans in flight as we have threads,
+        and we consume the scans in the order they were submitted so that the
+        files are generated in the same order from one call to the next.
+        The catalog is only touched from this (the calling) thread.
+        """
+
+        to_scan = collections.deque([top])
+        in_flight = collections.deque()
+        while to_scan or in_flight :
+            while to_scan and len(in_flight) < 2*self.max_workers :
+                d = to_scan.popleft()
+                known_mtime = None if self.catalog is None else self.catalog.known_mtime(d)
+                in_flight.append((d, pool.submit(_scan_dir, d, known_mtime)))
+
+            d, scan = in_flight.popleft()
+            mtime, scanned, listing = scan.result()
+            if listing is None :
+                self.n_cached += 1
+                files, listings, sub_dirs, n_skipped = self.catalog.load(d)
+                n_unreadable = 0
+            else :
+                self.n_rescanned += 1
+                files, listings, sub_dirs, n_skipped, n_unreadable = listing
+                if self.catalog is not None and mtime is not None and n_unreadable == 0 :
+                    self.catalog.store(d, mtime, scanned, files, listings, sub_dirs, n_skipped)
+
+            self.n_skipped += n_skipped
+            self.n_unreadable += n_unreadable
+            yield from files
+            if self.follow_listings :
+                for listing in listings :
+                    yield from self._walk_listing(listing, pool)
+            else :
+                self.n_skipped += len(listings)
+            to_scan.extend(sd for sd in sub_dirs if sd not in self.exclude)
+
+def _split_events(files, n_events) :
+    """Split the input number of events across the input files in proportion to their size
+
+    The counts are rounded so that they add up to n_events.
+    Files without any size share the events evenly.
+    """
+
+    total = sum(f.size for f in files)
+    split = []
+    before, so_far = 0, 0
+    for i, f in enumerate(files) :
+        so_far += f.size if total > 0 else 1
+        upto = n_events*so_far // (total if total > 0 else len(files))
+        split.append(f._replace(events = upto - before))
+        before = upto
+    return split
+
+# kinds of entries stored in the catalog
+_FILE, _LISTING, _DIRECTORY = 0, 1, 2
+
+def _scan_dir(d, known_mtime = None) :
+    """List a single directory, sorting its entries into what we care about
+
+    This is run inside of the worker threads, so it should not touch
+    any of the state of the InputDiscovery.
+
+    Parameters
+    ----------
+    d : str
+        Full path to directory to scan
+    known_mtime : int, optional
+        Modification time (in ns) of the listing we already have,
+        we skip listing the directory if it hasn't been modified since then.
+
+    Returns
+    -------
+        tuple : (modification time, time of scan, listing) where the listing is
+        None if the directory was not modified or
+        (root files, file listings, sub directories, number skipped, number unreadable)
+    """
+
+    scanned = int(time.time()*1e9)
+    files, listings, sub_dirs = [], [], []
+    n_skipped, n_unreadable = 0, 0
+    try :
+        mtime = os.stat(d).st_mtime_ns
+        if mtime == known_mtime :
+            return mtime, scanned, None
+        with os.scandir(d) as it :
+            entries = sorted(it, key = lambda e : e.name)
+    except OSError :
+        return None, scanned, (files, listings, sub_dirs, n_skipped, 1)
+
+    for e in entries :
+        try :
+            path = os.path.realpath(e.path) if e.is_symlink() else e.path
+            if e.is_dir() :
+                sub_dirs.append(path)
+            elif e.name.endswith('.root') and e.is_file() :
+                st = e.stat()
+                files.append(InputFile(path, st.st_size, st.st_mtime_ns))
+            elif e.name.endswith('.list') and e.is_file() :
+                listings.append(path)
+            else :
+                n_skipped += 1
+        except OSError :
+            n_unreadable += 1
+    #loop over directory entries
+
+    return mtime, scanned, (files, listings, sub_dirs, n_skipped, n_unreadable)
+
+def partition_by_count(files, n) :
+    """Partition the stream of input files into groups of (at most) n files
+
+    Parameters
+    ----------
+    files : iterable[InputFile]
+        Files to partition
+    n : int
+        Maximum number of files in each group
+
+    Returns
+    -------
+        generator[list[InputFile]] : groups of files in the order they were given
+    """
+
+    group = []
+    for f in files :
+        group.append(f)
+        if len(group) == n :
+            yield group
+            group = []
+    if group :
+        yield group
+
+def partition_by_weight(files, target, weight) :
+    """Partition the input files into groups with balanced total weights
+
+    We choose the number of groups so that the average weight of a group
+    is at most target and then assign the heaviest remaining file to the
+    lightest group (longest-processing-time first). This keeps the heaviest
+    group close to the average, so the slowest job in a cluster isn't
+    much slower than the rest.
+
+    Parameters
+    ----------
+    files : iterable[InputFile]
+        Files to partition
+    target : float
+        Target total weight of each group, must be positive
+    weight : callable
+        Function giving the weight of an InputFile
+
+    Returns
+    -------
+        list[list[InputFile]] : groups of files, each sorted by path
+    """
+
+    if target <= 0 :
+        raise Exception(f'Target weight of each group must be positive, not {target}.')
+
+    weighted = sorted(((weight(f), f) for f in files), key = lambda wf : wf[0], reverse = True)
+    if len(weighted) == 0 :
+        return []
+
+    total = sum(w for w, f in weighted)
+    n_groups = min(len(weighted), max(1, int(-(-total // target))))
+    groups = [[] for i in range(n_groups)]
+    # heap of (total weight, group index) so the lightest group is on top
+    lightest = [(0, i) for i in range(n_groups)]
+    for w, f in weighted :
+        group_weight, i = heapq.heappop(lightest)
+        groups[i].append(f)
+        heapq.heappush(lightest, (group_weight + w, i))
+
+    for g in groups :
+        g.sort(key = lambda f : f.path)
+    return groups
+
+def events_estimator(files) :
+    """Get a function estimating the number of events in an input file
+
+    Files that came with an event count (from a file listing) use that count,
+    the others are estimated from their size using the average number
+    of bytes per event of the files with a count.
+
+    Parameters
+    ----------
+    files : list[InputFile]
+        Full list of files that will be estimated
+
+    Returns
+    -------
+        callable : function giving the number of events for an InputFile,
+        or None if none of the files have a known number of events
+    """
+
+    known_bytes, known_events = 0, 0
+    for f in files :
+        if f.events is not None :
+            known_bytes += f.size
+            known_events += f.events
+
+    if known_events == 0 :
+        return None
+
+    bytes_per_event = known_bytes / known_events
+    def estimate(f) :
+        if f.events is not None :
+            return f.events
+        return f.size / bytes_per_event if bytes_per_event > 0 else 0
+    return estimate
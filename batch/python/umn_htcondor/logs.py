@@ -0,0 +1,405 @@
+"""Reading the condor event logs written by our jobs
+
+Each job writes its own condor event log '<cluster>_<proc>.log'
+into the logs directory inside of the detail directory.
+
+    python3 -m umn_htcondor.logs <log-directory> [--summary <file>] [--workers <number>]
+"""
+
+import htcondor #HTCondor Python API
+import os #for scanning the log directory
+import re #for pulling the host name out of the execute event
+import csv #for writing the summary
+import pickle #for saving where we are in the logs we follow
+import argparse #for the command line
+import collections #for namedtuple
+from concurrent.futures import ProcessPoolExecutor #for reading logs in parallel
+from umn_htcondor import utility
+
+# the status a job is in after each type of event
+#   events not listed here don't change the status of the job
+_status_after = {
+    htcondor.JobEventType.SUBMIT : htcondor.JobStatus.IDLE,
+    htcondor.JobEventType.EXECUTE : htcondor.JobStatus.RUNNING,
+    htcondor.JobEventType.JOB_EVICTED : htcondor.JobStatus.IDLE,
+    htcondor.JobEventType.SHADOW_EXCEPTION : htcondor.JobStatus.IDLE,
+    htcondor.JobEventType.JOB_RECONNECT_FAILED : htcondor.JobStatus.IDLE,
+    htcondor.JobEventType.JOB_HELD : htcondor.JobStatus.HELD,
+    htcondor.JobEventType.JOB_RELEASED : htcondor.JobStatus.IDLE,
+    htcondor.JobEventType.JOB_TERMINATED : htcondor.JobStatus.COMPLETED,
+    htcondor.JobEventType.JOB_ABORTED : htcondor.JobStatus.REMOVED,
+    }
+
+class EventLogWatcher :
+    """Keep running counts of idle, running, and held jobs from their event logs
+
+    We follow each job's event log, only reading the parts that
+    were written since we last looked, and update the status
+    of the job with each new event. Nothing is asked of the schedd.
+
+    We don't keep the logs open between updates since there is one for
+    each job. After reading a log we save where we stopped (a JobEventLog
+    can be pickled and picks up at the same place when unpickled) and close it,
+    so it is only opened again once its size changes.
+    Logs of jobs that have finished (completed or removed) are not looked at again,
+    and the log directory is only re-listed when its modification time changes.
+
+    Parameters
+    ----------
+    log_dir : str
+        Directory holding the event logs (e.g. '<output-dir>/detail/logs')
+    clusters : list[int], optional
+        Only follow the jobs in these clusters (default: all logs in the directory)
+
+    Examples
+    --------
+    >>> watcher = EventLogWatcher('/hdfs/cms/user/me/ldmx/my-production/detail/logs')
+    >>> watcher.update()
+    >>> [idle, run, held] = watcher.totals()
+    """
+
+    def __init__(self, log_dir, clusters = None) :
+        self.log_dir = log_dir
+        self.__prefixes = None if clusters is None else tuple(f'{c}_' for c in clusters)
+        self.__dir_mtime = None
+        # path -> [pickled JobEventLog, size of file when we last read it]
+        self.__following = dict()
+        # paths of logs for jobs that are done
+        self.__finished = set()
+        # (cluster, proc) -> status
+        self.__status = dict()
+        self.__counts = {
+            htcondor.JobStatus.IDLE : 0,
+            htcondor.JobStatus.RUNNING : 0,
+            htcondor.JobStatus.HELD : 0
+            }
+
+    def totals(self) :
+        """Get the current counts
+
+        Returns
+        -------
+            list[int] : counts in form [IDLE, RUNNING, HELD]
+        """
+        return [self.__counts[htcondor.JobStatus.IDLE],
+                self.__counts[htcondor.JobStatus.RUNNING],
+                self.__counts[htcondor.JobStatus.HELD]]
+
+    def _find_new_logs(self) :
+        """Start following any logs that have appeared in the log directory"""
+
+        try :
+            mtime = os.stat(self.log_dir).st_mtime_ns
+        except OSError :
+            return
+        if mtime == self.__dir_mtime :
+            return
+        self.__dir_mtime = mtime
+
+        with os.scandir(self.log_dir) as it :
+            for e in it :
+                if not e.name.endswith('.log') :
+                    continue
+                if self.__prefixes is not None and not e.name.startswith(self.__prefixes) :
+                    continue
+                if e.path in self.__following or e.path in self.__finished :
+                    continue
+                self.__following[e.path] = [None, -1]
+
+    def _transition(self, job, status) :
+        """Move the input job into the input status, keeping the counts up to date"""
+
+        old_status = self.__status.get(job)
+        if old_status == status :
+            return
+        if old_status in self.__counts :
+            self.__counts[old_status] -= 1
+        if status in self.__counts :
+            self.__counts[status] += 1
+        self.__status[job] = status
+
+    def update(self) :
+        """Read any new events from the logs we are following
+
+        Returns
+        -------
+            int : number of new events that changed the status of a job
+        """
+
+        self._find_new_logs()
+
+        n_changes = 0
+        for path in list(self.__following) :
+            log = self.__following[path]
+            try :
+                size = os.stat(path).st_size
+            except OSError :
+                continue
+            if size == log[1] :
+                continue
+            log[1] = size
+
+            event_log = htcondor.JobEventLog(path) if log[0] is None else pickle.loads(log[0])
+            done = False
+            try :
+                for event in event_log.events(stop_after = 0) :
+                    if event.type not in _status_after :
+                        continue
+                    status = _status_after[event.type]
+                    self._transition((event.cluster, event.proc), status)
+                    n_changes += 1
+                    done = status in [htcondor.JobStatus.COMPLETED, htcondor.JobStatus.REMOVED]
+                log[0] = pickle.dumps(event_log)
+            finally :
+                event_log.close()
+
+            if done :
+                del self.__following[path]
+                self.__finished.add(path)
+        #end loop over logs
+
+        return n_changes
+
+# columns of the log summary and their numpy types
+#   times are in seconds, memory is in MB, and disk is in KB
+#   the log name, size, and modification time identify which version of the log was summarized
+_summary_columns = [
+    ('log', 'U32'),
+    ('log_size', 'i8'),
+    ('log_mtime', 'i8'),
+    ('cluster', 'i8'),
+    ('proc', 'i8'),
+    ('submit_time', 'i8'),
+    ('queue_wait', 'i8'),
+    ('wall_time', 'i8'),
+    ('peak_memory', 'i8'),
+    ('peak_disk', 'i8'),
+    ('exit_code', 'i8'),
+    ('hold_code', 'i8'),
+    ('n_holds', 'i8'),
+    ('n_starts', 'i8'),
+    ('host', 'U32'),
+    ('holds', 'U512'),
+    ]
+
+JobSummary = collections.namedtuple('JobSummary', [name for name, dtype in _summary_columns])
+JobSummary.__doc__ = """Summary of a single job's event log, values that are not known are -1 (or '' for the host)
+
+The holds are the holds by our run script (hold code 3) as space-separated
+'<host>/<exit code>/<time>' entries in the order they happened (see hold_list)."""
+
+def hold_list(holds) :
+    """Get the holds by our run script from the holds column of a JobSummary
+
+    Returns
+    -------
+        list[tuple] : (host, exit code, time of hold) of each hold in the order they happened
+    """
+
+    result = []
+    for entry in holds.split() :
+        host, code, when = entry.rsplit('/', 2)
+        result.append((host, int(code), int(when)))
+    return result
+
+_alias = re.compile(r'alias=([^&>]+)')
+
+def _host_of(event) :
+    """Get the short name of the machine the input execute event happened on"""
+
+    m = _alias.search(event.get('ExecuteHost', ''))
+    if m is not None :
+        return utility.short_machine_name(m.group(1))
+    slot = event.get('SlotName', '')
+    if '@' in slot :
+        return utility.short_machine_name(slot.split('@')[1])
+    return event.get('ExecuteHost', '').strip('<>').split(':')[0]
+
+def _summarize_log(entry) :
+    """Summarize the events in a single job's event log
+
+    This is run within the worker processes of LogSummary.update,
+    so it must stay at the top level of this module.
+
+    Parameters
+    ----------
+    entry : tuple
+        (path, size, mtime) of the log to summarize
+
+    Returns
+    -------
+        JobSummary : summary of the job or None if the log could not be read
+    """
+
+    path, size, mtime = entry
+    cluster, proc = -1, -1
+    submit_time, first_start, last_start, end_time = -1, -1, -1, -1
+    peak_memory, peak_disk = -1, -1
+    exit_code, hold_code, n_holds, n_starts = -1, -1, 0, 0
+    host = ''
+    holds = []
+    try :
+        for event in htcondor.JobEventLog(path).events(stop_after = 0) :
+            cluster, proc = event.cluster, event.proc
+            if event.type == htcondor.JobEventType.SUBMIT :
+                submit_time = event.timestamp
+            elif event.type == htcondor.JobEventType.EXECUTE :
+                last_start = event.timestamp
+                if first_start < 0 :
+                    first_start = last_start
+                n_starts += 1
+                host = _host_of(event)
+            elif event.type in [htcondor.JobEventType.IMAGE_SIZE, htcondor.JobEventType.JOB_TERMINATED] :
+                peak_memory = max(peak_memory, event.get('MemoryUsage', -1))
+                peak_disk = max(peak_disk, event.get('DiskUsage', -1))
+                if event.type == htcondor.JobEventType.JOB_TERMINATED :
+                    end_time = event.timestamp
+                    if event.get('TerminatedNormally', False) :
+                        exit_code = event.get('ReturnValue', -1)
+            elif event.type == htcondor.JobEventType.JOB_HELD :
+                n_holds += 1
+                # our run script exits with a code that is stored as the sub code of a hold with code 3
+                hold_code = event.get('HoldReasonCode', -1)
+                if hold_code == 3 :
+                    hold_code = event.get('HoldReasonSubCode', hold_code)
+                    # the hold is charged to the host the job was running on at the time
+                    holds.append(f'{host or "-"}/{hold_code}/{event.timestamp}')
+            elif event.type == htcondor.JobEventType.JOB_ABORTED :
+                end_time = event.timestamp
+    except Exception :
+        # condor couldn't parse the log
+        return None
+
+    return JobSummary(os.path.basename(path), size, mtime, cluster, proc, submit_time,
+        first_start - submit_time if first_start >= 0 and submit_time >= 0 else -1,
+        end_time - last_start if end_time >= 0 and last_start >= 0 else -1,
+        peak_memory, peak_disk, exit_code, hold_code, n_holds, n_starts, host, ' '.join(holds))
+
+def _read_summary(path) :
+    """Read the jobs in a log summary CSV file
+
+    Returns
+    -------
+        list[JobSummary] : jobs in the summary, empty if it was written by a different version of this module
+    """
+
+    with open(path, newline = '') as f :
+        reader = csv.reader(f)
+        if next(reader, None) != list(JobSummary._fields) :
+            return []
+        return [JobSummary(row[0], *(int(v) for v in row[1:-2]), row[-2], row[-1]) for row in reader]
+
+class LogSummary :
+    """One row per job summarizing its event log, kept up to date as the jobs run
+
+    The summary is stored as a CSV file so that it can be read without
+    this module (e.g. by pandas) and loaded as a numpy structured array with
+    array. Logs that haven't changed since they were last summarized are not
+    read again, the others are read in a pool of processes. Jobs whose logs
+    have since been removed (e.g. by archive-logs) are kept in the summary.
+
+    Parameters
+    ----------
+    log_dir : str
+        Directory holding the event logs (e.g. '<output-dir>/detail/logs')
+    path : str, optional
+        CSV file to keep the summary in, default is 'log_summary.csv' next to the log directory
+
+    Examples
+    --------
+    >>> summary = LogSummary('/hdfs/cms/user/me/ldmx/my-production/detail/logs')
+    >>> summary.update()
+    >>> jobs = summary.array()
+    >>> jobs['wall_time'][jobs['exit_code'] == 0].mean()
+    """
+
+    def __init__(self, log_dir, path = None) :
+        self.log_dir = log_dir
+        if path is None :
+            path = os.path.join(os.path.dirname(os.path.realpath(log_dir)), 'log_summary.csv')
+        self.path = path
+        # log name -> JobSummary
+        self.jobs = dict()
+        if os.path.isfile(path) :
+            for job in _read_summary(path) :
+                self.jobs[job.log] = job
+
+    def write(self) :
+        """Write the summary to its CSV file, replacing the old one in one step"""
+
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w', newline = '') as f :
+            writer = csv.writer(f)
+            writer.writerow(JobSummary._fields)
+            writer.writerows(sorted(self.jobs.values(), key = lambda j : (j.cluster, j.proc, j.log)))
+        os.replace(tmp, self.path)
+
+    def update(self, workers = 8) :
+        """Summarize the logs that are new or have changed and write the summary
+
+        Parameters
+        ----------
+        workers : int, optional
+            Number of processes to read the logs with
+
+        Returns
+        -------
+            int : number of logs that were (re-)summarized
+        """
+
+        to_read = []
+        with os.scandir(self.log_dir) as it :
+            for e in it :
+                if not e.name.endswith('.log') :
+                    continue
+                st = e.stat()
+                job = self.jobs.get(e.name)
+                if job is None or job.log_size != st.st_size or job.log_mtime != st.st_mtime_ns :
+                    to_read.append((e.path, st.st_size, st.st_mtime_ns))
+
+        n_read = 0
+        if len(to_read) > 0 :
+            with ProcessPoolExecutor(max_workers = max(1, workers)) as pool :
+                for job in pool.map(_summarize_log, to_read, chunksize = 64) :
+                    if job is not None :
+                        self.jobs[job.log] = job
+                        n_read += 1
+
+        self.write()
+        return n_read
+
+    def array(self) :
+        """Get the summary as a numpy structured array with one entry per job
+
+        Returns
+        -------
+            numpy.ndarray : array with a field for each column of the summary
+        """
+        import numpy
+        return numpy.array([tuple(j) for j in self.jobs.values()], dtype = _summary_columns)
+
+def load_summary(path) :
+    """Load a log summary CSV file as a numpy structured array without reading any logs
+
+    Parameters
+    ----------
+    path : str
+        CSV file written by LogSummary
+
+    Returns
+    -------
+        numpy.ndarray : array with a field for each column of the summary
+    """
+    import numpy
+    return numpy.array([tuple(j) for j in _read_summary(path)], dtype = _summary_columns)
+
+if __name__ == '__main__' :
+    parser = argparse.ArgumentParser('logs', description='Summarize the condor event logs of our jobs into a CSV file.')
+    parser.add_argument('log_dir',type=str,help='Directory holding the event logs.')
+    parser.add_argument('--summary',type=str,help='CSV file to write the summary to. Default is log_summary.csv next to the log directory.')
+    parser.add_argument('--workers',type=int,default=8,help='Number of processes to read the logs with.')
+    arg = parser.parse_args()
+
+    summary = LogSummary(arg.log_dir, arg.summary)
+    n_read = summary.update(arg.workers)
+    print(f'Summarized {n_read} logs, {len(summary.jobs)} jobs in {summary.path}')
@@ -8,26 +8,122 @@ import sys #for sys.stdout
 import time #for sleep
 import glob #iterating through directory
 
-def _my_q(extra_filters = True) :
+# Maximum age in seconds of a query result that can be re-used.
+#   Set this to zero to always ask the schedd.
+q_cache_ttl = 5
+
+# constraint -> list of (time, projection, list of jobs)
+_q_cache = dict()
+
+def _clear_q_cache() :
+    """Forget all of the query results, we call this after changing any jobs"""
+    _q_cache.clear()
+
+def _cached_query(constraint, projection, max_age = None) :
+    """Query the schedd for the jobs matching the input constraint,
+    re-using a recent query result if we have one.
+
+    A result can be re-used if it was made with the same constraint
+    and its projection includes all of the attributes we are asking for.
+
+    Parameters
+    ----------
+    constraint : classad.ExprTree
+        Constraint the jobs must match
+    projection : list[str]
+        Attributes of the jobs to get, empty means all of them
+    max_age : float, optional
+        Maximum age of a result to re-use in seconds (default: q_cache_ttl)
+
+    Returns
+    -------
+        list[classad.ClassAd] : jobs matching the constraint
+    """
+
+    if max_age is None :
+        max_age = q_cache_ttl
+
+    key = str(constraint)
+    now = time.time()
+    want = set(projection)
+    results = [r for r in _q_cache.get(key, []) if now - r[0] < max_age]
+    for when, have, jobs in results :
+        if not have or (want and want <= have) :
+            return jobs
+
+    jobs = list(htcondor.Schedd().xquery(constraint, projection))
+    if max_age > 0 :
+        results.append((now, want, jobs))
+        _q_cache[key] = results
+    return jobs
+
+def _my_q(extra_filters = True, projection = [], max_age = None) :
     """Get the queue for the current user
 
     This is meant to be an internal function,
     and returns an iterator that can be used
-    in loops. This is the suggested method when potentially
-    looking through long lists of jobs or a list of jobs
-    that has large descriptions.
+    in loops.
+
+    Only the attributes in the projection are retrieved from the schedd,
+    which is much faster than getting the full description of each job.
+    The jobs are remembered for a short time (q_cache_ttl) so that several
+    calls made one after another can share a single query.
 
     Parameters
     ----------
     extra_filters : classad.ExprTree, optional
         Any extra filters to not list when querying the batch system
+    projection : list[str], optional
+        Attributes of the jobs to get, default (empty) is all of them
+    max_age : float, optional
+        Maximum age in seconds of a remembered query to use (default: q_cache_ttl)
 
     Returns
     -------
-        QueryIterator : Iterator to loop through list of jobs passing filters
+        iterator : Iterator to loop through list of jobs passing filters
     """
-    schedd = htcondor.Schedd()
-    return schedd.xquery(utility.job_is_mine().and_(extra_filters))
+    return iter(_cached_query(utility.job_is_mine().and_(extra_filters), projection, max_age))
+
+def _my_totals(extra_filters = True) :
+    """Get the number of the current user's jobs that are idle, running, and held
+
+    We ask the schedd to do the counting for us using a summary-only query
+    and only count the jobs ourselves if the schedd doesn't give us the summary.
+
+    Returns
+    -------
+        list[int] : counts in form [IDLE, RUNNING, HELD]
+    """
+
+    constraint = utility.job_is_mine().and_(extra_filters)
+    key = 'totals:'+str(constraint)
+    now = time.time()
+    if key in _q_cache and now - _q_cache[key][0] < q_cache_ttl :
+        return list(_q_cache[key][1])
+
+    tots = None
+    try :
+        for summary in htcondor.Schedd().query(str(constraint), [], opts = htcondor.QueryOpts.SummaryOnly) :
+            if 'Idle' in summary and 'Running' in summary and 'Held' in summary :
+                tots = [summary['Idle'], summary['Running'], summary['Held']]
+    except (AttributeError, TypeError, RuntimeError) :
+        # this version of condor can't give us a summary
+        tots = None
+
+    if tots is None :
+        tots = [0,0,0]
+        for j in _my_q(extra_filters, ['JobStatus']) :
+            if j['JobStatus'] == htcondor.JobStatus.IDLE :
+                tots[0] += 1
+            elif j['JobStatus'] == htcondor.JobStatus.RUNNING :
+                tots[1]  += 1
+            elif j['JobStatus'] == htcondor.JobStatus.HELD :
+                tots[2] += 1
+        #end loop over queue
+
+    if q_cache_ttl > 0 :
+        _q_cache[key] = (now, list(tots))
+    return tots
 
 def _my_act(action, constraint) :
     """Perform a action on a set of jobs that are owned by the current user
@@ -45,21 +141,31 @@ def _my_act(action, constraint) :
     """
 
     schedd = htcondor.Schedd()
+    _clear_q_cache()
     return schedd.act(action, utility.job_is_mine().and_(constraint), 
         reason=f'{getpass.getuser()} asked me to.')
 
 def ban_machine(broken_machine) :
-    """Ban a machine from being used to run your jobs.
+    """Ban a machine from being used to run your idle and held jobs.
 
-    We assume that there is already at least one
-    requirement for all of the jobs. This is a fine
-    assumption since all of our jobs have the requirements
-    to avoid using the zebras.
+    The machine is added to the set of banned machines written by
+    JobInstructions, rewriting that term of the jobs' requirements in place
+    (see utility.add_banned_machine), so the requirements stay flat
+    however many machines are banned.
+
+    Instead of editing each job individually, we group the jobs by
+    their current requirements and do one edit for each group
+    (usually one group per cluster) all within a single transaction.
+    Jobs that are running or already ban the machine are left alone.
 
     Parameters
     ----------
     broken_machine : str
         Name of machine to ban without URL (e.g. scorpion3)
+
+    Returns
+    -------
+        int : number of jobs that were edited
     
     Examples
     --------
@@ -67,15 +173,74 @@ def ban_machine(broken_machine) :
     >>> manage.ban_machine('scorpion43')
     """
 
-    # need to edit each job individually because they might
-    #   have different requirements
+    not_running = (classad.Attribute('JobStatus') == htcondor.JobStatus.IDLE).or_(utility.job_status_is_held())
+
+    # requirements -> { cluster : [procs] }
+    groups = dict()
+    # cluster -> set of requirements its jobs have
+    #   including the jobs we skip, so that selecting a whole cluster doesn't edit them
+    cluster_groups = dict()
+    for j in _my_q(not_running, ['ClusterId','ProcId','Requirements'], max_age = 0) :
+        requirements = str(j['Requirements'])
+        cluster_groups.setdefault(j['ClusterId'], set()).add(requirements)
+        if utility.bans_machine(requirements, broken_machine) :
+            continue
+        groups.setdefault(requirements, dict()).setdefault(j['ClusterId'], []).append(j['ProcId'])
+    #end loop over queue
+
+    if len(groups) == 0 :
+        return 0
+
+    n_jobs = 0
     schedd = htcondor.Schedd()
-    for j in _my_q() :
-        edit_result = schedd.edit(
-            f'{j["ClusterId"]}.{j["ProcId"]}',
-            'requirements',
-            classad.ExprTree(j["requirements"]).and_(utility.dont_use_machine(broken_machine))
-            )
+    _clear_q_cache()
+    with schedd.transaction() :
+        for requirements, clusters in groups.items() :
+            selections = []
+            for cluster, procs in clusters.items() :
+                n_jobs += len(procs)
+                if len(cluster_groups[cluster]) == 1 :
+                    # all of the idle/held jobs in this cluster are in this group
+                    selections.append(f'(ClusterId == {cluster})')
+                else :
+                    proc_list = ','.join(str(p) for p in procs)
+                    selections.append(f'(ClusterId == {cluster} && member(ProcId, {{{proc_list}}}))')
+            constraint = utility.job_is_mine().and_(not_running).and_(classad.ExprTree(' || '.join(selections)))
+            schedd.edit(str(constraint), 'Requirements',
+                utility.add_banned_machine(requirements, broken_machine))
+    #end of transaction
+
+    return n_jobs
+
+def ban_unhealthy_machines(log_dirs = [], min_held = 3., max_held_fraction = 0.5) :
+    """Ban the machines that have recently been holding too many of our jobs from your idle and held jobs.
+
+    The health of each machine is updated from the jobs held in the queue
+    and the event logs in the input directories before choosing which to ban.
+
+    Parameters
+    ----------
+    log_dirs : list[str], optional
+        Directories holding event logs of our jobs (e.g. '<output-dir>/detail/logs')
+    min_held : float, optional
+        Minimum decayed score of held jobs to ban a machine
+    max_held_fraction : float, optional
+        Ban machines whose held score is more than this fraction of their total score
+
+    Returns
+    -------
+        list[str] : machines that were banned
+
+    See Also
+    --------
+    health.unhealthy_machines : how the machines to ban are chosen
+    """
+
+    from umn_htcondor import health
+    bans = health.unhealthy_machines(log_dirs, min_held, max_held_fraction)
+    for m in bans :
+        ban_machine(m)
+    return bans
 
 def translate_job_status_enum(s) :
     """Translate status enum to human-readable status
@@ -129,11 +294,12 @@ def print_q(extra_filters = True, o = sys.stdout) :
     """
 
     o.write(f'Cluster.Proc : St : HH:MM:SS : Input\n')
-    for j in _my_q(extra_filters) :
+    for j in _my_q(extra_filters, ['ClusterId','ProcId','JobStatus','EnteredCurrentStatus','ServerTime','Args']) :
         job_status = translate_job_status_enum(j['JobStatus'])
 
         if 'EnteredCurrentStatus' in j :
-            run_time = j['ServerTime'] - j['EnteredCurrentStatus'] #in s
+            server_time = j['ServerTime'] if 'ServerTime' in j else int(time.time())
+            run_time = server_time - j['EnteredCurrentStatus'] #in s
             hours = run_time // 3600
             run_time %= 3600
             minutes = run_time // 60
@@ -160,34 +326,50 @@ def get_q_totals() :
     --------
     >>> [idle, run, held] = manage.get_q_totals()
     """
-    
-    tots = [0,0,0]
-    for j in _my_q() :
-        if j['JobStatus'] == htcondor.JobStatus.IDLE :
-            tots[0] += 1
-        elif j['JobStatus'] == htcondor.JobStatus.RUNNING :
-            tots[1]  += 1
-        elif j['JobStatus'] == htcondor.JobStatus.HELD :
-            tots[2] += 1
-    #end loop over queue
 
-    return tots
+    return _my_totals()
 
-def watch_q(refresh_period = 10) :
+def watch_q(refresh_period = 10, log_dir = None, clusters = None) :
     """Watch your queue develop in terms of counts of idle, running, and held.
 
     End this function with a KeyboardInterrupt (ctrl-C).
 
+    If a log directory is given, we follow the condor event logs
+    of the jobs instead of querying the schedd. This doesn't put any load on the
+    schedd, only on the filesystem holding the logs (see logs.EventLogWatcher).
+
     Parameters
     ----------
     refresh_period : int
         Time in seconds to wait between refreshing, default is 10s
+    log_dir : str, optional
+        Directory holding the event logs of the jobs to watch (e.g. '<output-dir>/detail/logs')
+    clusters : list[int], optional
+        Only watch these clusters when following the event logs
+
+    Examples
+    --------
+    Watch all of your jobs by asking the schedd
+    >>> manage.watch_q()
+
+    Watch the jobs that are writing to an output directory without asking the schedd
+    >>> manage.watch_q(log_dir = '/hdfs/cms/user/me/ldmx/my-production/detail/logs')
     """
 
+    if log_dir is None :
+        get_totals = get_q_totals
+    else :
+        from umn_htcondor import logs
+        watcher = logs.EventLogWatcher(log_dir, clusters)
+        def get_totals() :
+            watcher.update()
+            return watcher.totals()
+
     sys.stdout.write(' IDLE  RUN HELD\n')
+    [tot_idle, tot_run, tot_held] = [0,0,0]
     while True :
         try:
-            [tot_idle, tot_run, tot_held] = get_q_totals()
+            [tot_idle, tot_run, tot_held] = get_totals()
             sys.stdout.write(f' {tot_idle:4} {tot_run:4} {tot_held:4} {time.ctime()}\r')
             sys.stdout.flush()
             time.sleep(refresh_period)
@@ -221,7 +403,7 @@ def hosts(extra_filters = True) :
     """
 
     uniq_hosts = dict()
-    for j in _my_q(extra_filters) :
+    for j in _my_q(extra_filters, ['LastRemoteHost','RemoteHost']) :
         if 'LastRemoteHost' in j :
             the_host = j["LastRemoteHost"]
         elif 'RemoteHost' in j :
@@ -254,8 +436,7 @@ def release_me() :
 def who() :
     """Print a table of usage based on user name. Summarizes numbers in IDLE, RUN, and HELD states."""
     users = dict()
-    schedd = htcondor.Schedd()
-    for j in schedd.xquery() :
+    for j in _cached_query(classad.ExprTree('true'), ['Owner','JobStatus']) :
         user = j["Owner"]
         if user not in users :
             users[user] = [0,0,0]
@@ -293,19 +474,81 @@ def who() :
 def why_held() :
     """Print list of exit codes on why jobs were held."""
 
-    codes = []
-    for j in _my_q(utility.job_status_is_held()) :
-        c = j["HoldReasonSubCode"]
-        if c not in codes: codes.append(c)
+    codes = set()
+    for j in _my_q(utility.job_status_is_held(), ['HoldReasonSubCode']) :
+        codes.add(j["HoldReasonSubCode"])
+
+    return sorted(codes)
 
-    return codes
+def hold_summary(extra_filters = True, o = sys.stdout) :
+    """Count the held jobs by exit code, host, and cluster
 
-def check_event_files(directory, the_glob='**') :
+    All of the held jobs are counted from a single query for only the
+    attributes we need, so this is quick even with thousands of held jobs.
+    This helps decide what to do about them: many holds on one host
+    suggest banning it (see ban_machine), codes 117 and 118 spread
+    across hosts can just be released (see release_me), and code 115
+    usually means the jobs need to be fixed and resubmitted.
+
+    Jobs held by our run script are labeled by its exit code (see
+    JobInstructions.periodic_release), other holds are labeled by the
+    reason condor held them (e.g. 'condor-15' for jobs submitted on hold).
+
+    Parameters
+    ----------
+    extra_filters : classad.ExprTree, optional
+        Can do more filtering on which held jobs to count (default: True)
+    o : file
+        File to write the table to (default: sys.stdout), None to not write it
+
+    Returns
+    -------
+        dict : (code, host, cluster) to (number of held jobs, age of oldest hold in seconds)
+
+    Examples
+    --------
+    >>> counts = manage.hold_summary()
+    >>> sum(n for (code, host, cluster), (n, age) in counts.items() if host == 'scorpion17')
+    42
+    """
+
+    now = int(time.time())
+    counts = dict()
+    for j in _my_q(utility.job_status_is_held().and_(extra_filters),
+            ['ClusterId','HoldReasonCode','HoldReasonSubCode','LastRemoteHost','EnteredCurrentStatus']) :
+        if j.get('HoldReasonCode') == 3 :
+            code = j.get('HoldReasonSubCode')
+        else :
+            code = f'condor-{j.get("HoldReasonCode")}'
+        host = utility.get_umn_host_name(j['LastRemoteHost']) if 'LastRemoteHost' in j else '-'
+        key = (code, host, j['ClusterId'])
+        age = now - j.get('EnteredCurrentStatus', now)
+        n, oldest = counts.get(key, (0, 0))
+        counts[key] = (n + 1, max(oldest, age))
+
+    if o is not None :
+        o.write(f'{"CODE":>10} {"HOST":12} {"CLUSTER":>8} {"HELD":>6} {"OLDEST":>9}\n')
+        for (code, host, cluster), (n, age) in sorted(counts.items(), key = lambda c : -c[1][0]) :
+            o.write(f'{str(code):>10} {host:12} {cluster:8} {n:6d} {age//3600:6d}:{age%3600//60:02d}\n')
+        total = sum(n for n, age in counts.values())
+        oldest = max((age for n, age in counts.values()), default = 0)
+        o.write(f'{"TOTAL":>10} {"":12} {"":8} {total:6d} {oldest//3600:6d}:{oldest%3600//60:02d}\n')
+        o.flush()
+
+    return counts
+
+def check_event_files(directory, the_glob='**', workers = 4, cache = True, use_root = True) :
     """Sometimes batch files are only partially completed.
 
     This checks if a root file needs to be 'recovered', implying
     that it was only partially completed when copied over to the
     end point.
+
+    The files are checked in a pool of worker processes.
+    Each file's header is checked first without ROOT (see rootfile.check)
+    and only files that look suspicious are opened with ROOT.
+    Files that were already checked and haven't changed since are
+    taken from a verification cache instead of being opened again.
     
     Parameters
     ----------
@@ -313,20 +556,30 @@ def check_event_files(directory, the_glob='**') :
         Directory to look for bad event files in
     the_glob : str, optional
         Glob patter matching for file in directory
+    workers : int, optional
+        Number of processes to use to open files
+    cache : bool or str, optional
+        True to use the default verification cache, a path to use
+        a specific cache file, or False to check every file again
+    use_root : bool, optional
+        False to never open files with ROOT, only checking their headers
+
+    Returns
+    -------
+        verify.CheckResults : lists of good, recovered, and unreadable files
+
+    Examples
+    --------
+    >>> results = manage.check_event_files('/hdfs/cms/user/me/ldmx/my-production')
+    >>> bad_files = results.recovered + results.unreadable
     """
-    bad_files = []
-    import ROOT
-    for f in glob.iglob(f'{directory}/{the_glob}', recursive=False) :
-        if not f.endswith('.root') : continue
-        rf = ROOT.TFile.Open(f)
-        print(f,end='...',flush=True)
-        try :
-            if rf.TestBit(ROOT.TFile.EStatusBits.kRecovered) :
-                print('bad')
-                bad_files.append(f)
-            else :
-                print('good')
-        except :
-            print('bad')
-            bad_files.append(f)
-    return bad_files
+
+    from umn_htcondor import verify
+
+    check = verify.check_fast_then_root if use_root else verify.check_without_root
+    files = [f for f in glob.iglob(f'{directory}/{the_glob}', recursive=False) if f.endswith('.root')]
+    if not cache :
+        return verify.check_files(files, workers, check = check)
+
+    with verify.VerificationCache(None if cache is True else cache) as the_cache :
+        return verify.check_files(files, workers, the_cache, check)
@@ -0,0 +1,183 @@
+"""Reading the manifests of the outputs copied by our jobs
+
+When a job copies an output file into the output directory, it keeps
+a record of that copy (output name, size, checksum, run number, and job id)
+and writes its records into a manifest of its own 'manifest/<cluster>/<job-id>.jsonl'
+inside of the detail directory once it is done copying (see node_io.py).
+Reading these manifests tells us which runs are done without listing or
+opening any of the output files.
+
+A job that couldn't write its manifest (or ran before the jobs wrote manifests)
+leaves no records, so a run without any records is not necessarily missing.
+"""
+
+import os # for listing the manifests
+import json # for reading the records
+import glob # for finding the manifests
+import collections # for namedtuple
+
+OK = 'ok'
+FAILED = 'failed'
+
+ManifestRecord = collections.namedtuple('ManifestRecord',
+    ['output', 'size', 'checksum', 'algorithm', 'run', 'job_id', 'status', 'time'])
+ManifestRecord.__doc__ = """Record of a single output file copied by a job"""
+
+class Manifest :
+    """Index of the output files recorded in the manifests of a detail directory
+
+    The manifests of all of the jobs are merged and
+    only the latest record for each output file is kept,
+    so an output that failed to copy and then was copied
+    successfully by a later job (e.g. a refill) is done.
+
+    Parameters
+    ----------
+    detail_dir : str
+        Detail directory holding the manifests (e.g. '<output-dir>/detail')
+    clusters : list[int], optional
+        Only read the manifests of these clusters (default: all manifests in the directory)
+
+    Attributes
+    ----------
+    outputs : dict[str, ManifestRecord]
+        Latest record for each output file name
+    n_skipped : int
+        Number of lines in the manifests that could not be read
+
+    Examples
+    --------
+    >>> manifest = Manifest('/hdfs/cms/user/me/ldmx/my-production/detail')
+    >>> print(manifest.summary())
+    >>> missing = list(manifest.missing_runs())
+    """
+
+    def __init__(self, detail_dir, clusters = None) :
+        self.detail_dir = detail_dir
+        self.outputs = dict()
+        self.n_skipped = 0
+
+        # manifests of each job, and the older manifests shared by each cluster
+        if clusters is None :
+            paths = (glob.glob(os.path.join(detail_dir, 'manifest', '*', '*.jsonl'))
+                + glob.glob(os.path.join(detail_dir, 'manifest.*.jsonl')))
+        else :
+            paths = []
+            for c in clusters :
+                paths += glob.glob(os.path.join(detail_dir, 'manifest', str(c), '*.jsonl'))
+                paths.append(os.path.join(detail_dir, f'manifest.{c}.jsonl'))
+
+        for path in paths :
+            self._load(path)
+
+    def _load(self, path) :
+        """Read the records in the input manifest, keeping the latest one for each output"""
+
+        try :
+            f = open(path)
+        except OSError :
+            return
+
+        with f :
+            for line in f :
+                try :
+                    record = ManifestRecord(**json.loads(line))
+                except (ValueError, TypeError) :
+                    # a job could have been killed in the middle of writing its record
+                    self.n_skipped += 1
+                    continue
+                latest = self.outputs.get(record.output)
+                if latest is None or record.time >= latest.time :
+                    self.outputs[record.output] = record
+
+    def done(self) :
+        """Get the records of the output files that were copied successfully
+
+        Returns
+        -------
+            list[ManifestRecord] : records sorted by output name
+        """
+        return sorted((r for r in self.outputs.values() if r.status == OK), key = lambda r : r.output)
+
+    def failed(self) :
+        """Get the records of the output files whose latest copy failed
+
+        These files are corrupt or missing from the output directory.
+
+        Returns
+        -------
+            list[ManifestRecord] : records sorted by output name
+        """
+        return sorted((r for r in self.outputs.values() if r.status != OK), key = lambda r : r.output)
+
+    def runs(self) :
+        """Get the run numbers whose output files were all copied successfully
+
+        Returns
+        -------
+            set[int] : run numbers that are done
+        """
+        good, bad = set(), set()
+        for r in self.outputs.values() :
+            if r.run is None :
+                continue
+            (good if r.status == OK else bad).add(r.run)
+        return good - bad
+
+    def missing_runs(self, first = None, last = None) :
+        """Generate the run numbers that are not done
+
+        Parameters
+        ----------
+        first : int, optional
+            First run number to look for (default: smallest run number in the manifests)
+        last : int, optional
+            Last run number to look for (default: largest run number in the manifests)
+
+        Returns
+        -------
+            generator[int] : run numbers in increasing order
+        """
+        done = self.runs()
+        all_runs = [r.run for r in self.outputs.values() if r.run is not None]
+        if len(all_runs) == 0 and (first is None or last is None) :
+            return
+        first = min(all_runs) if first is None else first
+        last = max(all_runs) if last is None else last
+        for run in range(first, last+1) :
+            if run not in done :
+                yield run
+
+    def unrecorded_runs(self, first = None, last = None) :
+        """Generate the run numbers without any records at all
+
+        These runs could be missing or their jobs could have finished
+        without writing a manifest, so the output directory needs to be
+        scanned to tell which.
+
+        Parameters
+        ----------
+        first : int, optional
+            First run number to look for (default: smallest run number in the manifests)
+        last : int, optional
+            Last run number to look for (default: largest run number in the manifests)
+
+        Returns
+        -------
+            generator[int] : run numbers in increasing order
+        """
+        recorded = set(r.run for r in self.outputs.values() if r.run is not None)
+        if len(recorded) == 0 and (first is None or last is None) :
+            return
+        first = min(recorded) if first is None else first
+        last = max(recorded) if last is None else last
+        for run in range(first, last+1) :
+            if run not in recorded :
+                yield run
+
+    def summary(self) :
+        """Get a one-line summary of the manifests."""
+        n_done = sum(1 for r in self.outputs.values() if r.status == OK)
+        n_bytes = sum(r.size for r in self.outputs.values() if r.status == OK)
+        return (f'{len(self.outputs)} output files in manifests, {n_done} copied ({n_bytes/1024**3:.1f} GB), '
+                f'{len(self.outputs) - n_done} failed, {len(self.runs())} runs done.')
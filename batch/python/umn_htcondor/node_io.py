@@ -0,0 +1,420 @@
+"""File handling helpers run on the worker nodes
+
+This module only uses the standard library since it is run
+by the run scripts on the worker nodes (outside of the container).
+It is copied into the detail directory next to the run script
+when the jobs are submitted and is run from there.
+
+    python3 node_io.py copy <source> <destination-directory> [--manifest <file> --job_id <id> --run <number>]
+    python3 node_io.py manifest <records> <manifest>
+    python3 node_io.py stage <cache-directory> <working-directory> [--max_size <size>] -- <arguments> ...
+    python3 node_io.py image <cache-directory> <working-directory> <image> [--max_size <size>]
+"""
+
+import os # for file handling
+import sys # for exit codes
+import time # for measuring throughput
+import zlib # for checksums
+import json # for manifest records
+import fcntl # for locking the input cache
+import hashlib # for naming files in the input cache
+import argparse # for the command line
+
+_checksums = {
+    'adler32' : (zlib.adler32, 1),
+    'crc32' : (zlib.crc32, 0)
+    }
+
+_block_size = 16*1024*1024
+
+def checksum_file(path, algorithm = 'adler32') :
+    """Calculate the checksum of the input file
+
+    Returns
+    -------
+        int : checksum of the file's contents
+    """
+
+    update, checksum = _checksums[algorithm]
+    buf = bytearray(_block_size)
+    view = memoryview(buf)
+    with open(path, 'rb') as f :
+        while True :
+            n = f.readinto(buf)
+            if not n :
+                break
+            checksum = update(view[:n], checksum)
+    return checksum
+
+def _copy_file(source, dest, algorithm = 'adler32', verify = True) :
+    """Copy the input file to the destination path, calculating its checksum along the way
+
+    Returns
+    -------
+        tuple : (success, size in bytes, checksum of source, seconds spent copying)
+    """
+
+    update, checksum = _checksums[algorithm]
+    size = 0
+    start = time.time()
+    buf = bytearray(_block_size)
+    view = memoryview(buf)
+    try :
+        with open(source, 'rb') as src, open(dest, 'wb') as dst :
+            while True :
+                n = src.readinto(buf)
+                if not n :
+                    break
+                checksum = update(view[:n], checksum)
+                dst.write(view[:n])
+                size += n
+            dst.flush()
+            if verify :
+                os.fsync(dst.fileno())
+        copied = time.time() - start
+        success = (not verify or checksum_file(dest, algorithm) == checksum)
+    except OSError as e :
+        print(f'Copying {source} failed: {e}', file=sys.stderr)
+        copied = time.time() - start
+        success = False
+
+    if not success and os.path.isfile(dest) :
+        # delete half-copied file
+        os.remove(dest)
+
+    return success, size, checksum, copied
+
+def copy_with_checksum(source, dest_dir, algorithm = 'adler32') :
+    """Copy the input file into the destination directory, checking that the copy is complete
+
+    The source is read only once, calculating its checksum while it is being written to the
+    destination. Only the destination file is synced to disk (instead of every dirty buffer on
+    the node with 'sync') and then it is read back to compare its checksum to the source's.
+    A copy that doesn't match is removed.
+
+    Parameters
+    ----------
+    source : str
+        Path to file to copy
+    dest_dir : str
+        Directory to copy the file into
+    algorithm : str, optional
+        Checksum to use ('adler32' or 'crc32')
+
+    Returns
+    -------
+        tuple : (success, size in bytes, checksum of source, seconds spent copying)
+    """
+
+    return _copy_file(source, os.path.join(dest_dir, os.path.basename(source)), algorithm)
+
+def append_manifest_record(manifest, record) :
+    """Append the input record to the manifest as a single line of JSON
+
+    The manifest is a file of the job's own in its working directory,
+    it is written into the detail directory with write_manifest once
+    the job is done copying.
+    """
+
+    line = (json.dumps(record, sort_keys = True)+'\n').encode()
+    fd = os.open(manifest, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try :
+        os.write(fd, line)
+    finally :
+        os.close(fd)
+
+def write_manifest(records, manifest) :
+    """Write the records of a job's copies into its own manifest file in one go
+
+    HDFS only allows one writer for each file and appending through its
+    FUSE mount is unreliable, so instead of appending to a manifest shared
+    by the whole cluster, each job collects its records in its working directory
+    and writes them into a new file of its own. The file is written under a
+    temporary name (which readers skip) and renamed once it is complete.
+
+    Parameters
+    ----------
+    records : str
+        File the records were appended to while copying
+    manifest : str
+        Manifest file for this job (e.g. 'detail/manifest/<cluster>/<job-id>.jsonl')
+    """
+
+    with open(records, 'rb') as f :
+        data = f.read()
+    directory, name = os.path.split(manifest)
+    os.makedirs(directory, exist_ok=True)
+    tmp = os.path.join(directory, f'.{name}.{os.getpid()}.tmp')
+    try :
+        with open(tmp, 'wb') as f :
+            f.write(data)
+        if os.path.exists(manifest) :
+            # a job that is run again replaces its records,
+            #   hdfs doesn't rename over an existing file
+            os.remove(manifest)
+        os.rename(tmp, manifest)
+    finally :
+        if os.path.exists(tmp) :
+            os.remove(tmp)
+
+def _manifest(arg) :
+    try :
+        write_manifest(arg.records, arg.manifest)
+    except OSError as e :
+        # the outputs were still copied, so this doesn't fail the job
+        print(f'Could not write manifest {arg.manifest}: {e}', file=sys.stderr)
+        return 1
+    return 0
+
+def _copy(arg) :
+    success, size, checksum, copied = copy_with_checksum(arg.source, arg.dest_dir, arg.checksum)
+    rate = size / 1024**2 / copied if copied > 0 else float('inf')
+    print(f'{arg.source} -> {arg.dest_dir} : {size} bytes in {copied:.1f}s ({rate:.1f} MB/s) '
+          f'{arg.checksum} {checksum:08x} {"matched" if success else "did NOT match"}', flush=True)
+    if arg.manifest is not None :
+        try :
+            append_manifest_record(arg.manifest, {
+                'output' : os.path.basename(arg.source),
+                'size' : size,
+                'checksum' : f'{checksum:08x}',
+                'algorithm' : arg.checksum,
+                'run' : arg.run,
+                'job_id' : arg.job_id,
+                'status' : 'ok' if success else 'failed',
+                'time' : int(time.time())
+                })
+        except OSError as e :
+            # the output was still copied, so we don't fail the copy
+            print(f'Could not append to manifest {arg.manifest}: {e}', file=sys.stderr)
+    return 0 if success else 1
+
+class InputCache :
+    """Cache of input files on the scratch disk of a worker node
+
+    The jobs on a node share the cache, so each input file is only pulled over
+    the network once while it stays in the cache. Files are named by their source
+    path, size, and modification time, so a changed source is pulled again.
+
+    A file is copied into the cache under a lock for that file (other jobs wanting
+    the same file wait for it) and renamed into place once it is complete.
+    Each job then hard-links the cached file into its own working directory,
+    so a file that is evicted from the cache while a job is using it stays on disk
+    until that job cleans up. Files are evicted least-recently-used first once
+    the cache would be larger than its maximum size, skipping files that
+    are linked into a job's working directory.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory to keep the cached files in
+    max_size : int
+        Maximum size of the cache in bytes
+    verify : bool, optional
+        Sync each file copied into the cache to disk and compare its checksum
+        to the source's before it can be used, this is worth it for files that
+        are read by many jobs (e.g. the singularity image)
+    """
+
+    def __init__(self, cache_dir, max_size, verify = False) :
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.verify = verify
+        self.__files = os.path.join(cache_dir, 'files')
+        self.__locks = os.path.join(cache_dir, 'locks')
+        os.makedirs(self.__files, exist_ok=True)
+        os.makedirs(self.__locks, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evicted = 0
+        self.bytes_copied = 0
+        self.seconds_copying = 0.
+
+    def _make_room(self, needed) :
+        """Evict files until there is room for the input number of bytes
+
+        Returns
+        -------
+            bool : True if there is room
+        """
+
+        with open(os.path.join(self.cache_dir, '.lock'), 'w') as lock :
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = []
+            with os.scandir(self.__files) as it :
+                for e in it :
+                    try :
+                        st = e.stat()
+                    except OSError :
+                        continue
+                    entries.append((st.st_mtime, st.st_size, st.st_nlink, e.path))
+            total = sum(size for mtime, size, nlink, path in entries)
+            for mtime, size, nlink, path in sorted(entries) :
+                if total + needed <= self.max_size :
+                    break
+                if nlink > 1 or os.path.basename(path).startswith('.') :
+                    # a job is using it or it is being copied in
+                    continue
+                try :
+                    os.remove(path)
+                    total -= size
+                    self.evicted += 1
+                except OSError :
+                    pass
+            return total + needed <= self.max_size
+
+    def stage(self, source, work_dir) :
+        """Put the input file into the working directory through the cache
+
+        Parameters
+        ----------
+        source : str
+            Path to input file
+        work_dir : str
+            Working directory of the job
+
+        Returns
+        -------
+            str : path to the file in the working directory or the source if it couldn't be staged
+        """
+
+        st = os.stat(source)
+        real_source = os.path.realpath(source)
+        name = os.path.basename(source)
+        key = f'{hashlib.sha1(real_source.encode()).hexdigest()[:16]}-{st.st_size}-{st.st_mtime_ns}-{name}'
+        cached = os.path.join(self.__files, key)
+        staged = os.path.join(work_dir, name)
+        n = 0
+        while os.path.lexists(staged) :
+            n += 1
+            staged = os.path.join(work_dir, f'{n}_{name}')
+
+        try :
+            os.link(cached, staged)
+            os.utime(cached)
+            self.hits += 1
+            return staged
+        except FileNotFoundError :
+            pass
+
+        with open(os.path.join(self.__locks, key+'.lock'), 'w') as lock :
+            # wait for anyone else copying this file
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.isfile(cached) :
+                if not self._make_room(st.st_size) :
+                    self.bypassed += 1
+                    return source
+                tmp = os.path.join(self.__files, f'.{key}.{os.getpid()}.tmp')
+                try :
+                    success, size, checksum, copied = _copy_file(real_source, tmp, verify = self.verify)
+                    if not success :
+                        self.bypassed += 1
+                        return source
+                    os.replace(tmp, cached)
+                finally :
+                    # eviction skips files being copied in, so don't leave one behind
+                    if os.path.exists(tmp) :
+                        os.remove(tmp)
+                self.misses += 1
+                self.bytes_copied += size
+                self.seconds_copying += copied
+            else :
+                # someone else copied it while we waited
+                self.hits += 1
+            os.link(cached, staged)
+        return staged
+
+    def summary(self) :
+        """Get a one-line summary of how the cache was used."""
+        rate = self.bytes_copied / 1024**2 / self.seconds_copying if self.seconds_copying > 0 else 0.
+        return (f'Input cache {self.cache_dir} : {self.hits} hits, {self.misses} misses, {self.bypassed} not cached, '
+                f'{self.bytes_copied/1024**2:.1f} MB copied ({rate:.1f} MB/s), {self.evicted} files evicted')
+
+def _parse_size(size_str) :
+    """Get the number of bytes from a size string with an optional 'K', 'M', 'G', or 'T' suffix"""
+    multipliers = { 'K' : 1024, 'M' : 1024**2, 'G' : 1024**3, 'T' : 1024**4 }
+    size_str = size_str.strip().upper().rstrip('B')
+    if size_str and size_str[-1] in multipliers :
+        return int(float(size_str[:-1])*multipliers[size_str[-1]])
+    return int(size_str)
+
+def _stage(arg) :
+    # the re-written arguments are printed to stdout for the run script,
+    #   everything else goes to stderr (which also ends up in the job's .out log)
+    cache = InputCache(arg.cache_dir, _parse_size(arg.max_size))
+    os.makedirs(arg.work_dir, exist_ok=True)
+    # the input paths are given with symlinks resolved (e.g. /hdfs -> /mnt/hdfs/phys),
+    #   so we match the resolved prefixes as well
+    prefixes = set(arg.prefix)
+    for p in arg.prefix :
+        prefixes.add(os.path.join(os.path.realpath(p), ''))
+    prefixes = tuple(prefixes)
+    staged_args = []
+    for a in arg.arguments :
+        if a.startswith(prefixes) and os.path.isfile(a) :
+            try :
+                a = cache.stage(a, arg.work_dir)
+            except OSError as e :
+                print(f'Staging {a} failed: {e}', file=sys.stderr)
+        staged_args.append(a)
+    print(cache.summary(), file=sys.stderr, flush=True)
+    print(' '.join(staged_args))
+    return 0
+
+def _image(arg) :
+    # the path to the image to run is printed to stdout for the run script,
+    #   everything else goes to stderr (which also ends up in the job's .out log)
+    cache = InputCache(arg.cache_dir, _parse_size(arg.max_size), verify = True)
+    try :
+        image = cache.stage(arg.image, arg.work_dir)
+    except OSError as e :
+        print(f'Staging {arg.image} failed: {e}', file=sys.stderr)
+        image = arg.image
+    print(cache.summary(), file=sys.stderr, flush=True)
+    print(image)
+    return 0
+
+if __name__ == '__main__' :
+    parser = argparse.ArgumentParser('node_io', description='File handling helpers run on the worker nodes.')
+    commands = parser.add_subparsers(dest='command')
+
+    copy = commands.add_parser('copy', help='Copy a file into a directory, checking that the copy matches.')
+    copy.add_argument('source',type=str,help='File to copy.')
+    copy.add_argument('dest_dir',type=str,help='Directory to copy the file into.')
+    copy.add_argument('--checksum',type=str,default='adler32',choices=list(_checksums),help='Checksum to compare the copy with.')
+    copy.add_argument('--manifest',type=str,help='Manifest file to append a record of this copy to.')
+    copy.add_argument('--job_id',type=str,help='ID of the job doing this copy, for the manifest.')
+    copy.add_argument('--run',type=int,help='Run number of the job doing this copy, for the manifest.')
+    copy.set_defaults(func=_copy)
+
+    manifest = commands.add_parser('manifest', help="Write the records of a job's copies into its own manifest file in one go.")
+    manifest.add_argument('records',type=str,help='File the records were appended to while copying.')
+    manifest.add_argument('manifest',type=str,help='Manifest file for this job in the detail directory.')
+    manifest.set_defaults(func=_manifest)
+
+    stage = commands.add_parser('stage', help="Stage the input files in the arguments to the job given after '--' through a node-local cache, printing the re-written arguments.")
+    stage.add_argument('cache_dir',type=str,help='Directory to keep the cached input files in.')
+    stage.add_argument('work_dir',type=str,help='Working directory of the job to put the input files in.')
+    stage.add_argument('--max_size',type=str,default='100G',help="Maximum size of the cache. Can use 'K', 'M', 'G' as suffix specifiers.")
+    stage.add_argument('--prefix',type=str,nargs='+',default=['/hdfs/','/mnt/hdfs/'],help='Only stage input files whose path starts with one of these (or what they link to).')
+    stage.set_defaults(func=_stage)
+
+    image = commands.add_parser('image', help='Stage the singularity image through a node-local cache, checking the copy, and print the path to run.')
+    image.add_argument('cache_dir',type=str,help='Directory to keep the cached images in.')
+    image.add_argument('work_dir',type=str,help='Working directory of the job to put the image in.')
+    image.add_argument('image',type=str,help='Singularity image to stage.')
+    image.add_argument('--max_size',type=str,default='20G',help="Maximum size of the cache. Can use 'K', 'M', 'G' as suffix specifiers.")
+    image.set_defaults(func=_image)
+
+    # anything after '--' is passed along as the arguments to the job
+    argv = sys.argv[1:]
+    job_arguments = []
+    if '--' in argv :
+        job_arguments = argv[argv.index('--')+1:]
+        argv = argv[:argv.index('--')]
+    arg = parser.parse_args(argv)
+    arg.arguments = job_arguments
+    if arg.command is None :
+        parser.print_help()
+        sys.exit(2)
+    sys.exit(arg.func(arg))
@@ -0,0 +1,31 @@
+#!/bin/bash
+
+###############################################################################
+# node_io.sh
+#   Helpers shared by the run scripts, sourced from the detail directory
+#   where it is copied next to the run script and node_io.py when submitting.
+#   The run script defines _node_io (path to node_io.py) before sourcing this.
+###############################################################################
+
+# Stage the singularity image through a cache on the scratch disk of this node
+#   so that the jobs starting on this node don't all read the same multi-GB
+#   image from the shared filesystem at once. The image is copied into the
+#   cache once per node (jobs wanting it at the same time wait on a lock),
+#   its checksum is compared to the original before it is used, and it is
+#   hard-linked into our working directory so it stays put while we run.
+#   If staging fails, we run the image from where it is as usual.
+#
+#   Arguments
+#     1 - cache directory on the scratch disk
+#     2 - singularity image to stage
+#   Prints the path to the image to run
+stage-image() {
+  local _cache_dir="$1"
+  local _image="$2"
+  local _staged
+  if [[ -f $_node_io ]] && hash python3 &> /dev/null && _staged=$(python3 $_node_io image ${_cache_dir} $(pwd) ${_image}); then
+    echo ${_staged}
+  else
+    echo ${_image}
+  fi
+}
@@ -0,0 +1,379 @@
+"""Pilot jobs pulling work items from a shared queue
+
+Instead of submitting one job for each item (run number or group of input
+files), we put the items into a SQLite work queue and submit a few long-lived
+pilot jobs. Each pilot claims an item, runs the run script for it, records
+how it went, and claims the next one until the queue is empty. Matchmaking,
+waiting in the queue, and setting up the node (e.g. staging the singularity
+image) are then paid once per pilot instead of once per item.
+
+A pilot holds a lease on the item it is running which it renews while the
+run script is running. If a pilot dies (e.g. its machine goes down), its
+lease runs out and the item is claimed again by another pilot.
+
+This module only uses the standard library since it is run by the pilots on
+the worker nodes. It is copied into the detail directory next to the run
+script when the jobs are submitted and is run from there. A pilot can be
+run on any machine that sees the queue, which is helpful for testing.
+
+    python3 pilot.py run <queue> <job-id> <run-script> -- <arguments to run script after job id> ...
+    python3 pilot.py status <queue>
+"""
+
+import os # for stopping run scripts
+import sys # for exit codes
+import time # for leases
+import signal # for stopping run scripts
+import socket # for naming pilots
+import sqlite3 # for the work queue
+import argparse # for the command line
+import subprocess # for running the run script
+
+# statuses of items in the queue
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# exit codes of the run script meaning the item should be tried again
+#   (see JobInstructions.periodic_release)
+_retry_codes = [117, 118]
+
+# exit codes of the run script meaning this node can't run anything,
+#   the item is put back without counting it as an attempt and the pilot
+#   stops with this code so that condor can release it onto another node
+_node_codes = [99, 100]
+
+class WorkQueue :
+    """Queue of work items in a SQLite file shared by the pilots
+
+    Every change to the queue is a single transaction that locks the
+    file for writing first, so two pilots never claim the same item.
+
+    Parameters
+    ----------
+    path : str
+        SQLite file holding the queue, created if it doesn't exist
+    timeout : float, optional
+        Maximum time in seconds to wait for another pilot to finish changing the queue
+
+    Warnings
+    --------
+    SQLite needs a filesystem that supports locking files and writing into
+    the middle of them, which a FUSE mount of hdfs might not (see check_queue).
+    """
+
+    def __init__(self, path, timeout = 600) :
+        self.path = path
+        self.__db = sqlite3.connect(path, timeout = timeout, isolation_level = None)
+        self.__db.execute('''CREATE TABLE IF NOT EXISTS items (
+            id INTEGER PRIMARY KEY,
+            args TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            pilot TEXT,
+            lease_until REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            exit_code INTEGER,
+            started REAL,
+            finished REAL)''')
+
+    def close(self) :
+        self.__db.close()
+
+    def _transaction(self, f) :
+        """Run the input function with the database locked for writing, committing if it succeeds"""
+
+        self.__db.execute('BEGIN IMMEDIATE')
+        try :
+            result = f(self.__db)
+        except :
+            self.__db.execute('ROLLBACK')
+            raise
+        self.__db.execute('COMMIT')
+        return result
+
+    def fill(self, items) :
+        """Add the input items to the queue
+
+        Parameters
+        ----------
+        items : iterable[str]
+            Arguments to give the run script for each item (e.g. a run number)
+
+        Returns
+        -------
+            int : number of items added
+        """
+
+        def add(db) :
+            before = db.total_changes
+            db.executemany('INSERT INTO items (args) VALUES (?)', ((a,) for a in items))
+            return db.total_changes - before
+        return self._transaction(add)
+
+    def claim(self, pilot, lease = 3600, max_attempts = 3) :
+        """Claim the next item for the input pilot
+
+        Items whose pilot's lease has run out are claimed again.
+        Items that have already been attempted max_attempts times
+        are marked as failed instead of being claimed.
+
+        Parameters
+        ----------
+        pilot : str
+            Name of the pilot claiming the item
+        lease : float, optional
+            Time in seconds the pilot has to finish (or renew) the item
+        max_attempts : int, optional
+            Maximum number of times to attempt an item
+
+        Returns
+        -------
+            tuple : (id of item, arguments for item) or None if there is nothing left to claim
+        """
+
+        def claim_next(db) :
+            now = time.time()
+            db.execute('UPDATE items SET status = ? WHERE (status = ? OR (status = ? AND lease_until < ?)) AND attempts >= ?',
+                (FAILED, PENDING, RUNNING, now, max_attempts))
+            row = db.execute('SELECT id, args FROM items WHERE status = ? OR (status = ? AND lease_until < ?) ORDER BY id LIMIT 1',
+                (PENDING, RUNNING, now)).fetchone()
+            if row is None :
+                return None
+            db.execute('UPDATE items SET status = ?, pilot = ?, lease_until = ?, attempts = attempts + 1, started = ? WHERE id = ?',
+                (RUNNING, pilot, now + lease, now, row[0]))
+            return row
+        return self._transaction(claim_next)
+
+    def renew(self, item, pilot, lease = 3600) :
+        """Renew the lease the input pilot has on the input item
+
+        Returns
+        -------
+            bool : False if the pilot doesn't hold the item anymore
+        """
+        return self._transaction(lambda db : db.execute(
+            'UPDATE items SET lease_until = ? WHERE id = ? AND pilot = ? AND status = ?',
+            (time.time() + lease, item, pilot, RUNNING)).rowcount == 1)
+
+    def complete(self, item, pilot, exit_code) :
+        """Record how the input item finished
+
+        The item is done if the exit code is zero. Items whose outputs failed to copy
+        are put back into the queue (see _retry_codes) while other failures are final.
+        Nothing is recorded if the pilot doesn't hold the item anymore (its lease ran out).
+
+        Returns
+        -------
+            str : new status of the item or None if the pilot doesn't hold it
+        """
+
+        status = DONE if exit_code == 0 else (PENDING if exit_code in _retry_codes else FAILED)
+        updated = self._transaction(lambda db : db.execute(
+            'UPDATE items SET status = ?, exit_code = ?, finished = ?, lease_until = NULL WHERE id = ? AND pilot = ? AND status = ?',
+            (status, exit_code, time.time(), item, pilot, RUNNING)).rowcount == 1)
+        return status if updated else None
+
+    def release(self, item, pilot) :
+        """Put the input item back into the queue without counting this attempt"""
+        self._transaction(lambda db : db.execute(
+            'UPDATE items SET status = ?, attempts = attempts - 1, lease_until = NULL WHERE id = ? AND pilot = ? AND status = ?',
+            (PENDING, item, pilot, RUNNING)))
+
+    def counts(self) :
+        """Get the number of items with each status
+
+        Returns
+        -------
+            dict[str, int] : number of items by status
+        """
+        counts = { s : 0 for s in [PENDING, RUNNING, DONE, FAILED] }
+        counts.update(self.__db.execute('SELECT status, COUNT(*) FROM items GROUP BY status').fetchall())
+        return counts
+
+    def failed(self) :
+        """Get the items that failed
+
+        Returns
+        -------
+            list[tuple] : (id of item, arguments for item, exit code of last attempt)
+        """
+        return self.__db.execute('SELECT id, args, exit_code FROM items WHERE status = ? ORDER BY id', (FAILED,)).fetchall()
+
+    def summary(self) :
+        """Get a one-line summary of the items in the queue."""
+        return 'Work queue : ' + ', '.join(f'{n} {s}' for s, n in self.counts().items())
+
+def check_queue(path) :
+    """Check that a work queue at the input path can be written and locked
+
+    We create the queue (if it doesn't exist), make an empty transaction,
+    and check that a second connection is kept out while the first
+    one holds the lock, which is what keeps two pilots from claiming
+    the same item.
+
+    Parameters
+    ----------
+    path : str
+        SQLite file holding the queue
+
+    Raises
+    ------
+    Exception
+        If SQLite doesn't work on the filesystem holding the queue
+    """
+
+    try :
+        queue = WorkQueue(path, timeout = 60)
+        try :
+            queue._transaction(lambda db : db.execute('SELECT COUNT(*) FROM items').fetchone())
+            other = sqlite3.connect(path, timeout = 0, isolation_level = None)
+            try :
+                locked = queue._transaction(lambda db : _is_locked(other))
+            finally :
+                other.close()
+        finally :
+            queue.close()
+    except sqlite3.Error as e :
+        raise Exception(f'Unable to use {path} as a work queue ({e}), it needs to be on a filesystem that supports SQLite.')
+    if not locked :
+        raise Exception(f'Locking {path} does not keep other pilots out, it needs to be on a filesystem that supports locking files.')
+
+def _is_locked(db) :
+    """Check if the input connection is kept from writing to its database"""
+
+    try :
+        db.execute('BEGIN IMMEDIATE')
+    except sqlite3.OperationalError :
+        return True
+    db.execute('ROLLBACK')
+    return False
+
+def run_pilot(queue, job_id, run_script, arguments = [], lease = 3600, max_attempts = 3, max_time = None) :
+    """Run the items in the queue one after the other until it is empty
+
+    Each item is run as
+
+        bash <run-script> <job-id>_<item-id> <arguments> <arguments of item>
+
+    where the item id is zero-padded so the working directories and
+    logs of the items line up. The lease on the item is renewed while
+    the run script runs. If renewing fails, the item belongs to another
+    pilot now, so the run script is stopped and nothing is recorded for it.
+
+    Parameters
+    ----------
+    queue : WorkQueue
+        Queue to take items from
+    job_id : str
+        ID of this pilot, used to name it and the items it runs
+    run_script : str
+        Script to run for each item
+    arguments : list[str], optional
+        Arguments to the run script after the job ID, shared by all items
+    lease : float, optional
+        Time in seconds this pilot has to finish (or renew) an item
+    max_attempts : int, optional
+        Maximum number of times to attempt an item
+    max_time : float, optional
+        Stop claiming items once this pilot has been running this many seconds
+
+    Returns
+    -------
+        int : exit code for the pilot, zero unless the node can't run anything (see _node_codes)
+    """
+
+    pilot = f'{job_id}@{socket.gethostname()}'
+    start = time.time()
+    n_items = 0
+    while max_time is None or time.time() - start < max_time :
+        claimed = queue.claim(pilot, lease, max_attempts)
+        if claimed is None :
+            break
+        item, args = claimed
+        print(f'Pilot {pilot} running item {item} : {args}', flush=True)
+
+        # the run script gets its own process group so we can stop the container along with it
+        p = subprocess.Popen(['bash', run_script, f'{job_id}_{item:06d}'] + list(arguments) + args.split(),
+            start_new_session = True)
+        lost_lease = False
+        while True :
+            try :
+                exit_code = p.wait(timeout = lease/3)
+                break
+            except subprocess.TimeoutExpired :
+                if not queue.renew(item, pilot, lease) :
+                    # another pilot may be running this item now,
+                    #   so we stop ours before both copy outputs for it
+                    print(f'Pilot {pilot} lost its lease on item {item}, stopping it.', flush=True)
+                    lost_lease = True
+                    os.killpg(p.pid, signal.SIGTERM)
+                    try :
+                        p.wait(timeout = 60)
+                    except subprocess.TimeoutExpired :
+                        os.killpg(p.pid, signal.SIGKILL)
+                        p.wait()
+                    break
+
+        n_items += 1
+        if lost_lease :
+            continue
+
+        if exit_code in _node_codes :
+            queue.release(item, pilot)
+            print(f'Item {item} exited with {exit_code}, this node is not able to run items.', flush=True)
+            return exit_code
+
+        status = queue.complete(item, pilot, exit_code)
+        print(f'Item {item} exited with {exit_code} ({status}).', flush=True)
+
+    print(f'Pilot {pilot} ran {n_items} items in {time.time() - start:.0f}s. {queue.summary()}', flush=True)
+    return 0
+
+def _run(arg) :
+    queue = WorkQueue(arg.queue)
+    try :
+        return run_pilot(queue, arg.job_id, arg.run_script, arg.arguments,
+            lease = arg.lease, max_attempts = arg.max_attempts, max_time = arg.max_time)
+    finally :
+        queue.close()
+
+def _status(arg) :
+    queue = WorkQueue(arg.queue)
+    try :
+        print(queue.summary())
+        for item, args, exit_code in queue.failed() :
+            print(f'  failed item {item} ({args}) with exit code {exit_code}')
+    finally :
+        queue.close()
+    return 0
+
+if __name__ == '__main__' :
+    parser = argparse.ArgumentParser('pilot', description='Pilot jobs pulling work items from a shared queue.')
+    commands = parser.add_subparsers(dest='command')
+
+    run = commands.add_parser('run', help="Run items from the queue until it is empty, giving the run script the arguments after '--' followed by the item's arguments.")
+    run.add_argument('queue',type=str,help='SQLite file holding the work queue.')
+    run.add_argument('job_id',type=str,help='ID of this pilot, used to name the items it runs.')
+    run.add_argument('run_script',type=str,help='Script to run for each item.')
+    run.add_argument('--lease',type=float,default=3600,help='Time in seconds to finish (or renew) an item before another pilot can claim it.')
+    run.add_argument('--max_attempts',type=int,default=3,help='Maximum number of times to attempt an item.')
+    run.add_argument('--max_time',type=float,help='Stop claiming items after running for this many seconds.')
+    run.set_defaults(func=_run)
+
+    status = commands.add_parser('status', help='Print the number of items with each status and the items that failed.')
+    status.add_argument('queue',type=str,help='SQLite file holding the work queue.')
+    status.set_defaults(func=_status)
+
+    # anything after '--' is passed along to the run script
+    argv = sys.argv[1:]
+    run_arguments = []
+    if '--' in argv :
+        run_arguments = argv[argv.index('--')+1:]
+        argv = argv[:argv.index('--')]
+    arg = parser.parse_args(argv)
+    arg.arguments = run_arguments
+    if arg.command is None :
+        parser.print_help()
+        sys.exit(2)
+    sys.exit(arg.func(arg))
@@ -0,0 +1,190 @@
+"""Checking on the worker nodes directly
+
+We run a short command on each of the worker nodes (usually over ssh),
+all of the nodes at once with a timeout for each, so that one node that
+hangs doesn't hold up the rest. The results are remembered for a few
+minutes in your local directory so that other scripts (e.g. submit_jobs.py)
+can use them without asking the nodes again.
+
+    python3 -m umn_htcondor.probe {check,scratch,clean} [host ...]
+"""
+
+import os # for path manipulation
+import sys # for exit codes
+import json # for remembering results
+import time # for timing and ages of results
+import argparse # for the command line
+import subprocess # for running the commands
+import collections # for namedtuple
+from concurrent.futures import ThreadPoolExecutor # for probing nodes concurrently
+from umn_htcondor import utility
+
+# all of the worker nodes
+scorpions = [f'scorpion{i}' for i in range(1,49)]
+
+# maximum age in seconds of a remembered result that can be re-used
+probe_cache_ttl = 300
+
+# name of check -> command run on the node
+#   the commands print a single line describing the state of the node
+checks = {
+    'check' : 'if [[ ! -d /cvmfs/cms.cern.ch ]]; then echo "No cvmfs"; elif [[ ! -d /hdfs/cms/user ]]; then echo "No hdfs"; else echo "good"; fi',
+    'scratch' : 'df -hP /export/scratch | sed 1d',
+    'clean' : 'cd /export/scratch/users; if [[ -d $USER ]]; then rm -r $USER; echo "cleaned"; else echo "No user dir"; fi',
+    }
+
+# checks that change the node so their results shouldn't be re-used
+_not_cached = ['clean']
+
+ProbeResult = collections.namedtuple('ProbeResult', ['host', 'check', 'ok', 'output', 'time', 'seconds'])
+ProbeResult.__doc__ = """Result of running a check on a node, ok is False if we couldn't reach the node"""
+
+def ssh_transport(host, command) :
+    """Run the input command on the input host over ssh without prompting for anything"""
+    return ['ssh', '-q', '-o', 'BatchMode=yes', '-o', 'ConnectTimeout=10', host, command]
+
+def local_transport(host, command) :
+    """Run the input command on this machine instead of the input host, for testing"""
+    return ['bash', '-c', command]
+
+def _cache_path() :
+    """Path to the file holding the remembered results"""
+    return os.path.join(utility.local_dir(), 'probe_cache.json')
+
+def _load_cache(path) :
+    """Load the remembered results, empty if there aren't any"""
+    try :
+        with open(path) as f :
+            return json.load(f)
+    except (OSError, ValueError) :
+        return dict()
+
+def _run_check(host, check, transport, timeout) :
+    """Run the input check on a single host
+
+    Returns
+    -------
+        ProbeResult : result of the check
+    """
+
+    start = time.time()
+    try :
+        p = subprocess.run(transport(host, checks[check]), stdin = subprocess.DEVNULL,
+            stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, timeout = timeout, universal_newlines = True)
+        ok = (p.returncode == 0)
+        output = p.stdout.strip() or "Can't connect"
+    except subprocess.TimeoutExpired :
+        ok, output = False, f'Timed out after {timeout}s'
+    except OSError as e :
+        ok, output = False, str(e)
+    return ProbeResult(host, check, ok, output, start, time.time() - start)
+
+def cached(check, max_age = None, hosts = None) :
+    """Get the remembered results of the input check without asking the nodes
+
+    Parameters
+    ----------
+    check : str
+        Name of check (see checks)
+    max_age : float, optional
+        Maximum age in seconds of a result to use (default: probe_cache_ttl)
+    hosts : list[str], optional
+        Hosts to get results for (default: any host with a result)
+
+    Returns
+    -------
+        dict[str, ProbeResult] : results by host for the hosts with a recent enough result
+    """
+
+    if max_age is None :
+        max_age = probe_cache_ttl
+    now = time.time()
+    results = dict()
+    for host, r in _load_cache(_cache_path()).get(check, dict()).items() :
+        r = ProbeResult(*r)
+        if (hosts is None or host in hosts) and now - r.time < max_age :
+            results[host] = r
+    return results
+
+def probe(check, hosts = scorpions, transport = ssh_transport, timeout = 30, workers = 16, max_age = None) :
+    """Run the input check on all of the input hosts concurrently
+
+    Hosts with a recent enough remembered result are not asked again.
+    Results of checks that change the node (e.g. 'clean') are never re-used.
+
+    Parameters
+    ----------
+    check : str
+        Name of check (see checks)
+    hosts : list[str], optional
+        Hosts to check (default: all scorpions)
+    transport : callable, optional
+        Function taking a host and a command and returning the argument list to run it
+    timeout : float, optional
+        Maximum time in seconds to wait for each host
+    workers : int, optional
+        Number of hosts to check at once
+    max_age : float, optional
+        Maximum age in seconds of a remembered result to use (default: probe_cache_ttl), zero to always ask
+
+    Returns
+    -------
+        dict[str, ProbeResult] : results by host in the order of the input hosts
+
+    Examples
+    --------
+    >>> for host, r in probe.probe('check').items() :
+    ...     print(host, r.output)
+    """
+
+    if check not in checks :
+        raise Exception(f"Unknown check '{check}', choose from {list(checks)}.")
+
+    hosts = list(hosts)
+    results = dict()
+    if check not in _not_cached and max_age != 0 :
+        results = cached(check, max_age, hosts)
+
+    to_probe = [h for h in hosts if h not in results]
+    if len(to_probe) > 0 :
+        with ThreadPoolExecutor(max_workers = max(1, workers)) as pool :
+            for r in pool.map(lambda h : _run_check(h, check, transport, timeout), to_probe) :
+                results[r.host] = r
+
+        if check not in _not_cached :
+            # re-load in case someone else probed while we were
+            path = _cache_path()
+            cache = _load_cache(path)
+            cache.setdefault(check, dict()).update({ h : list(results[h]) for h in to_probe })
+            os.makedirs(os.path.dirname(os.path.realpath(path)), exist_ok=True)
+            tmp = f'{path}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f :
+                json.dump(cache, f)
+            os.replace(tmp, path)
+
+    return { h : results[h] for h in hosts }
+
+def bad_hosts(max_age = None) :
+    """Get the hosts whose remembered 'check' result was not good, without asking the nodes
+
+    Returns
+    -------
+        list[str] : hosts that couldn't be reached or are missing hdfs or cvmfs
+    """
+    return sorted(h for h, r in cached('check', max_age).items() if r.output != 'good')
+
+if __name__ == '__main__' :
+    parser = argparse.ArgumentParser('probe', description='Run a check on the worker nodes concurrently.')
+    parser.add_argument('check',type=str,choices=list(checks),help='Check to run.')
+    parser.add_argument('hosts',type=str,nargs='*',default=scorpions,help='Hosts to check. Default is all scorpions.')
+    parser.add_argument('--timeout',type=float,default=30,help='Maximum time in seconds to wait for each host.')
+    parser.add_argument('--workers',type=int,default=16,help='Number of hosts to check at once.')
+    parser.add_argument('--max_age',type=float,help=f'Maximum age in seconds of a remembered result to use. Default is {probe_cache_ttl}s, 0 always asks the hosts.')
+    parser.add_argument('--local',action='store_true',help='Run the check on this machine instead of on the hosts, for testing.')
+    arg = parser.parse_args()
+
+    results = probe(arg.check, arg.hosts, local_transport if arg.local else ssh_transport,
+        timeout = arg.timeout, workers = arg.workers, max_age = arg.max_age)
+    for host, r in results.items() :
+        print(f'{host} : {r.output}')
+    sys.exit(0 if all(r.ok for r in results.values()) else 1)
@@ -0,0 +1,173 @@
+"""Finding the run numbers that need to be re-run in an output directory
+
+We scan the whole output directory tree once, pull the run numbers
+out of the file names, and then use a bitmap over the range of run numbers
+so that finding the missing ones doesn't depend on how many runs there are.
+"""
+
+import re # for pulling run numbers out of file names
+import os # for path manipulation
+import statistics # for median file sizes
+from umn_htcondor import inputs
+from umn_htcondor import manifest
+
+# <other-parameters>_run_<run-number>[_<other-parameters>].root
+DEFAULT_PATTERN = r'(?:^|_)run_(?P<run>\d+)(?:_.*)?\.root$'
+
+class RefillScan :
+    """Scan of the run numbers present in an output directory
+
+    Parameters
+    ----------
+    pattern : str, optional
+        Regular expression matched against the name of each ROOT file in the output directory.
+        It must have a group named 'run' that matches the run number.
+        Default matches '<other-parameters>_run_<run-number>.root'.
+    min_size : int, optional
+        Output files smaller than this many bytes are treated as truncated.
+        Default is 1, so only zero-length files are truncated.
+    min_fraction : float, optional
+        Output files smaller than this fraction of the median size of the other output
+        files with the same name (besides the run number) are treated as truncated.
+        Default is None, so we don't compare to the median.
+    scan_threads : int, optional
+        Number of threads to use when scanning the output directory
+
+    Attributes
+    ----------
+    first : int
+        Smallest run number found (None if no runs found)
+    last : int
+        Largest run number found (None if no runs found)
+    n_files : int
+        Number of output files with a run number
+    truncated : set[int]
+        Run numbers with at least one truncated output file
+
+    Examples
+    --------
+    >>> scan = RefillScan()
+    >>> scan('/hdfs/cms/user/me/ldmx/my-production')
+    >>> print(scan.summary())
+    >>> runs_to_submit = list(scan.runs_to_refill())
+    """
+
+    def __init__(self, pattern = None, min_size = 1, min_fraction = None, scan_threads = 8) :
+        self.pattern = re.compile(DEFAULT_PATTERN if pattern is None else pattern)
+        if 'run' not in self.pattern.groupindex :
+            raise Exception(f"Refill pattern '{self.pattern.pattern}' does not have a group named 'run'.")
+        self.min_size = min_size
+        self.min_fraction = min_fraction
+        self.scan_threads = scan_threads
+        self.first = None
+        self.last = None
+        self.n_files = 0
+        self.truncated = set()
+        self.__present = bytearray()
+
+    def __call__(self, out_dir) :
+        """Scan the input output directory recursively for run numbers
+
+        The detail directory is not scanned since it only holds
+        the logs and other records of the jobs. File listings in the
+        output directory are not followed, only the ROOT files
+        that are actually there count as outputs.
+
+        Parameters
+        ----------
+        out_dir : str
+            Full path to output directory to scan
+        """
+
+        # (run, size, name with the run number taken out) for each output file
+        found = []
+        discovery = inputs.InputDiscovery(max_workers = self.scan_threads,
+            exclude = [os.path.join(out_dir, 'detail')], follow_listings = False)
+        for f in discovery([out_dir]) :
+            name = os.path.basename(f.path)
+            m = self.pattern.search(name)
+            if m is None :
+                continue
+            found.append((int(m.group('run')), f.size, name[:m.start('run')]+'#'+name[m.end('run'):]))
+
+        self._fill(found)
+
+    def from_manifest(self, the_manifest) :
+        """Fill the scan from the records in a manifest instead of scanning the output directory
+
+        Outputs whose latest copy failed are treated as truncated.
+
+        Parameters
+        ----------
+        the_manifest : manifest.Manifest
+            Manifest of the outputs copied into the output directory
+        """
+
+        found = []
+        for r in the_manifest.outputs.values() :
+            if r.run is None :
+                continue
+            size = r.size if r.status == manifest.OK else 0
+            m = self.pattern.search(r.output)
+            name = r.output if m is None else r.output[:m.start('run')]+'#'+r.output[m.end('run'):]
+            found.append((r.run, size, name))
+
+        self._fill(found)
+
+    def _fill(self, found) :
+        """Fill the bitmap of runs that are done
+
+        Parameters
+        ----------
+        found : list[tuple]
+            (run, size, name with the run number taken out) for each output file
+        """
+
+        self.n_files = len(found)
+        self.truncated = set()
+        if len(found) == 0 :
+            self.first, self.last = None, None
+            self.__present = bytearray()
+            return
+
+        min_sizes = dict()
+        if self.min_fraction is not None :
+            sizes_by_name = dict()
+            for run, size, name in found :
+                sizes_by_name.setdefault(name, []).append(size)
+            min_sizes = { name : self.min_fraction*statistics.median(sizes) for name, sizes in sizes_by_name.items() }
+
+        self.first = min(run for run, size, name in found)
+        self.last = max(run for run, size, name in found)
+        self.__present = bytearray(self.last - self.first + 1)
+        for run, size, name in found :
+            if size < self.min_size or size < min_sizes.get(name, 0) :
+                self.truncated.add(run)
+            else :
+                self.__present[run - self.first] = 1
+
+        # a run is only done if all of its output files are good
+        for run in self.truncated :
+            self.__present[run - self.first] = 0
+
+    def runs_to_refill(self) :
+        """Generate the run numbers between the first and last run found
+        that are missing or have a truncated output file
+
+        Returns
+        -------
+            generator[int] : run numbers in increasing order
+        """
+
+        i = self.__present.find(0)
+        while i != -1 :
+            yield self.first + i
+            i = self.__present.find(0, i+1)
+
+    def summary(self) :
+        """Get a one-line summary of the scan."""
+        if self.first is None :
+            return 'No run numbers found.'
+        n_refill = self.__present.count(0)
+        return (f'Found {self.n_files} output files for runs {self.first} to {self.last}, '
+                f'{n_refill} runs need to be refilled ({len(self.truncated)} truncated).')
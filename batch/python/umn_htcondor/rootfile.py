@@ -0,0 +1,133 @@
+"""Fast integrity check of ROOT files without ROOT
+
+When ROOT closes a file, it writes the location of the list of keys,
+the list of free segments, and the end of the file into the header.
+A file that was cut off while copying (or never closed) does not
+have a consistent header, so we can spot it by memory-mapping the file
+and reading only the header and the few records it points to.
+
+This module only uses the standard library so that it is cheap
+to import in many worker processes.
+
+See Also
+--------
+https://root.cern/doc/master/classTFile.html : layout of the file header
+https://root.cern/doc/master/classTKey.html : layout of the key header
+"""
+
+import mmap # for reading only the parts of the file we need
+import struct # for unpacking the big-endian records
+
+GOOD = 'good'
+EMPTY = 'empty'
+NOT_ROOT = 'not a ROOT file'
+TRUNCATED = 'truncated'
+NOT_CLOSED = 'not closed'
+CORRUPT = 'corrupt'
+UNREADABLE = 'unreadable'
+
+# "root" fVersion fBEGIN
+_begin = struct.Struct('>4sii')
+# fEND fSeekFree fNbytesFree nfree fNbytesName fUnits fCompress fSeekInfo fNbytesInfo
+_header_small = struct.Struct('>iiiiiBiii')
+_header_large = struct.Struct('>qqiiiBiqi')
+# version fDatimeC fDatimeM fNbytesKeys fNbytesName
+_directory_begin = struct.Struct('>hIIii')
+# fSeekDir fSeekParent fSeekKeys
+_directory_seeks_small = struct.Struct('>iii')
+_directory_seeks_large = struct.Struct('>qqq')
+# Nbytes Version ObjLen Datime KeyLen Cycle
+_key_begin = struct.Struct('>ihiIhh')
+# SeekKey SeekPdir
+_key_seeks_small = struct.Struct('>ii')
+_key_seeks_large = struct.Struct('>qq')
+
+def _read_key_seek(buf, offset) :
+    """Read the number of bytes and location stored in the header of the key at the input offset
+
+    Returns
+    -------
+        tuple : (Nbytes, SeekKey) of the key
+    """
+
+    n_bytes, version, obj_len, datime, key_len, cycle = _key_begin.unpack_from(buf, offset)
+    seeks = _key_seeks_large if version > 1000 else _key_seeks_small
+    seek_key, seek_pdir = seeks.unpack_from(buf, offset + _key_begin.size)
+    return n_bytes, seek_key
+
+def _check_buffer(buf, size) :
+    """Check the ROOT file contents in the input buffer, see check"""
+
+    if size < _begin.size + _header_small.size :
+        return NOT_ROOT
+    magic, version, begin = _begin.unpack_from(buf, 0)
+    if magic != b'root' :
+        return NOT_ROOT
+
+    large = version >= 1000000
+    header = _header_large if large else _header_small
+    end, seek_free, n_bytes_free, n_free, n_bytes_name, units, compress, seek_info, n_bytes_info = header.unpack_from(buf, _begin.size)
+
+    if end > size :
+        return TRUNCATED
+    if end < size :
+        return CORRUPT
+
+    # the top directory record is right after the name and title of the file
+    dir_offset = begin + n_bytes_name
+    if dir_offset + _directory_begin.size + _directory_seeks_large.size > size :
+        return CORRUPT
+    dir_version, datime_c, datime_m, n_bytes_keys, dir_n_bytes_name = _directory_begin.unpack_from(buf, dir_offset)
+    dir_seeks = _directory_seeks_large if dir_version > 1000 else _directory_seeks_small
+    seek_dir, seek_parent, seek_keys = dir_seeks.unpack_from(buf, dir_offset + _directory_begin.size)
+
+    # the list of keys, the list of free segments, and the streamer info
+    #   are all written when the file is closed
+    if seek_keys <= begin or seek_free <= begin or seek_info <= begin :
+        return NOT_CLOSED
+
+    for seek, n_bytes in [(seek_keys, n_bytes_keys), (seek_free, n_bytes_free), (seek_info, n_bytes_info)] :
+        if n_bytes <= 0 or seek + n_bytes > end :
+            return TRUNCATED
+        key_n_bytes, key_seek = _read_key_seek(buf, seek)
+        if key_seek != seek or key_n_bytes != n_bytes :
+            return CORRUPT
+
+    return GOOD
+
+def check(path) :
+    """Check that the input ROOT file was closed cleanly and is complete
+
+    Only the header of the file and the headers of the keys list,
+    free segments list, and streamer info records are read.
+    We check that the end of the file recorded in the header is the size
+    of the file and that each of these records is where the header says it is.
+
+    Parameters
+    ----------
+    path : str
+        Path to file to check
+
+    Returns
+    -------
+        str : GOOD or the reason the file is not good
+        (EMPTY, NOT_ROOT, TRUNCATED, NOT_CLOSED, CORRUPT, UNREADABLE)
+
+    Examples
+    --------
+    >>> rootfile.check('my_fancy_sample_run_0420.root')
+    'good'
+    """
+
+    try :
+        with open(path, 'rb') as f :
+            size = f.seek(0, 2)
+            if size == 0 :
+                return EMPTY
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as buf :
+                return _check_buffer(buf, size)
+    except (OSError, ValueError) :
+        return UNREADABLE
+    except struct.error :
+        # a record pointed past the end of the file
+        return TRUNCATED
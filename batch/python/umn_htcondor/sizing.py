@@ -0,0 +1,203 @@
+"""Choosing how much memory and disk to request from past usage
+
+Each submission log records a hash of the configuration the jobs ran
+(see JobInstructions.config_hash). Given the output directories of previous
+productions, we find the clusters that ran the same configuration and
+look at the peak memory and disk their jobs used (see logs.LogSummary).
+Requesting a high percentile of that usage plus some headroom instead of
+a guess lets more of our jobs fit onto each worker node.
+"""
+
+import os # for path manipulation
+import glob # for finding the submission logs
+import gzip # for reading the submission logs
+import math # for rounding up
+import hashlib # for hashing the configuration
+from umn_htcondor import logs
+
+# submission log section holding the configuration hash
+_hash_header = '== Config Hash =='
+
+# requests are rounded up to a multiple of this many MB
+_granularity = 64
+
+def config_hash(config_path = None, arguments = '') :
+    """Hash the configuration the jobs will run
+
+    Parameters
+    ----------
+    config_path : str, optional
+        Path to the configuration script, if there is one
+    arguments : str, optional
+        Arguments given to the program (and script), e.g. the number of events to simulate.
+        Differences in the spacing between arguments don't change the hash.
+
+    Returns
+    -------
+        str : hexadecimal digest identifying the configuration
+    """
+
+    h = hashlib.sha256()
+    if config_path is not None :
+        with open(config_path, 'rb') as f :
+            h.update(f.read())
+        # separate the script from the arguments
+        h.update(b'\0')
+    h.update(' '.join(arguments.split()).encode())
+    return h.hexdigest()[:16]
+
+def log_config_hash(f, the_hash) :
+    """Write the configuration hash into the submission log (assumed open)
+
+    See Also
+    --------
+    JobInstructions._log_submission : the rest of the submission log
+    """
+    f.write(f'\n{_hash_header}\n{the_hash}\n')
+
+def _logged_config_hash(submit_log) :
+    """Get the configuration hash recorded in the input submission log
+
+    Only the header of the log is read, not the list of items.
+
+    Returns
+    -------
+        str : configuration hash or None if it wasn't recorded
+    """
+
+    opener = gzip.open if submit_log.endswith('.gz') else open
+    try :
+        with opener(submit_log, 'rt') as f :
+            for line in f :
+                line = line.strip()
+                if line == _hash_header :
+                    return next(f).strip()
+                if line == '== List of Items ==' :
+                    break
+    except (OSError, EOFError, StopIteration) :
+        pass
+    return None
+
+def _percentile(values, percentile) :
+    """Get the input percentile of the values (nearest rank)"""
+    values = sorted(values)
+    rank = max(1, math.ceil(percentile/100.*len(values)))
+    return values[rank-1]
+
+def _round_up(mb) :
+    """Round the input number of MB up to the request granularity"""
+    return max(_granularity, int(math.ceil(mb/_granularity))*_granularity)
+
+class ResourceAdvisor :
+    """Suggest memory and disk requests from the usage of past jobs with the same configuration
+
+    Parameters
+    ----------
+    config_hash : str
+        Hash of the configuration the new jobs will run (see config_hash)
+    percentile : float, optional
+        Percentile of the past peak usage to request
+    headroom : float, optional
+        Factor to multiply the percentile by before requesting it
+    min_jobs : int, optional
+        Minimum number of past jobs needed before suggesting anything
+
+    Attributes
+    ----------
+    clusters : list[int]
+        Past clusters that ran the same configuration
+    memory_mb : list[int]
+        Peak memory (MB) of each past job
+    disk_kb : list[int]
+        Peak disk (KB) of each past job
+
+    Examples
+    --------
+    >>> advisor = ResourceAdvisor(config_hash('my_config.py'))
+    >>> advisor.add_output_dir('/hdfs/cms/user/me/ldmx/my-production')
+    >>> print(advisor.summary())
+    >>> advisor.memory()
+    '1536M'
+    """
+
+    def __init__(self, config_hash, percentile = 95, headroom = 1.2, min_jobs = 20) :
+        self.config_hash = config_hash
+        self.percentile = percentile
+        self.headroom = headroom
+        self.min_jobs = min_jobs
+        self.clusters = []
+        self.memory_mb = []
+        self.disk_kb = []
+
+    def add_output_dir(self, out_dir, workers = 8) :
+        """Add the usage of the jobs in the input output directory that ran the same configuration
+
+        Parameters
+        ----------
+        out_dir : str
+            Full path to a previous output directory
+        workers : int, optional
+            Number of processes to read the event logs with
+
+        Returns
+        -------
+            int : number of past jobs added
+        """
+
+        detail_dir = os.path.join(out_dir, 'detail')
+        clusters = set()
+        for submit_log in glob.glob(os.path.join(detail_dir, 'submit.*.log*')) :
+            if _logged_config_hash(submit_log) != self.config_hash :
+                continue
+            cluster = os.path.basename(submit_log).split('.')[1]
+            if cluster.isdigit() :
+                clusters.add(int(cluster))
+
+        log_dir = os.path.join(detail_dir, 'logs')
+        if len(clusters) == 0 or not os.path.isdir(log_dir) :
+            return 0
+
+        summary = logs.LogSummary(log_dir)
+        summary.update(workers)
+        n_added = 0
+        for job in summary.jobs.values() :
+            if job.cluster not in clusters :
+                continue
+            if job.peak_memory >= 0 :
+                self.memory_mb.append(job.peak_memory)
+            if job.peak_disk >= 0 :
+                self.disk_kb.append(job.peak_disk)
+            n_added += 1
+
+        self.clusters.extend(sorted(clusters))
+        return n_added
+
+    def memory(self) :
+        """Get the suggested memory request
+
+        Returns
+        -------
+            str : request in MB (e.g. '1536M') or None if there aren't enough past jobs
+        """
+        if len(self.memory_mb) < self.min_jobs :
+            return None
+        return f'{_round_up(self.headroom*_percentile(self.memory_mb, self.percentile))}M'
+
+    def disk(self) :
+        """Get the suggested disk request
+
+        Returns
+        -------
+            str : request in MB (e.g. '512M') or None if there aren't enough past jobs
+        """
+        if len(self.disk_kb) < self.min_jobs :
+            return None
+        return f'{_round_up(self.headroom*_percentile(self.disk_kb, self.percentile)/1024.)}M'
+
+    def summary(self) :
+        """Get a one-line summary of the past usage."""
+        if len(self.clusters) == 0 :
+            return 'No past clusters ran this configuration.'
+        return (f'{len(self.memory_mb)} past jobs in clusters {self.clusters} ran this configuration, '
+                f'suggest request_memory = {self.memory()} and request_disk = {self.disk()} '
+                f'({self.percentile}th percentile x {self.headroom}).')
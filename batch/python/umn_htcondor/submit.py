@@ -10,7 +10,13 @@ import os # for path joining and directory listing
 import shutil # for copying files
 import sys # for exiting after check failure
 import json # for dumping objects to log file
+import gzip # for compressing the submission log
+import itertools # for slicing the items into transactions
 from umn_htcondor import utility 
+from umn_htcondor import inputs
+from umn_htcondor import refill
+from umn_htcondor import manifest
+from umn_htcondor import sizing
 
 class JobInstructions(htcondor.Submit) :
     """Specialization of htcondor.Submit that has some helper functions for us.
@@ -40,23 +46,27 @@ class JobInstructions(htcondor.Submit) :
         Full path to output directory
     __full_detail_dir_path : str
         Full path to directory to store details of this run
-    __items_to_loop_over : list[dict]
-        List of dictionaries defining the variables condor should loop over when submitting the jobs
-    __cluster_id : int
-        ID number for cluster these job instructions were submitted as (0 if not submitted yet)
+    __items_to_loop_over : callable
+        Function returning a fresh iterator over the dictionaries defining the variables
+        condor should loop over when submitting the jobs
+    __cluster_ids : list[int]
+        ID numbers for the clusters these job instructions were submitted as (empty if not submitted yet)
 
     Warnings
     --------
     Currently, we are limited to running ~100 jobs simultaneously
     so that we don't overload the /local/ filesystem. There are 16 slots
     on each scorpion so that means we should limit ourselves to 5-6 scorpions.
+    The run scripts copy the singularity image into a cache on the scratch
+    disk of each scorpion, so only the first job on each node reads it from /local/.
+    Submitting with a throttle (see submit) keeps us around this limit for you.
     """
 
     def __init__(self,
         executable_path, output_dir, singularity_img, config,
         input_arg_name = '', extra_config_args = '', program = 'fire') :
 
-        self.__cluster_id = 0
+        self.__cluster_ids = []
         self.__full_out_dir_path = utility.full_dir(output_dir)
 
         if 'hdfs' not in self.__full_out_dir_path :
@@ -70,6 +80,11 @@ class JobInstructions(htcondor.Submit) :
         full_run_script = utility.full_file(executable_path)
         shutil.copy2(full_run_script, os.path.join(self.__full_detail_dir_path,'run.sh'))
 
+        # helpers for the run script to use on the worker nodes
+        for helper in ['node_io.py','node_io.sh'] :
+            shutil.copy2(os.path.join(os.path.dirname(os.path.realpath(__file__)),helper),
+                os.path.join(self.__full_detail_dir_path,helper))
+
         # log directory inside of detail directory
         log_dir = utility.full_dir(os.path.join(self.__full_detail_dir_path,'logs'))
 
@@ -109,14 +124,16 @@ class JobInstructions(htcondor.Submit) :
             'error'  : '$(output)',
             # Condor log file
             'log' : f'{log_dir}/$(our_job_id).log',
-            # Pass the username through the environment, so the bash script can use $USER
-            'environment' : classad.quote(f'USER={getpass.getuser()} LDMX_BASE={os.environ["LDMX_BASE"]}'),
             # Just some helpful variables to clean up the long arguments line
             'output_dir' : self.__full_out_dir_path,
             'run_script' : '$(output_dir)/detail/run.sh',
             'singularity_img' : singularity_img
           })
 
+        # Pass the username through the environment, so the bash script can use $USER
+        self.__environment = { 'USER' : getpass.getuser(), 'LDMX_BASE' : os.environ['LDMX_BASE'] }
+        self._set_environment()
+
         # we deduce the arguments to the run script by whether a configuration script was provided
         if config is None :
             # assume the container has the program and script inside it
@@ -130,11 +147,23 @@ class JobInstructions(htcondor.Submit) :
             # need to provide program and script
             self['arguments'] = f'$(run_script) $(our_job_id) $(singularity_img) $(output_dir) {program} $(conf_script) {extra_config_args} {input_arg_name}'
 
-        self['requirements'] = utility.dont_use_machine('caffeine')
-        for m in ['zebra01','zebra02','zebra03','zebra04'] :
-            self.ban_machine(m)            
+        # identifies this configuration in the submission log so that later
+        #   submissions of the same configuration can look at how these jobs ran
+        self.__config_hash = sizing.config_hash(None if config is None else full_config_path,
+            f'{program} {extra_config_args} {input_arg_name}')
+
+        # the machines the jobs can run on are kept as sets and
+        #   written into the requirements whenever they change
+        self.__allowed_machines = None
+        self.__banned_machines = set()
+        for m in ['caffeine','zebra01','zebra02','zebra03','zebra04'] :
+            self.ban_machine(m)
 
         self.__items_to_loop_over = None
+        self.__previewed_items = None
+        self.__item_args = ''
+        self.__processes_per_job = 1
+        self.__pilots = None
 
     def memory(self,max_mem_str) :
         """Set the max memory requested for these jobs
@@ -147,6 +176,60 @@ class JobInstructions(htcondor.Submit) :
 
         self['request_memory'] = max_mem_str
 
+    def config_hash(self) :
+        """Get the hash identifying the configuration these jobs run
+
+        See Also
+        --------
+        sizing.config_hash : how the hash is calculated
+        """
+        if self.__processes_per_job > 1 :
+            # jobs running several items at once use more memory and disk
+            #   than jobs of the same configuration running one item
+            return sizing.config_hash(arguments = f'{self.__config_hash} processes_per_job={self.__processes_per_job}')
+        return self.__config_hash
+
+    def size_from_history(self, out_dirs, percentile = 95, headroom = 1.2, max_memory = None, max_disk = None) :
+        """Set the memory and disk requested from the usage of past jobs with the same configuration
+
+        We look through the event logs of the clusters in the input output directories
+        that ran the same configuration as these jobs and request a high percentile of
+        their peak usage plus some headroom. If there aren't enough past jobs,
+        the requests are left as they are.
+
+        Parameters
+        ----------
+        out_dirs : list[str]
+            Previous output directories to look for past jobs in
+        percentile : float, optional
+            Percentile of the past peak usage to request
+        headroom : float, optional
+            Factor to multiply the percentile by
+        max_memory : str, optional
+            Never request more memory than this (same format as memory, MB if there is no suffix)
+        max_disk : str, optional
+            Never request more disk than this (same format as disk, KB if there is no suffix)
+
+        See Also
+        --------
+        sizing.ResourceAdvisor : how the requests are chosen
+        """
+
+        advisor = sizing.ResourceAdvisor(self.config_hash(), percentile = percentile, headroom = headroom)
+        for out_dir in out_dirs :
+            advisor.add_output_dir(utility.resolve_path(out_dir))
+        print(advisor.summary())
+
+        # condor reads a request without a suffix as MB of memory and KB of disk
+        for suggested, maximum, unit, set_request in [
+                (advisor.memory(), max_memory, 1024**2, self.memory),
+                (advisor.disk(), max_disk, 1024, self.disk)] :
+            if suggested is None :
+                continue
+            if maximum is not None and utility.parse_size(suggested) > utility.parse_size(maximum, unit) :
+                suggested = maximum
+            set_request(suggested)
+
     def disk(self, max_disk_str) :
         """Set the maximum amount of disk space requested for these jobs
 
@@ -194,22 +277,218 @@ class JobInstructions(htcondor.Submit) :
     def ban_machine(self,m) :
         """Don't allow the jobs to run on the input machine.
 
-        We assume that there is already at least one
-        requirement defined, so the first requirement
-        will need to be defined in the constructor.
+        Banned machines are avoided even if they are
+        also requested with use_machine.
+
+        See Also
+        --------
+        utility.machine_requirements : how the requirements are written
         """
 
-        self['requirements'] = classad.ExprTree(self['requirements']).and_(utility.dont_use_machine(m))
+        self.__banned_machines.add(m)
+        self['requirements'] = utility.machine_requirements(self.__allowed_machines, self.__banned_machines)
 
     def use_machine(self,m) :
         """Specifically request that the jobs run on the input machine.
 
-        We assume that the other requires should be logical or'd with
-        this requirement so that multiple calls to this function specify
-        a list of machine to use.
+        Multiple calls to this function specify a list of machines to use,
+        the jobs will not run on any machine that isn't in this list.
+
+        See Also
+        --------
+        utility.machine_requirements : how the requirements are written
+        """
+
+        if self.__allowed_machines is None :
+            self.__allowed_machines = set()
+        self.__allowed_machines.add(m)
+        self['requirements'] = utility.machine_requirements(self.__allowed_machines, self.__banned_machines)
+
+    def ban_unhealthy_machines(self, log_dirs = [], min_held = 3., max_held_fraction = 0.5) :
+        """Ban the machines that have recently been holding too many of our jobs from these jobs
+
+        Takes the same parameters and returns the same list as
+        manage.ban_unhealthy_machines, which does this for jobs already submitted.
+
+        See Also
+        --------
+        manage.ban_unhealthy_machines : what the parameters mean
+        health.unhealthy_machines : how the machines to ban are chosen
+        """
+
+        from umn_htcondor import health
+        bans = health.unhealthy_machines(log_dirs, min_held, max_held_fraction)
+        for m in bans :
+            self.ban_machine(m)
+        return bans
+
+    def _set_environment(self) :
+        """Write the environment variables we are passing to the run script"""
+        self['environment'] = classad.quote(' '.join(f'{k}={v}' for k, v in self.__environment.items()))
+
+    def stage_inputs(self, max_size = '100G') :
+        """Have the jobs read their input files through a cache on the scratch disk of each node
+
+        The input files are copied from hdfs into the cache the first time a job on
+        that node needs them, so other jobs on the same node (or later passes over the
+        same inputs) don't pull them over the network again. The least recently used
+        files are removed once the cache would be larger than max_size.
+
+        Parameters
+        ----------
+        max_size : str, optional
+            Maximum size of the cache on each node (same 'K', 'M', 'G' suffixes as memory)
+
+        See Also
+        --------
+        node_io.InputCache : how the cache works on the node
+        """
+        self.__environment['LDMX_STAGE_INPUTS'] = max_size
+        self._set_environment()
+
+    def processes_per_job(self, n) :
+        """Run n items at once in each job instead of one
+
+        Each job requests n CPUs and is given n of the items (run numbers or groups
+        of input files) separated by '::' in its arguments. The run script starts the
+        container once and runs all n items in it at the same time, each in its own
+        sub-directory, copying the outputs of each item as soon as it finishes. This saves
+        starting the container, setting up the scratch area, and waiting in the queue
+        for every item.
+
+        The memory and disk requested are for the whole job, so they should be enough
+        for n items at once. These jobs are sized from past jobs that ran the same
+        number of items at once, so call this before size_from_history.
+
+        Parameters
+        ----------
+        n : int
+            Number of items to run at once in each job
+        """
+
+        if n < 1 :
+            raise Exception(f'Need at least one process per job, not {n}.')
+        if self.__pilots is not None :
+            raise Exception('Pilots run one item at a time.')
+        self['request_cpus'] = str(n)
+        self.__processes_per_job = n
+
+    def _grouped_items(items, n) :
+        """Combine each n items into one item, each value starting with '::' to separate them
+
+        For example, the run numbers {'run_number' : '1'} and {'run_number' : '2'}
+        become {'run_number' : ':: 1 :: 2'}.
         """
 
-        self['requirements'] = classad.ExprTree(self['requirements']).or_(utility.use_machine(m))
+        while True :
+            group = list(itertools.islice(items, n))
+            if len(group) == 0 :
+                return
+            if len(group[0]) != 1 :
+                raise Exception('Can only run several items in one job when each item has one variable.')
+            yield { k : ' '.join(f':: {item[k]}' for item in group) for k in group[0] }
+
+    def _items(self) :
+        """Get a fresh iterator over the items each job is given
+
+        If the items were just previewed (see _check), we continue with the
+        iterator the preview started instead of making the items again
+        (e.g. scanning the input directories a second time).
+        """
+
+        if self.__previewed_items is not None :
+            items, self.__previewed_items = self.__previewed_items, None
+            return items
+
+        items = self.__items_to_loop_over()
+        if self.__processes_per_job > 1 :
+            items = JobInstructions._grouped_items(items, self.__processes_per_job)
+        return items
+
+    def pilots(self, n, queue = None, lease = 3600, max_attempts = 3, max_time = None) :
+        """Run the items through n pilot jobs pulling them from a work queue
+
+        Instead of one job for each item, the items are put into a SQLite work queue
+        when submitting and n pilot jobs are submitted. Each pilot runs the run script
+        for one item after another until the queue is empty, so waiting in the queue and
+        setting up the node are paid once per pilot instead of once per item.
+        This is helpful when each item only takes a few minutes.
+
+        The items need to be defined (e.g. with run_numbers) before the pilots.
+        Submitting again with the same queue adds the items to it.
+
+        Parameters
+        ----------
+        n : int
+            Number of pilot jobs to submit
+        queue : str, optional
+            SQLite file holding the work queue, it needs to be on a filesystem that the worker
+            nodes see and that supports locking files (hdfs doesn't), default is a file named
+            after the output directory in 'work_queues' of our local directory
+        lease : float, optional
+            Time in seconds a pilot has to finish an item (it is renewed while the item is running)
+            before another pilot can claim the item
+        max_attempts : int, optional
+            Maximum number of times to attempt an item
+        max_time : float, optional
+            Pilots stop claiming items after running for this many seconds
+
+        See Also
+        --------
+        pilot.WorkQueue : how the items are claimed and completed
+        pilot.run_pilot : what each pilot does
+        pilot.check_queue : how the location of the queue is checked
+        """
+
+        if self.__items_to_loop_over is None :
+            raise Exception('Need to define how these jobs should run before the pilots.')
+        if self.__processes_per_job > 1 :
+            raise Exception('Pilots run one item at a time.')
+
+        if queue is None :
+            queue = os.path.join(utility.local_dir(), 'work_queues',
+                self.__full_out_dir_path.strip('/').replace('/','_')+'.db')
+        queue = os.path.join(utility.full_dir(os.path.dirname(queue)), os.path.basename(queue))
+
+        # fail here rather than after the pilots are submitted
+        from umn_htcondor.pilot import check_queue
+        check_queue(queue)
+        self.__pilots = (n, queue)
+
+        # the pilots run from the detail directory like the run script
+        shutil.copy2(os.path.join(os.path.dirname(os.path.realpath(__file__)),'pilot.py'),
+            os.path.join(self.__full_detail_dir_path,'pilot.py'))
+
+        # the pilot gives the run script its arguments with the job ID and the item changed for each item
+        run_script_args = '$(run_script) $(our_job_id) '
+        arguments = self['arguments']
+        if not arguments.startswith(run_script_args) or not arguments.endswith(self.__item_args) :
+            raise Exception(f'Unable to run {arguments} through pilots.')
+        arguments = arguments[len(run_script_args):len(arguments)-len(self.__item_args)]
+
+        options = f'--lease {lease} --max_attempts {max_attempts}'
+        if max_time is not None :
+            options += f' --max_time {max_time}'
+        self['executable'] = '/usr/bin/python3'
+        self['arguments'] = f'$(output_dir)/detail/pilot.py run {queue} $(our_job_id) $(run_script) {options} -- {arguments}'
+
+    def _fill_work_queue(self) :
+        """Put the items into the work queue of the pilots
+
+        Returns
+        -------
+            int : number of items added to the queue
+        """
+
+        from umn_htcondor.pilot import WorkQueue
+        n, queue = self.__pilots
+        work_queue = WorkQueue(queue)
+        try :
+            added = work_queue.fill(' '.join(item.values()) for item in self._items())
+            print(f'Added {added} items to {queue}. {work_queue.summary()}')
+        finally :
+            work_queue.close()
+        return added
 
     def sleep(self,time) :
         """Sleep for the input number of seconds between starting jobs.
@@ -242,6 +521,10 @@ class JobInstructions(htcondor.Submit) :
         117       | Output directory can't be seen on worker node (probably disconnected from hdfs during running)
         118       | Output file failed to cp to destination or copy of file did not match original
 
+        When running several items in each job (see processes_per_job), the job exits
+        with the largest code of its items, so a job is released if the outputs of any
+        of its items failed to copy (even if another item failed to run).
+
         See Also
         --------
         ban_machine : Banning machines before submitting jobs
@@ -264,17 +547,30 @@ class JobInstructions(htcondor.Submit) :
         ----------
         add_args : str
             Argument string to add to 'arguments' parameter
-        items : list[dict]
+        items : list[dict] or callable
             List of dictionary "items" that will be looped over for the jobs
+            or a function returning a fresh iterator over these items.
+            Using a function (e.g. one returning a generator) means the items
+            are only made as they are being submitted and are never all in memory at once.
         """
 
         self['arguments'] += add_args
-        self.__items_to_loop_over = items
+        self.__item_args = add_args
+        if callable(items) :
+            self.__items_to_loop_over = items
+        else :
+            self.__items_to_loop_over = lambda : iter(items)
 
-    def run_over_input_dirs(self, input_dirs, num_files_per_job, recursive = True) :
-        """Have the config script run over num_files_per_job files taken from input_dirs, generating jobs
+    def run_over_input_dirs(self, input_dirs, num_files_per_job, recursive = True, scan_threads = 8, catalog = True,
+            bytes_per_job = None, events_per_job = None) :
+        """Have the config script run over groups of files taken from input_dirs, generating jobs
         until all of the files in input_dirs are included.
 
+        By default, each job gets num_files_per_job files. Since the sizes of the input
+        files can vary a lot, we can instead balance the groups of files by their total size
+        or by their total number of events so that there aren't a few jobs that take much longer
+        than the rest.
+
         Parameters
         ----------
         input_dirs : list of str
@@ -283,63 +579,81 @@ class JobInstructions(htcondor.Submit) :
             Number of files for each job to have (maximum, could be less)
         recursive : bool
             True if we should recursively search for root and list files in the supplied directories
+        scan_threads : int, optional
+            Number of threads to use when scanning the input directories
+        catalog : bool or str, optional
+            True to re-use unchanged directory listings from the default input catalog,
+            a path to use a specific catalog file, or False to list every directory again
+        bytes_per_job : int, optional
+            Balance the groups of files so that each job has about this many bytes of input
+        events_per_job : int, optional
+            Balance the groups of files so that each job has about this many events of input.
+            The number of events in a file is only known if it is given in a file listing,
+            we fall back to num_files_per_job if no files have a known number of events.
+
+        See Also
+        --------
+        inputs.InputDiscovery : how the input files are found
+        inputs.InputCatalog : how directory listings are remembered between submissions
+        inputs.partition_by_weight : how the groups of files are balanced
         """
 
         if self.__items_to_loop_over is not None :
             raise Exception('Already defined how these jobs should run.')
 
-        def smart_recursive_input(file_or_dir) :
-            """Recursively add the full path to the file or files in the input directory"""
-            full_list = []
-            if isinstance(file_or_dir,list) :
-                for entry in file_or_dir :
-                    full_list.extend(smart_recursive_input(entry))
-            elif os.path.isfile(file_or_dir) and file_or_dir.endswith('.root') :
-                full_list.append(os.path.realpath(file_or_dir))
-            elif os.path.isfile(file_or_dir) and file_or_dir.endswith('.list') :
-                with open(file_or_dir) as listing :
-                    file_listing = listing.readlines()
-        
-                full_list.extend(smart_recursive_input([f.strip() for f in file_listing]))
-            elif os.path.isdir(utility.full_dir(file_or_dir)) :
-                d = utility.full_dir(file_or_dir)
-                full_list.extend(smart_recursive_input([os.path.join(d,f) for f in os.listdir(d)]))
-            else :
-                print(f"'{file_or_dir}' is not a ROOT file, a directory, or a list of files. Skipping.")
-            #file or directory
-            return full_list
-
-        if recursive :
-            input_file_list = smart_recursive_input(input_dirs)
+        if bytes_per_job is not None and events_per_job is not None :
+            raise Exception('Can only balance jobs by bytes or by events, not both.')
+
+        def discover() :
+            the_catalog = None
+            if catalog :
+                the_catalog = inputs.InputCatalog(None if catalog is True else catalog)
+
+            discovery = inputs.InputDiscovery(recursive = recursive, max_workers = scan_threads, catalog = the_catalog)
+
+            try :
+                # we generate the dictionaries that htcondor submission will loop over
+                #   we partition the input files into groups and give each group as a space separated list
+                if bytes_per_job is not None :
+                    groups = inputs.partition_by_weight(discovery(input_dirs), bytes_per_job, lambda f : f.size)
+                elif events_per_job is not None :
+                    files = list(discovery(input_dirs))
+                    n_events = inputs.events_estimator(files)
+                    if n_events is None :
+                        print(f'No input files have a known number of events, using {num_files_per_job} files per job.')
+                        groups = inputs.partition_by_count(files, num_files_per_job)
+                    else :
+                        groups = inputs.partition_by_weight(files, events_per_job, n_events)
+                else :
+                    groups = inputs.partition_by_count(discovery(input_dirs), num_files_per_job)
+
+                for g in groups :
+                    yield {'input_files' : ' '.join(f.path for f in g)}
+            finally :
+                if the_catalog is not None :
+                    the_catalog.close()
+
+            print(discovery.summary())
+
+        if bytes_per_job is None and events_per_job is None :
+            # the groups are made as the files are found, so jobs are submitted while
+            #   we are still scanning and we never hold the full list of files
+            #   the input directories are scanned again each time the items are looped over
+            self.run_over(' $(input_files)', discover)
         else :
-            input_file_list = []
-            for d in [utility.full_dir(d) for d in input_dirs] :
-                input_file_list.extend([os.path.realpath(os.path.join(d,f)) for f in os.listdir(d)])
-    
-        # we need to define a list of dictionaries that htcondor submission will loop over
-        #   we partition the list of input files into space separate lists of maximum length arg.files_per_job
-        def partition(l, n) :
-            chunks = []
-            for i in range(0,len(l),n):
-                space_sep = ''
-                for p in l[i:i+n] :
-                    space_sep += f'{p} '
-                #loop over sub list
-                chunks.append(space_sep) 
-            #loop over full list
-            return chunks
-        #end def of partition
-        
-        self.run_over(' $(input_files)', [{'input_files' : i} for i in partition(input_file_list, num_files_per_job)])
+            # balancing the groups needs all of the files at once
+            self.run_over(' $(input_files)', list(discover()))
 
-    def run_refill(self) :
+    def run_refill(self, pattern = None, min_size = 1, min_fraction = None, scan_threads = 8, use_manifest = False) :
         """Get missing run numbers from output directory and submit those.
 
         We determine the run numbers to submit by looking through the output directory
-        for any run numbers that are missing between the minimum and maximum run number.
+        (and its sub-directories) for any run numbers that are missing between the
+        minimum and maximum run number. Run numbers whose output file is present
+        but truncated (e.g. zero-length) are submitted again as well.
 
         Run numbers are determined from the file names.
-        The file names must match the following form:
+        By default, the file names must match the following form:
 
             <other-parameters>_run_<run-number>.root
 
@@ -351,30 +665,52 @@ class JobInstructions(htcondor.Submit) :
 
             my_fancy_sample_run0420.root
 
-        would just be skipped and
+        would just be skipped. A different form can be given as a regular
+        expression with a group named 'run' matching the run number.
 
-            my_fancy_sample_0420_run.root
+        Parameters
+        ----------
+        pattern : str, optional
+            Regular expression matching the output file names
+        min_size : int, optional
+            Output files smaller than this many bytes are truncated
+        min_fraction : float, optional
+            Output files smaller than this fraction of the median size of similar output files are truncated
+        scan_threads : int, optional
+            Number of threads to use when scanning the output directory
+        use_manifest : bool, optional
+            Use the manifests written by the jobs into the detail directory
+            instead of scanning the output directory. Outputs whose last copy
+            failed are submitted again. If any runs don't have records
+            (e.g. their jobs couldn't write a manifest), we scan the output directory instead.
 
-        would cause the python to error-out.
+        See Also
+        --------
+        refill.RefillScan : how the run numbers are found
+        manifest.Manifest : the records of the outputs copied by the jobs
         """
 
         if self.__items_to_loop_over is not None :
             raise Exception('Already defined how these jobs should run.')
 
-        runs = []
-        for f in os.listdir(self.__full_out_dir_path) :
-            parameters = f[:-5].split('_')
-            if 'run' in parameters :
-                runs.append(int(parameters[parameters.index('run')+1]))
-            #end if run is in parameter list
-        #end loop over directory
+        scan = refill.RefillScan(pattern, min_size = min_size, min_fraction = min_fraction, scan_threads = scan_threads)
+        if use_manifest :
+            the_manifest = manifest.Manifest(self.__full_detail_dir_path)
+            print(the_manifest.summary())
+            n_unrecorded = sum(1 for r in the_manifest.unrecorded_runs())
+            if len(the_manifest.outputs) == 0 or n_unrecorded > 0 :
+                print(f'{n_unrecorded} runs have no records in the manifests, scanning the output directory instead.')
+                use_manifest = False
+            else :
+                scan.from_manifest(the_manifest)
+        if not use_manifest :
+            scan(self.__full_out_dir_path)
+        print(scan.summary())
 
-        if len(runs) == 0 :
+        if scan.first is None :
             raise Exception('No run numbers listed in output directory. Cant refill!')
 
-        runs.sort()
-
-        self.run_over(' $(run_number)',[{'run_number':str(r)} for r in range(runs[0],runs[-1]+1) if r not in runs])
+        self.run_over(' $(run_number)', lambda : ({'run_number' : str(r)} for r in scan.runs_to_refill()))
 
     def run_numbers(self, start, number):
         """Run over iterated run numbers
@@ -393,7 +729,7 @@ class JobInstructions(htcondor.Submit) :
         if self.__items_to_loop_over is not None :
             raise Exception('Already defined how these jobs should run.')
 
-        self.run_over(' $(run_number)',[{'run_number' : str(r)} for r in range(start, start+number)])
+        self.run_over(' $(run_number)', lambda : ({'run_number' : str(r)} for r in range(start, start+number)))
 
     def _pause_before(next_thing) :
         """Pause before the next thing and allow the user the option to exit the script."""
@@ -409,17 +745,44 @@ class JobInstructions(htcondor.Submit) :
         """Return a printed version of this object using htcondor.Submit.__str__"""
         return super().__str__()
 
-    def _check(self) :
-        """Print configuration to screen and pause for confirmation."""
+    def _check(self, n_preview = 10) :
+        """Print configuration to screen and pause for confirmation.
+
+        Only the first n_preview items in the Queue-ing list are printed.
+        """
 
         print(self)
         if not JobInstructions._pause_before('see Queue-ing list') : return False
-        print(self.__items_to_loop_over)
+        items = self._items()
+        preview = list(itertools.islice(items, n_preview+1))
+        for item in preview[:n_preview] :
+            print(item)
+        if len(preview) > n_preview :
+            print('...')
+        # submitting picks up where the preview stopped
+        self.__previewed_items = itertools.chain(preview, items)
         return True
 
+    def clusters(self) :
+        """Get the list of cluster IDs these job instructions were submitted as."""
+        return list(self.__cluster_ids)
+
+    def _logged_items(items, f) :
+        """Generate the input items while writing each one to the input file (assumed open)
+
+        The items are written as one JSON object per line.
+        """
+
+        for item in items :
+            f.write(json.dumps(item)+'\n')
+            yield item
+
     def _log_submission(self, f) :
         """Log the job configurations to the input file (assumed open)
 
+        This does not include the list of items, which are logged
+        as they are submitted using _logged_items.
+
         Parameters
         ----------
         f : file
@@ -428,6 +791,7 @@ class JobInstructions(htcondor.Submit) :
 
         f.write("== Condor Configuration ==\n")
         print(self, file=f)
+        sizing.log_config_hash(f, self.config_hash())
         f.write("\n== Run Script ==\n")
         with open(self.__full_detail_dir_path+'/run.sh') as rs :
             f.write(rs.read())
@@ -436,28 +800,78 @@ class JobInstructions(htcondor.Submit) :
             with open(self.__full_detail_dir_path+'/script.py') as conf :
                 f.write(conf.read())
         f.write("\n== List of Items ==\n")
-        f.write(json.dumps(self.__items_to_loop_over,indent=1))
 
-    def submit(self) :
-        """Actually submit the job instructions to the batch system."""
-        schedd = htcondor.Schedd()
-        with schedd.transaction() as txn :
-            submit_result = self.queue_with_itemdata(txn, itemdata=iter(self.__items_to_loop_over))
-            self.__cluster_id = submit_result.cluster()
-            print(f'Submitted to Cluster {self.__cluster_id}')
+    def submit(self, max_per_transaction = None, throttle = None) :
+        """Actually submit the job instructions to the batch system.
 
-        with open(f'{self.__full_detail_dir_path}/submit.{self.__cluster_id}.log','w') as log :
-            self._log_submission(log)
+        The items are written to a compressed submission log 'submit.<cluster>.log.gz'
+        in the detail directory.
 
-    def submit_interactive(self) :
+        Very large submissions can be split into several transactions with the schedd
+        so that no single transaction takes too long. Each transaction creates its own
+        cluster with its own submission log. The items for a transaction are made
+        (e.g. by scanning the input directories) before it is opened, so the schedd
+        isn't kept waiting on them.
+
+        Parameters
+        ----------
+        max_per_transaction : int, optional
+            Maximum number of jobs to submit in a single transaction, at least one (default: no limit)
+        throttle : int, optional
+            Submit the jobs on hold and release them so that about this many are
+            idle or running at once, adjusting that number as the jobs run
+            (see throttle.Throttle). This only returns once all of the jobs are released.
+        """
+
+        if max_per_transaction is not None and max_per_transaction < 1 :
+            raise Exception(f'Need to submit at least one job in each transaction, not {max_per_transaction}.')
+
+        if throttle is not None :
+            self['hold'] = True
+
+        schedd = htcondor.Schedd()
+        if self.__pilots is None :
+            items = self._items()
+        else :
+            if self._fill_work_queue() == 0 :
+                return
+            items = iter([{'pilot' : str(i)} for i in range(self.__pilots[0])])
+        while True :
+            chunk = list(items if max_per_transaction is None else itertools.islice(items, max_per_transaction))
+            if len(chunk) == 0 :
+                break
+
+            # we don't know the cluster ID until the transaction is done,
+            #   so we write the log to a temporary name and move it afterwards
+            pending_log = f'{self.__full_detail_dir_path}/submit.pending.{os.getpid()}.log.gz'
+            try :
+                with gzip.open(pending_log,'wt') as log :
+                    self._log_submission(log)
+                    with schedd.transaction() as txn :
+                        submit_result = self.queue_with_itemdata(txn, itemdata=JobInstructions._logged_items(chunk, log))
+                        cluster_id = submit_result.cluster()
+            except :
+                if os.path.isfile(pending_log) :
+                    os.remove(pending_log)
+                raise
+
+            os.rename(pending_log, f'{self.__full_detail_dir_path}/submit.{cluster_id}.log.gz')
+            self.__cluster_ids.append(cluster_id)
+            print(f'Submitted to Cluster {cluster_id}')
+
+        if throttle is not None and len(self.__cluster_ids) > 0 :
+            from umn_htcondor.throttle import Throttle
+            Throttle(self.__cluster_ids, target = throttle).run()
+
+    def submit_interactive(self, max_per_transaction = None, throttle = None) :
         """Submit to the batch system while checking with the user along the way"""
 
         if not self._check() : return
         if not JobInstructions._pause_before('submit') : return
 
-        self.submit()
+        self.submit(max_per_transaction, throttle)
 
         if JobInstructions._pause_before('watch jobs') :
             from umn_htcondor import manage
-            manage.watch_q()
+            manage.watch_q(log_dir = os.path.join(self.__full_detail_dir_path,'logs'), clusters = self.__cluster_ids)
     
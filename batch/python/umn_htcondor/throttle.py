@@ -0,0 +1,182 @@
+"""Dripping submitted jobs into the queue at a rate the filesystems can handle
+
+The jobs are submitted on hold and we release a few at a time so that
+a target number of them are idle or running. The target grows slowly while
+the jobs are running fine and is cut in half when the jobs start failing to
+copy their outputs (exit codes 117 and 118) or start taking much longer than
+they used to, both of which mean the shared filesystem is overloaded.
+"""
+
+import htcondor #HTCondor Python API
+import classad #htcondor internal data structure
+import statistics #for median job durations
+import sys #for sys.stdout
+import time #for sleep
+from umn_htcondor import manage
+
+# hold reason code of jobs that were submitted on hold
+_submitted_on_hold = 15
+
+# exit codes of run.sh when copying the output files failed
+_copy_failures = [117, 118]
+
+class Throttle :
+    """Release held-on-submit jobs so that a target number of jobs are in flight
+
+    The target is adjusted with an additive increase and multiplicative decrease:
+    while all of the released jobs are in flight without trouble, the target goes up
+    by a few jobs each period; when new copy failures are seen (or jobs are
+    finishing much slower than the first jobs did), the target is multiplied by
+    the decrease factor. After a decrease, we wait a cooldown before decreasing
+    again so that the failures of jobs that were already running don't count twice.
+
+    Parameters
+    ----------
+    clusters : list[int]
+        Clusters of jobs that were submitted on hold
+    target : int, optional
+        Number of jobs to have idle or running to start with
+    min_target : int, optional
+        Never lower the target below this
+    max_target : int, optional
+        Never raise the target above this (default: no limit)
+    increase : int, optional
+        Number of jobs to add to the target each period the jobs are running fine
+    decrease : float, optional
+        Factor to multiply the target by when the filesystem seems overloaded
+    slowdown : float, optional
+        Jobs are finishing too slowly if the median duration of the recent ones
+        is this many times the median duration of the first ones
+    cooldown : float, optional
+        Minimum time in seconds between decreases of the target
+    n_durations : int, optional
+        Number of finished jobs used to measure the first and recent durations
+
+    Attributes
+    ----------
+    target : int
+        Current number of jobs we want idle or running
+    n_waiting : int
+        Number of jobs still held from submission after the last step
+    n_failed : int
+        Number of copy failures seen so far
+
+    Examples
+    --------
+    >>> throttle = Throttle(job_instructions.clusters(), target = 100)
+    >>> throttle.run()
+    """
+
+    def __init__(self, clusters, target = 100, min_target = 16, max_target = None,
+            increase = 4, decrease = 0.5, slowdown = 1.5, cooldown = 300, n_durations = 20) :
+        self.clusters = list(clusters)
+        self.target = target
+        self.min_target = min_target
+        self.max_target = max_target
+        self.increase = increase
+        self.decrease = decrease
+        self.slowdown = slowdown
+        self.cooldown = cooldown
+        self.n_durations = n_durations
+        self.n_waiting = None
+        self.n_failed = 0
+        self.__failed = set()
+        # (cluster, proc) -> time the job started running
+        self.__running = dict()
+        self.__durations = []
+        self.__last_decrease = 0
+
+    def _constraint(self) :
+        """Constraint selecting the jobs in our clusters"""
+        return classad.ExprTree(f'member(ClusterId, {{{",".join(str(c) for c in self.clusters)}}})')
+
+    def _slowing_down(self) :
+        """Are the recent jobs finishing much slower than the first jobs did?"""
+        if len(self.__durations) < 2*self.n_durations :
+            return False
+        first = statistics.median(self.__durations[:self.n_durations])
+        recent = statistics.median(self.__durations[-self.n_durations:])
+        return recent > self.slowdown*first
+
+    def step(self) :
+        """Look at the jobs once, adjust the target, and release jobs to meet it
+
+        Returns
+        -------
+            int : number of jobs released
+        """
+
+        now = time.time()
+        waiting = []
+        in_flight = 0
+        new_failures = 0
+        present = set()
+        running = dict()
+        jobs = manage._my_q(self._constraint(),
+            ['ClusterId','ProcId','JobStatus','HoldReasonCode','HoldReasonSubCode','EnteredCurrentStatus'], max_age = 0)
+        for j in jobs :
+            job = (j['ClusterId'], j['ProcId'])
+            present.add(job)
+            status = j['JobStatus']
+            if status == htcondor.JobStatus.HELD :
+                if j.get('HoldReasonCode') == _submitted_on_hold :
+                    waiting.append(job)
+                elif j.get('HoldReasonSubCode') in _copy_failures and job not in self.__failed :
+                    self.__failed.add(job)
+                    new_failures += 1
+            elif status == htcondor.JobStatus.RUNNING :
+                in_flight += 1
+                running[job] = self.__running.get(job, j.get('EnteredCurrentStatus', now))
+            elif status == htcondor.JobStatus.IDLE :
+                in_flight += 1
+        #end loop over jobs
+
+        # jobs that were running and have left the queue finished successfully
+        for job, start in self.__running.items() :
+            if job not in present :
+                self.__durations.append(now - start)
+        self.__running = running
+        self.n_failed += new_failures
+
+        if (new_failures > 0 or self._slowing_down()) and now - self.__last_decrease > self.cooldown :
+            self.target = max(self.min_target, int(self.target*self.decrease))
+            self.__last_decrease = now
+        elif in_flight >= self.target and len(waiting) > 0 :
+            self.target += self.increase
+            if self.max_target is not None :
+                self.target = min(self.max_target, self.target)
+
+        to_release = sorted(waiting)[:max(0, self.target - in_flight)]
+        if len(to_release) > 0 :
+            htcondor.Schedd().act(htcondor.JobAction.Release, [f'{c}.{p}' for c, p in to_release])
+            manage._clear_q_cache()
+
+        self.n_waiting = len(waiting) - len(to_release)
+        return len(to_release)
+
+    def run(self, period = 30) :
+        """Keep releasing jobs until none are left held from submission
+
+        End this function early with a KeyboardInterrupt (ctrl-C),
+        the jobs that haven't been released yet stay held.
+
+        Parameters
+        ----------
+        period : float, optional
+            Time in seconds between looking at the jobs
+        """
+
+        sys.stdout.write(' TARGET WAITING FAILED\n')
+        while True :
+            try :
+                self.step()
+                sys.stdout.write(f' {self.target:6} {self.n_waiting:7} {self.n_failed:6} {time.ctime()}\r')
+                sys.stdout.flush()
+                if self.n_waiting == 0 :
+                    break
+                time.sleep(period)
+            except KeyboardInterrupt :
+                break
+        sys.stdout.write('\n')
+        if self.n_waiting :
+            print(f'{self.n_waiting} jobs are still held, release them with manage.release_me() or run the throttle again.')
@@ -4,6 +4,7 @@ import htcondor #HTCondor Python API
 import classad #HTCondor internal data structure
 import os #full paths and directory making
 import getpass #user name
+import re #parsing requirements expressions
 
 def hdfs_dir() :
     """Get the current users ldmx directory in hdfs"""
@@ -22,6 +23,17 @@ def check_exists(path) :
     if not os.path.exists(path) :
         raise Exception("'%s' does not exist."%path)
 
+def resolve_path(path) :
+    """Get the full path to the input path without touching it.
+
+    Paths that are not absolute are assumed to be
+    relative to your hdfs directory.
+    """
+
+    if not path.startswith('/') :
+        path = hdfs_dir()+'/'+path
+    return os.path.realpath(path)
+
 def full_dir(path, make=True) :
     """Get the full path to the input directory
     and (maybe) create it if it doesn't exist.
@@ -30,9 +42,7 @@ def full_dir(path, make=True) :
     completely exit the script.
     """
 
-    if not path.startswith('/') :
-        path = hdfs_dir()+'/'+path
-    full_path = os.path.realpath(path)
+    full_path = resolve_path(path)
     if make :
         os.makedirs(full_path, exist_ok=True)
     check_exists(full_path)
@@ -48,12 +58,32 @@ def full_file(path) :
     check_exists(full_path)
     return full_path
 
+def parse_size(size_str, unit = 1) :
+    """Get the number of bytes from a size string
+
+    Allows the same 'K', 'M', 'G' suffixes (powers of 1024)
+    that we use for requesting memory and disk from condor.
+    A size without a suffix is in the input unit, condor reads
+    these as MB for memory (unit = 1024**2) and KB for disk (unit = 1024).
+
+    >>> parse_size('2G')
+    2147483648
+    >>> parse_size('2048', unit = 1024**2)
+    2147483648
+    """
+
+    multipliers = { 'K' : 1024, 'M' : 1024**2, 'G' : 1024**3, 'T' : 1024**4 }
+    size_str = str(size_str).strip().upper().rstrip('B')
+    if size_str and size_str[-1] in multipliers :
+        return int(float(size_str[:-1])*multipliers[size_str[-1]])
+    return int(float(size_str)*unit)
+
 def get_umn_host_name(full_machine_name) :
     """Get the UMN Host name from the full computer name
 
     Removes the slot number and the URL '.spa.umn.edu'
     """
-    return full_machine_name.split('@')[1][:-12]
+    return short_machine_name(full_machine_name.split('@')[1])
 
 def dont_use_machine(m) :
     """Don't use the input SPA machine for jobs."""
@@ -63,6 +93,115 @@ def use_machine(m) :
     """Specify the input SPA machine to be used for jobs."""
     return classad.Attribute('Machine') == f'{m}.spa.umn.edu'
 
+def _full_machine_name(m) :
+    """Get the full name of the input SPA machine (with the URL)"""
+    return m if m.endswith('.spa.umn.edu') else f'{m}.spa.umn.edu'
+
+def short_machine_name(m) :
+    """Get the name of the input SPA machine without the URL"""
+    return m[:-12] if m.endswith('.spa.umn.edu') else m
+
+def machine_requirements(allowed = None, banned = ()) :
+    """Requirements expression allowing and banning sets of SPA machines
+
+    Instead of chaining one comparison for each machine, each set of machines
+    is checked with a single stringListMember call. This keeps the expression
+    flat (and cheap for the negotiator to evaluate) no matter how many machines
+    are listed.
+
+    Parameters
+    ----------
+    allowed : iterable[str], optional
+        Machines the jobs are allowed to run on (None means any machine)
+    banned : iterable[str], optional
+        Machines the jobs are not allowed to run on
+
+    Examples
+    --------
+    >>> machine_requirements(banned = ['scorpion3','scorpion4'])
+    !stringListMember(Machine,"scorpion3.spa.umn.edu,scorpion4.spa.umn.edu")
+    """
+
+    terms = []
+    if allowed is not None :
+        allowed_list = ','.join(sorted(_full_machine_name(m) for m in allowed))
+        terms.append(f'stringListMember(Machine,"{allowed_list}")')
+    if banned :
+        banned_list = ','.join(sorted(_full_machine_name(m) for m in banned))
+        terms.append(f'!stringListMember(Machine,"{banned_list}")')
+    if len(terms) == 0 :
+        return classad.ExprTree('true')
+    return classad.ExprTree(' && '.join(terms))
+
+_machine_list_member = re.compile(r'(!?)\s*stringListMember\(\s*Machine\s*,\s*"([^"]*)"\s*\)', re.IGNORECASE)
+
+def _machine_list(names) :
+    """Get the set of machine names without the URL from a comma-separated list"""
+    return { short_machine_name(n.strip()) for n in names.split(',') if n.strip() }
+
+def parse_machine_requirements(requirements) :
+    """Get the sets of allowed and banned machines from a requirements expression
+    made by machine_requirements
+
+    condor_submit adds its own terms to the requirements of the queued jobs
+    (e.g. '&& (TARGET.Arch == "X86_64") && ... && (TARGET.HasFileTransfer)'),
+    so only the stringListMember(Machine, ...) terms are looked at
+    and the rest of the expression is ignored.
+
+    Returns
+    -------
+        tuple : (allowed, banned) sets of machine names without the URL
+        (allowed is None if any machine is allowed), or None if the expression
+        doesn't have any sets of machines in it
+    """
+
+    allowed, banned = None, set()
+    found = False
+    for m in _machine_list_member.finditer(str(requirements)) :
+        found = True
+        machines = _machine_list(m.group(2))
+        if m.group(1) :
+            banned |= machines
+        else :
+            allowed = machines if allowed is None else allowed & machines
+    if not found :
+        return None
+    return allowed, banned
+
+def add_banned_machine(requirements, m) :
+    """Ban the input SPA machine within an existing requirements expression
+
+    The machine is added to the banned set of machines written by machine_requirements,
+    rewriting that term in place and leaving the rest of the expression (e.g. the terms
+    condor_submit added) as it is. If there isn't a banned set yet, one is and'ed onto
+    the end of the requirements, so the expression stays flat however many machines are banned.
+    """
+
+    requirements = str(requirements)
+    banned_term = None
+    for term in _machine_list_member.finditer(requirements) :
+        if term.group(1) :
+            banned_term = term
+            break
+
+    if banned_term is None :
+        return classad.ExprTree(requirements).and_(machine_requirements(banned = [m]))
+
+    banned = _machine_list(banned_term.group(2))
+    banned.add(short_machine_name(m))
+    return classad.ExprTree(requirements[:banned_term.start()]
+        + str(machine_requirements(banned = banned))
+        + requirements[banned_term.end():])
+
+def bans_machine(requirements, m) :
+    """Check if the input requirements expression already bans the input SPA machine"""
+
+    machine_sets = parse_machine_requirements(requirements)
+    if machine_sets is not None and short_machine_name(m) in machine_sets[1] :
+        return True
+    # jobs submitted before the machines were kept in sets
+    return f'Machine != "{_full_machine_name(m)}"' in str(requirements)
+
 def job_is_mine() :
     """Expression that is true when current user owns the job."""
     return classad.Attribute('Owner') == getpass.getuser()
@@ -71,6 +210,13 @@ def job_status_is_held() :
     """Returns an expression that is true when the Job is in the HELD state.""" 
     return classad.Attribute('JobStatus') == htcondor.JobStatus.HELD
 
+def job_held_by_run_script() :
+    """Returns an expression that is true when the Job was held because our run script failed.
+
+    The exit code of the run script is then stored in HoldReasonSubCode.
+    """
+    return classad.Attribute('HoldReasonCode') == 3
+
 def job_status_is_running() :
     """Returns an expression that is true when the Job is in the RUNNING state."""
     return classad.Attribute('JobStatus') == htcondor.JobStatus.RUNNING
@@ -0,0 +1,179 @@
+"""Verifying the ROOT files produced by our jobs
+
+Opening every output file with ROOT is slow, so we spread the files
+across a pool of processes and remember which files have already
+been checked so that unchanged files are never opened again.
+We also first look at the header of each file without ROOT
+(see rootfile.check) and only open the suspicious files with ROOT.
+"""
+
+import os # for stat-ing files
+import sqlite3 # for the verification cache
+import collections # for namedtuple
+from concurrent.futures import ProcessPoolExecutor # for checking files in parallel
+from umn_htcondor import utility
+from umn_htcondor import rootfile
+
+GOOD = 'good'
+RECOVERED = 'recovered'
+UNREADABLE = 'unreadable'
+
+CheckResults = collections.namedtuple('CheckResults', [GOOD, RECOVERED, UNREADABLE])
+CheckResults.__doc__ = """Lists of files that were good, needed to be recovered, or could not be read"""
+
+class VerificationCache :
+    """On-disk cache of the files that have already been checked
+
+    Files are identified by their path, size, and modification time,
+    so a file that is re-written is checked again.
+    Files that could not be read are not remembered since
+    that is often because of a temporary problem (e.g. with hdfs).
+
+    Parameters
+    ----------
+    path : str, optional
+        Path to the SQLite file holding the cache.
+        Default is 'verify_cache.sqlite' in your local directory.
+    """
+
+    def __init__(self, path = None) :
+        if path is None :
+            path = os.path.join(utility.local_dir(), 'verify_cache.sqlite')
+        os.makedirs(os.path.dirname(os.path.realpath(path)), exist_ok=True)
+        self.path = path
+        self.__db = sqlite3.connect(path, timeout = 60)
+        self.__db.execute("""
+            CREATE TABLE IF NOT EXISTS checked (
+                path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, status TEXT)""")
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, *exc) :
+        self.close()
+
+    def close(self) :
+        """Write any changes to disk and close the cache"""
+        self.__db.commit()
+        self.__db.close()
+
+    def lookup(self, path, size, mtime) :
+        """Get the status of the input file if it was checked and hasn't changed since
+
+        Returns
+        -------
+            str : status of the file or None if it needs to be checked
+        """
+        row = self.__db.execute('SELECT size, mtime, status FROM checked WHERE path = ?', (path,)).fetchone()
+        if row is None or row[0] != size or row[1] != mtime :
+            return None
+        return row[2]
+
+    def record(self, path, size, mtime, status) :
+        """Remember the status of the input file"""
+        if status == UNREADABLE :
+            self.__db.execute('DELETE FROM checked WHERE path = ?', (path,))
+        else :
+            self.__db.execute('INSERT OR REPLACE INTO checked VALUES (?,?,?,?)', (path, size, mtime, status))
+
+def check_with_root(path) :
+    """Check a single file by opening it with ROOT
+
+    This is run within the worker processes, so ROOT is only
+    imported in the workers and not in the process that submitted the checks.
+
+    Returns
+    -------
+        str : GOOD, RECOVERED, or UNREADABLE
+    """
+
+    import ROOT
+    try :
+        rf = ROOT.TFile.Open(path)
+        if not rf or rf.IsZombie() :
+            return UNREADABLE
+        status = RECOVERED if rf.TestBit(ROOT.TFile.EStatusBits.kRecovered) else GOOD
+        rf.Close()
+        return status
+    except Exception :
+        return UNREADABLE
+
+def check_without_root(path) :
+    """Check a single file only by looking at its header (see rootfile.check)
+
+    Files that were cut off or not closed would need to be recovered
+    when opened with ROOT, any other problem makes them unreadable.
+
+    Returns
+    -------
+        str : GOOD, RECOVERED, or UNREADABLE
+    """
+
+    status = rootfile.check(path)
+    if status == rootfile.GOOD :
+        return GOOD
+    elif status in [rootfile.TRUNCATED, rootfile.NOT_CLOSED] :
+        return RECOVERED
+    return UNREADABLE
+
+def check_fast_then_root(path) :
+    """Check a single file by looking at its header and
+    only opening it with ROOT if the header looks suspicious
+
+    Returns
+    -------
+        str : GOOD, RECOVERED, or UNREADABLE
+    """
+
+    if rootfile.check(path) == rootfile.GOOD :
+        return GOOD
+    try :
+        return check_with_root(path)
+    except ImportError :
+        # ROOT isn't available here
+        return check_without_root(path)
+
+def check_files(files, workers = 4, cache = None, check = check_fast_then_root) :
+    """Check the input files, using a pool of processes
+
+    Parameters
+    ----------
+    files : iterable[str]
+        Paths to files to check
+    workers : int, optional
+        Number of processes to check files with
+    cache : VerificationCache, optional
+        Cache of files that have already been checked
+    check : callable, optional
+        Function checking a single file and returning its status,
+        it must be defined at the top level of a module so that it can be sent to the workers.
+
+    Returns
+    -------
+        CheckResults : the files sorted by their status
+    """
+
+    results = CheckResults([], [], [])
+    to_check = []
+    for path in files :
+        try :
+            st = os.stat(path)
+        except OSError :
+            results.unreadable.append(path)
+            continue
+        status = None if cache is None else cache.lookup(path, st.st_size, st.st_mtime_ns)
+        if status is None :
+            to_check.append((path, st.st_size, st.st_mtime_ns))
+        else :
+            getattr(results, status).append(path)
+    #end loop over files
+
+    if len(to_check) > 0 :
+        with ProcessPoolExecutor(max_workers = max(1, workers)) as pool :
+            statuses = pool.map(check, [path for path, size, mtime in to_check], chunksize = 16)
+            for (path, size, mtime), status in zip(to_check, statuses) :
+                getattr(results, status).append(path)
+                if cache is not None :
+                    cache.record(path, size, mtime, status)
+
+    return results
@@ -42,6 +42,16 @@ if ! cd $_job_id; then
   exit 98
 fi
 
+# helpers for handling files, copied next to this script when submitting
+_node_io=$(dirname $(realpath $0))/node_io.py
+
+# Stage the singularity image through a cache on the scratch disk of this node
+#   (see stage-image in node_io.sh, copied next to this script when submitting)
+if [[ -f ${_node_io%.py}.sh ]]; then
+  source ${_node_io%.py}.sh
+  _singularity_img=$(stage-image ${_scratch_root}/image_cache $_singularity_img)
+fi
+
 # Now that we have entered our working directory,
 #   clean-up entails exiting the directory for this
 #   specific job and deleting the whole thing.
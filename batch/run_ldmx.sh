@@ -42,6 +42,34 @@ if ! cd $_job_id; then
   exit 100
 fi
 
+# helpers for handling files, copied next to this script when submitting
+_node_io=$(dirname $(realpath $0))/node_io.py
+
+# records of the outputs we copy, written into the detail directory
+#   once we are done copying (see write-manifest)
+_local_manifest=$(pwd)/manifest.jsonl
+
+# Stage the singularity image through a cache on the scratch disk of this node
+#   (see stage-image in node_io.sh, copied next to this script when submitting)
+if [[ -f ${_node_io%.py}.sh ]]; then
+  source ${_node_io%.py}.sh
+  _singularity_img=$(stage-image ${_scratch_root}/image_cache $_singularity_img)
+fi
+
+# Stage the input files through a cache on the scratch disk of this node
+#   if it was asked for when the jobs were submitted (LDMX_STAGE_INPUTS is
+#   the maximum size of the cache). The input files in the arguments are
+#   hard-linked from the cache into the 'inputs' directory inside our working
+#   directory (so they aren't mistaken for outputs) and the arguments are
+#   re-written to point to them, so the container reads them from the
+#   working directory it already has mounted. The hits and misses of the
+#   cache are printed to our log. If staging fails, we read from hdfs as usual.
+if [[ -n "${LDMX_STAGE_INPUTS}" ]] && [[ -f $_node_io ]] && hash python3 &> /dev/null; then
+  if _staged_args=$(python3 $_node_io stage ${_scratch_root}/input_cache $(pwd)/inputs --max_size ${LDMX_STAGE_INPUTS} -- $_args); then
+    _args=${_staged_args}
+  fi
+fi
+
 # Now that we have entered our working directory,
 #   clean-up entails exiting the directory for this
 #   specific job and deleting the whole thing.
@@ -50,37 +78,29 @@ clean-up() {
   rm -r $_job_id
 }
 
-# Singularity command to run the fire executable
-#   --no-home : don't mount home directory
-#   --bind : mount our current directory and /hdfs/ (for reading input files)
-#   --cleanenv : don't copy current environment into container
-if ! singularity run --no-home --bind $(pwd),/mnt/hdfs/phys/,${LDMX_BASE} --cleanenv --env LDMX_BASE=${LDMX_BASE} $_singularity_img . $_args; then
-  echo "container returned an non-zero error status."
-  clean-up
-  exit 115
-fi
-
 # Our special copying function,
 #   sometimes jobs interrupt the copying mid-way through
 #   (don't know why this happens)
 #   but this means we need to check that the copied file
-#   matches the actually generated file. This is done
-#   using 'cmp -s' which does a bit-wise comparison and
-#   returns a failure status upon the first mis-match.
-#   
-#   Sometimes (usually for larger files like ours),
-#   the kernel decides to put the file into a buffer
-#   and have cp return success. This is done because
-#   the computer can have the copy continue on in the
-#   background without interfering with the user.
-#   In our case, this sometimes causes a failure because
-#   we attempt to compare the copied file (which is only
-#   partial copied) to the original. To solve this
-#   niche issue, we can simply add the 'sync' command
-#   which tells the terminal to wait for these write
-#   buffers to finish before moving on.
+#   matches the actually generated file.
+#
+#   The copying is done by the node_io.py helper that is
+#   copied into the detail directory next to this script.
+#   It calculates a checksum of the source while copying it
+#   (so the source is only read once), syncs only the
+#   copied file to disk, and then compares the checksum of
+#   the copied file read back from the destination.
+#   It prints out the throughput of the copy as well and
+#   appends a record of the copy (output name, size, checksum,
+#   run number, and job id) to our manifest (see write-manifest).
 #
-#   We return a success-status of 0 if we cp and cmp.
+#   If python3 or the helper isn't available, we fall back
+#   to copying with 'cp' and doing a bit-wise comparison with
+#   'cmp -s'. In this case, we need to 'sync' so that the kernel
+#   finishes writing the copy out of its buffers before we compare.
+#   A successful copy is recorded in our manifest without a checksum.
+#
+#   We return a success-status of 0 if the copy matches.
 #   Otherwise, we make sure any partially-copied files
 #   are removed from the destination directory and try again
 #   until the input number of tries are attempted.
@@ -92,16 +112,27 @@ fi
 #     2 - Number of tries to attempt before giving up
 #     3 - source file to copy
 #     4 - destination directory to put copy in
+#   The run number for the manifest is taken from _manifest_run
 copy-and-check() {
   local _sleep_between_tries="$1"
   local _num_tries="$2"
   local _source="$3"
   local _dest_dir="$4"
+  local _manifest_args="--manifest ${_local_manifest} --job_id ${_job_id}"
+  if [[ "${_manifest_run}" != "null" ]]; then
+    _manifest_args="${_manifest_args} --run ${_manifest_run}"
+  fi
   for try in $(seq $_num_tries); do
-    if cp -t $_dest_dir $_source; then
+    if [[ -f $_node_io ]] && hash python3 &> /dev/null; then
+      if python3 $_node_io copy $_source $_dest_dir ${_manifest_args}; then
+        #SUCCESS!
+        return 0;
+      fi
+    elif cp -t $_dest_dir $_source; then
       sync #wait for large files to actually leave buffer
       if cmp -s $_source $_dest_dir/$_source; then
         #SUCCESS!
+        echo "{\"output\": \"${_source}\", \"size\": $(stat -c %s ${_source}), \"checksum\": null, \"algorithm\": null, \"run\": ${_manifest_run}, \"job_id\": \"${_job_id}\", \"status\": \"ok\", \"time\": $(date +%s)}" >> ${_local_manifest}
         return 0;
       else
         #Interrupted during copying
@@ -115,25 +146,178 @@ copy-and-check() {
   return 1
 }
 
-# check if output directory exists
-#   we wait until here because sometimes
-#   hdfs is connected when we start the job
-#   but isn't connected at the end
-if [[ ! -d $_output_dir ]]; then
-  echo "Output directory '$_output_dir' doesn't exist!"
-  exit 117
-fi
+# Run number for the manifest record of copies made for the input arguments
+#   the run number is the last argument if it is an integer, otherwise 'null'
+#
+#   Arguments
+#     1 - arguments given to the program
+manifest-run() {
+  local _last_arg=${1##* }
+  if [[ "${_last_arg}" =~ ^[0-9]+$ ]]; then
+    echo ${_last_arg}
+  else
+    echo null
+  fi
+}
 
-# copy over each output file, checking to make sure it worked
+# Write the records of our copies into a manifest file of our own in the detail directory
+#   detail/manifest/<cluster>/<job-id>.jsonl
+#   HDFS only allows one writer for each file, so the jobs can't all append
+#   to one manifest. The file is written in one go with node_io.py
+#   (or with 'cp' if we don't have it). This doesn't fail the job,
+#   the runs without records are found by scanning the output directory.
+write-manifest() {
+  if [[ ! -f ${_local_manifest} ]]; then
+    return 0
+  fi
+  local _manifest=${_output_dir}/detail/manifest/${_job_id%%_*}/${_job_id}.jsonl
+  if [[ -f $_node_io ]] && hash python3 &> /dev/null; then
+    python3 $_node_io manifest ${_local_manifest} ${_manifest}
+  else
+    mkdir -p $(dirname ${_manifest}) && rm -f ${_manifest} && cp ${_local_manifest} ${_manifest}
+  fi
+}
+
+# copy over each output file in the current directory, checking to make sure it worked
 #   most of the time this is only one file, but sometimes
 #   we create both a event and a histogram file
-for _output_file in *.root; do
-  if ! copy-and-check 30 10 $_output_file $_output_dir; then
-    # Coulding copy after trying 10 times, waiting
-    #   30s between each try.
-    echo "Copying failed after several tries."
-    exit 118
+#
+#   We return a success-status of 0 if all of the outputs were copied,
+#   117 if the output directory can't be seen, and 118 if copying
+#   an output failed.
+copy-outputs() {
+  # check if output directory exists
+  #   we wait until here because sometimes
+  #   hdfs is connected when we start the job
+  #   but isn't connected at the end
+  if [[ ! -d $_output_dir ]]; then
+    echo "Output directory '$_output_dir' doesn't exist!"
+    return 117
+  fi
+  for _output_file in *.root; do
+    if ! copy-and-check 30 10 $_output_file $_output_dir; then
+      # Coulding copy after trying 10 times, waiting
+      #   30s between each try.
+      echo "Copying failed after several tries."
+      return 118
+    fi
+  done
+  return 0
+}
+
+# Singularity command to run inside the container
+#   --no-home : don't mount home directory
+#   --bind : mount our current directory and /hdfs/ (for reading input files)
+#   --cleanenv : don't copy current environment into container
+#   the first argument to the image is the directory to run in
+#   and the rest is the command to run
+run-in-container() {
+  singularity run --no-home --bind $(pwd),/mnt/hdfs/phys/,${LDMX_BASE} --cleanenv --env LDMX_BASE=${LDMX_BASE} $_singularity_img . "$@"
+}
+
+# Several items can be given to this job to run at once (see JobInstructions.processes_per_job)
+#   in which case the arguments look like
+#     <program> <config> <config-args> :: <item-1-args> :: <item-2-args> ...
+#   and each item is run with the arguments before the first '::' followed by its own.
+_prefix=""
+_items=()
+_in_items=false
+for _word in $_args; do
+  if [[ "${_word}" == "::" ]]; then
+    if ${_in_items}; then
+      _items+=("${_item}")
+    fi
+    _in_items=true
+    _item=""
+  elif ${_in_items}; then
+    _item="${_item} ${_word}"
+  else
+    _prefix="${_prefix} ${_word}"
   fi
 done
+if ${_in_items}; then
+  _items+=("${_item}")
+fi
+
+if [[ ${#_items[@]} -eq 0 ]]; then
+  # run the fire executable
+  if ! run-in-container $_args; then
+    echo "container returned an non-zero error status."
+    clean-up
+    exit 115
+  fi
+
+  _manifest_run=$(manifest-run "$_args")
+  copy-outputs
+  _status=$?
+  write-manifest
+  if [[ ${_status} -ne 0 ]]; then
+    exit ${_status}
+  fi
+
+  clean-up
+  exit 0
+fi
+
+# Run all of the items at once inside of one container
+#   Each item runs in its own sub-directory, writing its log there and
+#   its exit status into a 'status' file when it finishes. While the container
+#   is running, we copy the outputs of each item as soon as its status appears.
+{
+  for _i in "${!_items[@]}"; do
+    mkdir item_${_i}
+    echo "(cd item_${_i} && ${_prefix} ${_items[${_i}]} &> item.log; echo \$? > status.tmp; mv status.tmp status) &"
+  done
+  echo "wait"
+} > items.sh
+
+run-in-container bash items.sh &
+_container=$!
+
+# The job exits with the largest exit code of its items so that a job with
+#   an item that failed to copy (117 or 118) is still released and run again
+#   (see JobInstructions.periodic_release)
+_exit_code=0
+_done=()
+set +x # don't fill our log while waiting
+while true; do
+  _running=false
+  if kill -0 ${_container} &> /dev/null; then
+    _running=true
+  fi
+  for _i in "${!_items[@]}"; do
+    if [[ -n "${_done[${_i}]}" ]] || { ${_running} && [[ ! -f item_${_i}/status ]]; }; then
+      continue
+    fi
+    _done[${_i}]=1
+    set -x
+    cat item_${_i}/item.log
+    _item_status=$(cat item_${_i}/status 2> /dev/null)
+    echo "Item ${_i} (${_items[${_i}]} ) finished with status '${_item_status}'."
+    if [[ "${_item_status}" != "0" ]]; then
+      # item failed to run or the container stopped before it finished
+      _item_status=115
+    else
+      _item_status=$(cd item_${_i} && _manifest_run=$(manifest-run "${_items[${_i}]}") && copy-outputs >&2; echo $?)
+    fi
+    if [[ ${_item_status} -gt ${_exit_code} ]]; then
+      _exit_code=${_item_status}
+    fi
+    set +x
+  done
+  if ! ${_running}; then
+    break
+  fi
+  sleep 10
+done
+set -x
+wait ${_container}
+write-manifest
+
+if [[ ${_exit_code} -ne 0 ]]; then
+  echo "At least one item failed with exit code ${_exit_code}."
+  clean-up
+  exit ${_exit_code}
+fi
 
 clean-up
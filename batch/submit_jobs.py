@@ -5,8 +5,9 @@ This python script is intended to be used with the running script 'run_fire.sh'
 
 import os
 import argparse
-from umn_htcondor.utility import local_dir, hdfs_dir
+from umn_htcondor.utility import local_dir, hdfs_dir, parse_size, resolve_path
 from umn_htcondor.submit import JobInstructions
+from umn_htcondor.images import ImageCache
 
 parser = argparse.ArgumentParser('ldmx-submit-jobs',
     description="Submit batches of jobs running the ldmx-sw application.",
@@ -29,7 +30,17 @@ how_many_jobs.add_argument('-r','--refill',dest='refill',action='store_true',hel
 parser.add_argument("--input_arg_name",type=str,default='',help='Name of argument that should go before the input file or run number when passing it to the config script.')
 parser.add_argument("--start_job",type=int,default=0,help="Starting number to use when run numbers. Only used if NOT running over items in a directory.")
 parser.add_argument("--files_per_job",type=int,default=10,help="If running over an input directory, this argument defines how many files to group together per job.")
+balance_jobs = parser.add_mutually_exclusive_group()
+balance_jobs.add_argument("--bytes_per_job",type=str,help="If running over an input directory, group files together so that each job has about this much input instead of a fixed number of files. Can use 'K', 'M', 'G' as suffix specifiers.")
+balance_jobs.add_argument("--events_per_job",type=int,help="If running over an input directory, group files together so that each job has about this many events. Event counts are read from file listings ('<file> <num-events>' lines), falls back to --files_per_job if no counts are given.")
+parser.add_argument("--refill_pattern",type=str,help="Regular expression with a group named 'run' matching the run number in output file names when refilling. Default matches '<other-parameters>_run_<run-number>.root'.")
+parser.add_argument("--refill_min_fraction",type=float,help="When refilling, also re-run any run whose output file is smaller than this fraction of the median size of similar output files. Zero-length outputs are always re-run.")
+parser.add_argument("--refill_from_manifest",default=False,action='store_true',help="When refilling, find the runs that are done from the manifests the jobs wrote into the detail directory instead of scanning the output directory. The output directory is still scanned if some runs don't have records.")
 parser.add_argument("--no_recursive",default=False,action='store_true',help='Should we NOT recursively enter the input directories?')
+parser.add_argument("--scan_threads",type=int,default=8,help="Number of threads to use when scanning the input directories for files.")
+input_catalog = parser.add_mutually_exclusive_group()
+input_catalog.add_argument("--catalog",type=str,default=None,help="SQLite file to remember input directory listings in between submissions. Default is input_catalog.sqlite in your local directory: %s"%local_dir())
+input_catalog.add_argument("--no_catalog",action='store_true',help="Re-list every input directory instead of re-using unchanged listings from the input catalog.")
 
 # rarely-used optional args
 full_path_to_dir_we_are_in=os.path.dirname(os.path.realpath(__file__))
@@ -41,8 +52,16 @@ parser.add_argument("--nonice",action='store_true',dest="nonice",help="Do not ru
 parser.add_argument("--sleep",type=int,help="Time in seconds to sleep before starting the next job.",default=5)
 parser.add_argument("--max_memory",type=str,default='4G',help='Maximum amount of memory to give jobs. Can use \'K\', \'M\', \'G\' as suffix specifiers.')
 parser.add_argument("--max_disk",type=str,default='1G',help='Maximum amount of disk space to give jobs. Can use \'K\', \'M\', \'G\' as suffix specifiers.')
+parser.add_argument("--auto_resources",type=str,nargs='*',metavar='PAST_OUT_DIR',help="Request memory and disk from the peak usage of past jobs that ran the same configuration in these output directories (default is the output directory of this submission). --max_memory and --max_disk are still the most that will be requested.")
+parser.add_argument("--processes_per_job",type=int,metavar='N',help="Request N CPUs for each job and run N run numbers (or groups of input files) at once in each job, inside of one container. --max_memory and --max_disk are for the whole job.")
+parser.add_argument("--pilots",type=int,metavar='N',help="Put the run numbers (or groups of input files) into a work queue in our local directory and submit N pilot jobs that each run items from the queue until it is empty, instead of one job for each item. Helpful when each item only takes a few minutes.")
+parser.add_argument("--stage_inputs",type=str,nargs='?',const='100G',metavar='MAX_SIZE',help="Copy the input files into a cache on the scratch disk of each worker node so that jobs on the same node reading the same files don't each pull them from hdfs. Optionally give the maximum size of the cache on each node (default 100G).")
 parser.add_argument("--periodic_release",action='store_true',help="Periodically release any jobs that exited because the worker node was not connected to cvmfs or hdfs.")
+parser.add_argument("--throttle",type=int,metavar='N',help="Submit the jobs on hold and release them so that about N jobs are idle or running at once. N is lowered automatically when jobs fail to copy their outputs (exit codes 117 and 118) or slow down, and raised while they run fine. The script keeps running until all jobs are released.")
+parser.add_argument("--max_per_transaction",type=int,help="Split the submission into several clusters of at most this many jobs so that very large submissions don't time out the schedd.")
 parser.add_argument("--priority",type=int,help='Define this job as higher priority than the default of zero. Provide an integer to rank relative to other jobs. (Higher == More Urgent)')
+parser.add_argument("--ban_unhealthy",action='store_true',help="Also avoid machines that have recently been holding too many of your jobs, judged from your held jobs and the event logs in the output directory. The health of each machine is remembered in host_health.json in your local directory: %s"%local_dir())
+parser.add_argument("--avoid_unreachable",action='store_true',help="Also avoid machines whose last check (from check-scorpions in the last few minutes) was not good. The machines are not checked again.")
 parser.add_argument("--broken_machines",type=str,nargs='+',help="Extra list of machines that should be avoided, usually because they are not running your jobs for whatever reason. For example: --broken_machines scorpion34 scorpion17")
 
 machine_choice = parser.add_mutually_exclusive_group()
@@ -55,17 +74,22 @@ arg = parser.parse_args()
 if arg.singularity_img is not None :
     singularity_img = os.path.realpath(arg.singularity_img)
 else :
-    img_name = arg.docker_tag.replace(':','_').replace('/','_')
-    singularity_img = f'{local_dir()}/{img_name}.sif'
-    # singularity will prompt user if image already exists
-    os.system(f'singularity build {singularity_img} docker://{arg.docker_tag}')
+    # images are only built if we don't have one built from the same docker image already
+    singularity_img = ImageCache().get(arg.docker_tag)
 
 job_instructions = JobInstructions(arg.run_script, arg.out_dir, singularity_img, arg.config, 
     input_arg_name = arg.input_arg_name, extra_config_args = arg.config_args, program = arg.program)
 
+if arg.processes_per_job is not None :
+    job_instructions.processes_per_job(arg.processes_per_job)
 job_instructions.memory(arg.max_memory)
 job_instructions.disk(arg.max_disk)
+if arg.auto_resources is not None :
+    job_instructions.size_from_history(arg.auto_resources or [arg.out_dir],
+        max_memory = arg.max_memory, max_disk = arg.max_disk)
 job_instructions.nice(not arg.nonice)
+if arg.stage_inputs is not None :
+    job_instructions.stage_inputs(arg.stage_inputs)
 job_instructions.sleep(arg.sleep)
 
 if arg.priority is not None :
@@ -75,15 +99,12 @@ scorpions_with_small_scratch = [1,3,5,6,9,10,11,12,14,16,17,18,20,21,22,23,24]
 
 # update list of requirements for our machine choice
 if arg.useable_machines is not None :
-    # Reset requirements
-    job_instructions['requirements'] = 'False'
     for m in arg.useable_machines :
         job_instructions.use_machine(m)
 elif arg.production :
     for s in scorpions_with_small_scratch :
         job_instructions.ban_machine(f'scorpion{s}')
 elif arg.analysis :
-    job_instructions['requirements'] = 'False'
     for s in scorpions_with_small_scratch :
         job_instructions.use_machine(f'scorpion{s}')
 
@@ -93,6 +114,19 @@ if arg.broken_machines is not None :
     for m in arg.broken_machines :
         job_instructions.ban_machine(m)
 
+if arg.avoid_unreachable :
+    from umn_htcondor import probe
+    bad_hosts = probe.bad_hosts()
+    if len(probe.cached('check')) == 0 :
+        print('No recent results from check-scorpions, not avoiding any machines for being unreachable.')
+    print(f'Avoiding unreachable machines: {bad_hosts}')
+    for m in bad_hosts :
+        job_instructions.ban_machine(m)
+
+if arg.ban_unhealthy :
+    bans = job_instructions.ban_unhealthy_machines([os.path.join(resolve_path(arg.out_dir),'detail','logs')])
+    print(f'Avoiding unhealthy machines: {bans}')
+
 # run_fire.sh exits with code 99 if the worker is not connected to cvmfs or hdfs
 #   in this case, we want to retry and hopefully find a worker that is correctly connected
 #
@@ -102,14 +136,21 @@ if arg.periodic_release :
     job_instructions.periodic_release()
 
 if arg.input_dir is not None :
-    job_instructions.run_over_input_dirs(arg.input_dir, arg.files_per_job, not arg.no_recursive)
+    job_instructions.run_over_input_dirs(arg.input_dir, arg.files_per_job, not arg.no_recursive, arg.scan_threads,
+        catalog = False if arg.no_catalog else (arg.catalog or True),
+        bytes_per_job = None if arg.bytes_per_job is None else parse_size(arg.bytes_per_job),
+        events_per_job = arg.events_per_job)
 elif arg.refill :
-    job_instructions.run_refill()
+    job_instructions.run_refill(arg.refill_pattern, min_fraction = arg.refill_min_fraction, scan_threads = arg.scan_threads,
+        use_manifest = arg.refill_from_manifest)
 else :
     job_instructions.run_numbers(arg.start_job, arg.num_jobs)
 #input directory or not
 
+if arg.pilots is not None :
+    job_instructions.pilots(arg.pilots)
+
 if arg.nocheck :
-    job_instructions.submit()
+    job_instructions.submit(arg.max_per_transaction, arg.throttle)
 else :
-    job_instructions.submit_interactive()
+    job_instructions.submit_interactive(arg.max_per_transaction, arg.throttle)